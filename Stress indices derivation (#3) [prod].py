@@ -10,11 +10,53 @@ import re, os
 #import pdb
 import glob
 #import pandas.api.types as ptypes
+from gscsi.lane_stats import LANE, lane_quantiles, reference_lead_times
+from gscsi.lane_sketch import lane_sketches, lane_codes, quantiles as sketch_quantiles
+from gscsi.ports import load_ports
+from gscsi.region_matrix import region_matrix, tidy, wide
+from gscsi.rolling_stress import LEG_COLUMNS, leg_delays, rolling_stress
+from gscsi.config import load_config
+from gscsi.segments import current_segment
+from gscsi import instrument
+from gscsi.instrument import traced
 
 pd.set_option('display.max_columns', 12)
 pd.set_option("display.expand_frame_repr", False)
 #pd.set_option('display.width', 1000)
 #pd.set_option("display.precision", 1)
+# Market segment of the run (GSCSI_SEGMENT: containers or drybulk, see gscsi.segments): working directory and
+# capacity column of the Dep2Dep aggregates (TEU sum, DWT sum)
+SEGMENT = current_segment()
+CAPACITY = '{} sum'.format(SEGMENT['weight'])
+# Paths of the site configuration (pipeline.ini, see gscsi.config)
+CONFIG = load_config()['paths']
+WORKDIR = CONFIG[SEGMENT['workdir']]
+PORTS_FILE = CONFIG['ports']
+# Step timings and row counts (JSON lines, off unless a trace file is configured, see gscsi.instrument)
+instrument.configure('stress')
+# Reference lead time of a lane = (K+1) * median - K * LOW_QUANTILE quantile of its monthly median times,
+# only lanes active in more than MIN_PERIOD_COUNT months are kept
+K = 2
+LOW_QUANTILE = .1
+MIN_PERIOD_COUNT = 10
+# (k, low quantile, min period count) settings of the robustness checks, all evaluated in one run
+SENSITIVITY_GRID = [(k, q, n) for k in (1, 2, 3) for q in (.1, .25) for n in (5, 10, 15)]
+# Origin x destination stress by month (gscsi.region_matrix): port attributes the ports are grouped by, one tidy and
+# one matrix (delayed capacity) file each
+MATRIX_LEVELS = ['Maritime_Region', 'country_3', 'Economy name']
+# Rolling mode (gscsi.rolling_stress): stress of every destination port and maritime region on a daily grid, over trailing
+# windows of ROLLING_WINDOWS days, from the legs written by stage 2 (ROLLING_LEGS there); ROLLING_START: first day of
+# the grid (None: all the data)
+ROLLING = False
+ROLLING_WINDOWS = [7, 28, 91]
+ROLLING_START = None
+QUANTILES = sorted({.5, LOW_QUANTILE} | {q for _, q, _ in SENSITIVITY_GRID})
+# Lane quantiles come from per-lane sketches kept in LANE_SKETCHES between runs and updated with the months added
+# since the last run (exact as long as a lane has at most SKETCH_CAPACITY months); EXACT = True recomputes them
+# from the full history of the input instead (audits), without touching the sketches
+EXACT = False
+LANE_SKETCHES = os.path.join(WORKDIR, 'lane_sketches_{}.npz')
+SKETCH_CAPACITY = 200
 
 def define_datetime():
     """Create timestamp extension FORMAT: _DDMMMYYYY"""
@@ -26,8 +68,12 @@ def define_datetime():
     return datetime_ext
 
 def define_traffic(nameoffile):
-    """Check and make sure that the traffic type in the name of the file is GLOBAL"""
-    if re.search("GLOBAL", nameoffile, flags = re.I) and not re.search("reg", nameoffile):
+    """Check and make sure that the traffic type in the name of the file is GLOBAL (drybulk: LADEN or BALLAST)"""
+    if re.search("LADEN", nameoffile):
+        traffic = "(laden)"
+    elif re.search("BALLAST", nameoffile):
+        traffic = "(ballast)"
+    elif re.search("GLOBAL", nameoffile, flags = re.I) and not re.search("reg", nameoffile):
         traffic = "(global)"
     elif re.search("reg", nameoffile) and not re.search("glob", nameoffile):
         traffic = "(regional)"
@@ -35,20 +81,22 @@ def define_traffic(nameoffile):
         traffic = "(all traffic)"
     return traffic
 
+@traced('read')
 def get_inputs(nameoffile):
     #df=pd.read_pickle(nameoffile)
     df=pd.read_csv(nameoffile)
     return df
 
+@traced('clean')
 def clean_inputs(df):
     """
     Step 1. Rename the columns to be more descriptives _CUR --> Destinations and _PREV --> Origins 
     Step 2. Drop nulls
     Step 3. Double check (drop) that there are no records with origin/destination at the same port
-    Step 4. Filter out records with invalid capacity
+    Step 4. Filter out records with invalid capacity (CAPACITY: TEU sum, DWT sum for drybulk)
     Return: clean dataframe and a dictionary of column transformations from step 1
     """
-    filter1=['PORT_ID_CUR', 'PORT_ID_PREV', 'Dep2_YearMonth','SHIP_ID count', 'TEU sum', 'diff_hrs median']
+    filter1=['PORT_ID_CUR', 'PORT_ID_PREV', 'Dep2_YearMonth','SHIP_ID count', CAPACITY, 'diff_hrs median']
     filter2 = ['PORT_ID Destination', 'PORT_ID Origin','Departure_YearMonth', 'SHIP_ID count', 'TEUs sum','time difference (median hrs)']
     f = dict(zip(filter2, filter1))
     f_reversed = dict(map(reversed, f.items()))
@@ -56,7 +104,7 @@ def clean_inputs(df):
     df=df.filter(filter1)
     df.dropna(inplace=True)
     df=df.loc[df['PORT_ID_CUR']!=df['PORT_ID_PREV']]
-    df=df.loc[df['TEU sum']>0]
+    df=df.loc[df[CAPACITY]>0]
     return df, f_reversed
     
 def shangai_long_beach_show(df):
@@ -64,6 +112,9 @@ def shangai_long_beach_show(df):
     filter1=(df['PORT_ID_CUR']==2727)
     filter2=(df['PORT_ID_PREV']==1253)
     dfex=df.loc[filter1&filter2]
+    if dfex.empty:
+        print("No activity between Shanghai and Long Beach")
+        return
     dfex['diff_hrs median'].plot.hist()
     plt.show()
     dfex.groupby("Dep2_YearMonth")['diff_hrs median'].sum().plot()
@@ -74,128 +125,174 @@ def shangai_long_beach_show(df):
     print("Median: ",a,"25th percentile: ", b, "75th percentile: ", c, "3*25th percentile - 2*75th percentile: ", 3*a-2*b)
     return
 
-def activity_by_lane(df, aggtype, verbose):
-    """Create the statistics of activity by lane"""
-    df_lane=df.groupby(['PORT_ID_CUR', 'PORT_ID_PREV']).agg({'diff_hrs median':'median','TEU sum':'median','SHIP_ID count':aggtype})
-    df_lane.columns = ["_".join(x) for x in df_lane.columns]
-    df_lane.columns =['diff_hrs median','TEU sum',f'SHIP_ID {aggtype}']
+def activity_by_lane(df, verbose):
+    """Create the statistics of activity by lane (one grouped pass): median time and capacity (TEU, DWT),
+    sum of ships and count of periods"""
+    df_lane=df.groupby(['PORT_ID_CUR', 'PORT_ID_PREV']).agg(**{'diff_hrs median': ('diff_hrs median', 'median'), CAPACITY: (CAPACITY, 'median'),
+                                                               'SHIP_ID sum': ('SHIP_ID count', 'sum'), 'SHIP_ID count': ('SHIP_ID count', 'count')})
     df_lane = df_lane.reset_index()
     #df0.sort_values(by='TEU sum',axis=1, ascending=False, inplace=True)
     if verbose:
-        df_lane[f'SHIP_ID {aggtype}'].plot.hist()
-        plt.show()
+        for aggtype in ['sum', 'count']:
+            df_lane[f'SHIP_ID {aggtype}'].plot.hist()
+            plt.show()
         print(df_lane.head())
     return df_lane
 
-def reference_lead_time(dataframe, df_lane):
-    """ 3 * median - 2* 1st quartile 
-    Augment the original dataframe with a reference lead time by pair of OD ports
-    Filter bilateral lane dataframe  to keep count of period and join with df1"""
-    df = dataframe.copy()
-    df0 = df_lane.copy()
-   
-    k=2
-    df['diff_trs median'] = pd.to_numeric(df['diff_hrs median'])
-    df1=df.groupby(['PORT_ID_CUR', 'PORT_ID_PREV'])['diff_hrs median'].agg([('diff_hrs median', lambda x: (k+1)*np.quantile(x,.5)-k*np.quantile(x,.1))]).reset_index()
-    
-    df0=df0.filter(['PORT_ID_CUR', 'PORT_ID_PREV','SHIP_ID count'])
-    df1=df1.set_index(['PORT_ID_CUR', 'PORT_ID_PREV']).join(df0.set_index(['PORT_ID_CUR', 'PORT_ID_PREV']), on=['PORT_ID_CUR', 'PORT_ID_PREV'],how='left').reset_index()
-    df1.rename(columns={'diff_hrs median':'reference_lead_time','SHIP_ID count':'period count' },inplace=True)
-    return df1
+@traced('lane_statistics')
+def lane_statistics(df, traffic, exact=EXACT):
+    """Quantiles (QUANTILES) of the monthly median times and count of periods of every lane, and the lane of every row of df.
+    From the lane sketches of the traffic type, or recomputed from df if exact"""
+    if exact:
+        return lane_quantiles(df, 'diff_hrs median', QUANTILES)
+    sketch = lane_sketches(df, LANE_SKETCHES.format(traffic.strip('()').replace(' ', '_')), 'Dep2_YearMonth', 'diff_hrs median', SKETCH_CAPACITY)
+    lanes = sketch_quantiles(sketch, QUANTILES).astype({key: df[key].dtype for key in LANE})
+    return lanes, lane_codes(lanes, df)
+
+def reference_lead_time(lanes, k=K, low_quantile=LOW_QUANTILE):
+    """ (k+1) * median - k * low quantile (default 3 * median - 2 * 10th percentile) of the monthly median times
+    Reference lead time by pair of OD ports, with its count of periods (months with activity),
+    from the lane statistics of lane_statistics"""
+    lanes = lanes.copy()
+    lanes['reference_lead_time'] = reference_lead_times(lanes, k, low_quantile)
+    return lanes[['PORT_ID_CUR', 'PORT_ID_PREV', 'reference_lead_time', 'period count']]
 
-def join_ref(dataframe, dataframe1):
-    #Do a join of the reference dataframe df1 with df and  Keep the lanes with minimal activity (above 10)
+@traced('join_ref')
+def join_ref(dataframe, dataframe1, min_period_count=MIN_PERIOD_COUNT):
+    #Do a join of the reference dataframe df1 with df and  Keep the lanes with minimal activity (above min_period_count)
     frame=dataframe.set_index(['PORT_ID_CUR', 'PORT_ID_PREV']).join(dataframe1.set_index(['PORT_ID_CUR', 'PORT_ID_PREV']), on=['PORT_ID_CUR', 'PORT_ID_PREV'],how='left')
     frame=frame.reset_index()
-    frame=frame.loc[frame['period count']>10]
+    instrument.merge_ratio(len(dataframe), len(frame))
+    frame=frame.loc[frame['period count']>min_period_count]
     return frame
 
-def stalled_capacity_pairs(dataframe):
+def delayed_pairs(dataframe):
     df = dataframe.copy()
     # Do the estimate of stalled capacity by pair
     df['delay']=np.heaviside(df['diff_hrs median']-df['reference_lead_time'],0.5)*(df['diff_hrs median']-df['reference_lead_time'])
     df['delayed_ship']=df['SHIP_ID count']*df['delay']/730
-    df['delayed_capacity']=df['TEU sum']*df['delay']/730
+    df['delayed_capacity']=df[CAPACITY]*df['delay']/730
     #df['delayed_ship sum']=df['SHIP_ID count']*df['delay']/730
     #df['delayed_capacity median']=df['TEU median']*df['delay']/730
+    return df
+
+@traced('stress_pairs')
+def stalled_capacity_pairs(dataframe):
+    df = delayed_pairs(dataframe)
     # Aggregate stalled capacity by port of arrival and month
-    df2=df.groupby(['Dep2_YearMonth','PORT_ID_CUR']).agg({'delayed_ship':'sum','delayed_capacity':'sum','TEU sum':'sum'}).reset_index()
-    df2['port_delay']=730*df2['delayed_capacity']/df2['TEU sum']
+    df2=df.groupby(['Dep2_YearMonth','PORT_ID_CUR']).agg({'delayed_ship':'sum','delayed_capacity':'sum',CAPACITY:'sum'}).reset_index()
+    df2['port_delay']=730*df2['delayed_capacity']/df2[CAPACITY]
     df2.rename(columns={'PORT_ID_CUR':'PORT_ID'},inplace=True)#rename column with port id to match port file
     return df2
 
-def ports_metadata(ports_file):
-    #retrieve port data
-    df3=pd.read_csv(ports_file,usecols=['PORT_ID', 'PORT_NAME', 'Latitude','Longitude', 'un_code', 'country_3', 'Economy name','Maritime_Region']) 
-    # dfports['PORT_ID'] = dfports['PORT_ID'].astype('Int64')
-    #assert df3['PORT_ID'].dtypes == df2['PORT_ID'].dtypes
-    #df3[df3.isna().any(axis=1)]
-    df3.at[52, 'country_3'] = 'IDN'
-    df3.at[249, 'country_3'] = 'JPN'
-    df3.at[321, 'country_3'] = 'BRA'
-    df3.at[1756, 'country_3'] = 'GLP'
-    df3.at[1757, 'country_3'] = 'AIA'
-
-    df3.at[52, 'Maritime_Region'] = 'South East Asia'
-    df3.at[249, 'Maritime_Region'] = 'North Asia'
-    df3.at[321, 'Maritime_Region'] = 'South America East Coast'
-    df3.at[1756, 'Maritime_Region'] = 'Carribean Sea & Central America'
-    df3.at[1757, 'Maritime_Region'] = 'Carribean Sea & Central America'
-    dfports = df3.copy()
-    
-    prev = dfports.copy()
-    cols = [x+"_PREV" for x in prev.columns]
-    prev.columns = cols
-    cur = dfports.copy()
-    cols = [x+"_CUR" for x in cur.columns]
-    cur.columns = cols
-    return  prev, cur
-
-def stalled_capacity(dataframe):
+@traced('stress')
+def stalled_capacity(dataframe, ports):
     #estimation of stalled capacity by maritime region and export to csv
-    prev, cur = ports_metadata('Y:\\mt\\ports.csv')
-    dataframe = dataframe.copy() 
-    #cols_to_check = [cur['PORT_ID_CUR'], prev['PORT_ID_PREV'], dataframe['PORT_ID']] 
-    #assert all(ptypes.is_numeric_dtype(dataframe[col]) for col in cols_to_check)
-
-    dataframe1 = pd.merge(dataframe, cur,how='left',left_on='PORT_ID',right_on='PORT_ID_CUR')
-    #dataframe2 = pd.merge(dataframe1,prev,how='left',left_on='PORT_ID_PREV',right_on='PORT_ID_PREV')
-    #df=df.set_index(['PORT_ID']).join(dfports.set_index(['PORT_ID']), on=['PORT_ID'],how='left').reset_index() # dataframe for further processing
-    dfagg=dataframe1.groupby(['Dep2_YearMonth','Maritime_Region_CUR']).agg({'delayed_ship':'sum','delayed_capacity':'sum'}).reset_index()
-    #dfbilat=dataframe.groupby(['Dep2_YearMonth','Maritime_Region_CUR','Maritime_Region_PREV']).agg({'delayed_ship':'sum','delayed_capacity':'sum'}).reset_index()
+    #(ports: port registry of gscsi.ports - ports.csv with corrections keyed by PORT_ID, attributes attached by integer take)
+    dataframe = dataframe.reset_index(drop=True)
+    dataframe1 = pd.concat([dataframe, ports.take(dataframe['PORT_ID'], suffix='_CUR')], axis=1)
+    instrument.merge_ratio(len(dataframe), len(dataframe1))
+    dfagg=dataframe1.groupby(['Dep2_YearMonth','Maritime_Region_CUR'], observed=True).agg({'delayed_ship':'sum','delayed_capacity':'sum'}).reset_index()
+    # bilateral (origin x destination) version: see stress_matrices
     return dfagg, dataframe1
 
+@traced('stress_matrix')
+def stress_matrices(dataframe, ports, levels=MATRIX_LEVELS):
+    """Delayed ships and capacity by month, origin and destination group of ports for every level of levels (port attribute),
+    from the lane-month rows with their reference lead time (join_ref). Return: dict {level: matrix} (see gscsi.region_matrix)"""
+    pairs = delayed_pairs(dataframe)
+    return {level: region_matrix(pairs, ports, level) for level in levels}
+
+@traced('read_legs')
+def get_legs(legsfile):
+    return pd.read_parquet(legsfile, columns=LEG_COLUMNS + [SEGMENT['weight']])
+
+@traced('rolling')
+def rolling_stress_indices(legs, lanes, ports, windows=ROLLING_WINDOWS, start=ROLLING_START, min_period_count=MIN_PERIOD_COUNT):
+    """Daily stress over trailing windows by destination port and by maritime region (gscsi.rolling_stress) of the legs of stage 2,
+    delays over the reference lead times of the lanes (reference_lead_time) active in more than min_period_count months, as in join_ref"""
+    delays = leg_delays(legs, lanes[lanes['period count'] > min_period_count], SEGMENT['weight'])
+    by_port = rolling_stress(delays, delays['PORT_ID_CUR'], windows, start, name='PORT_ID', capacity=CAPACITY)
+    by_port = pd.concat([by_port, ports.take(by_port['PORT_ID'], ['PORT_NAME', 'Maritime_Region'], suffix='_CUR')], axis=1)
+    regions = ports.take(delays['PORT_ID_CUR'], ['Maritime_Region'])['Maritime_Region']
+    by_region = rolling_stress(delays, regions, windows, start, name='Maritime_Region_CUR', capacity=CAPACITY)
+    return by_port, by_region
+
+@traced('sensitivity')
+def sensitivity_grid(df, lanes, code, ports, grid=SENSITIVITY_GRID):
+    """Stalled capacity by month and maritime region for every (k, low quantile, min period count) setting of grid.
+    lanes, code: lane statistics of lane_statistics, shared by all settings"""
+    periods = lanes['period count'].to_numpy()[code]
+    series = []
+    for k, q, n in grid:
+        frame = df.assign(**{'reference_lead_time': reference_lead_times(lanes, k, q)[code], 'period count': periods})
+        dfagg, _ = stalled_capacity(stalled_capacity_pairs(frame[frame['period count'] > n]), ports)
+        series.append(dfagg.assign(k=k, low_quantile=q, min_period_count=n))
+    return pd.concat(series, ignore_index=True)
+
 def save_files(dfagg, dataframe, datetime_ext, traffic,f_reversed):
-    dfagg.to_csv('stressdata {}_{}.csv'.format(datetime_ext, traffic))
+    #Return: names of the two files written
+    files = {'stressdata': 'stressdata {}_{}.csv'.format(datetime_ext, traffic), 'stress_by_port': 'stress_by_port {}_{}.csv'.format(datetime_ext, traffic)}
+    dfagg.to_csv(files['stressdata'])
     #pdb.set_trace()
     tosave=dataframe.copy()
-    tosave = dataframe.filter(['PORT_NAME_CUR', 'Dep2_YearMonth','country_3_CUR','Economy name_CUR','delayed_capacity','port_delay','Latitude_CUR','Longitude_CUR'])
+    tosave = dataframe.filter(['PORT_ID', 'PORT_NAME_CUR', 'Dep2_YearMonth','country_3_CUR','Economy name_CUR','delayed_capacity','port_delay','Latitude_CUR','Longitude_CUR'])
     tosave.rename(columns = f_reversed,inplace=True)
-    tosave.to_csv('stress_by_port {}_{}.csv'.format(datetime_ext, traffic))
-    return
+    tosave.to_csv(files['stress_by_port'])
+    return files
+
+def save_matrices(matrices, datetime_ext, traffic):
+    #Return: names of the files written, tidy (stress_matrix) and matrix form of delayed capacity (stress_matrix_wide) for every level
+    files = {}
+    for level, matrix in matrices.items():
+        name = level.replace(' ', '_')
+        files['matrix_' + name] = 'stress_matrix_{} {}_{}.csv'.format(name, datetime_ext, traffic)
+        tidy(matrix).to_csv(files['matrix_' + name])
+        files['matrix_wide_' + name] = 'stress_matrix_wide_{} {}_{}.csv'.format(name, datetime_ext, traffic)
+        wide(matrix).to_csv(files['matrix_wide_' + name])
+    return files
+
+def save_rolling(by_port, by_region, datetime_ext, traffic):
+    #Return: names of the rolling stress files, by destination port and by maritime region
+    files = {'rolling_by_port': 'stress_rolling_by_port {}_{}.csv'.format(datetime_ext, traffic),
+             'rolling_by_region': 'stress_rolling_by_region {}_{}.csv'.format(datetime_ext, traffic)}
+    by_port.to_csv(files['rolling_by_port'])
+    by_region.to_csv(files['rolling_by_region'])
+    return files
 
-def plot_trends(df2):
+def plot_trends(df2, datetime_ext, traffic):
+    #Return: name of the file of the monthly totals, one per segment and traffic type (stages of the pipeline must not share outputs)
     dfplot=df2.groupby('Dep2_YearMonth').agg({'delayed_ship':'sum','delayed_capacity':'sum'}).reset_index()
     dfplot.plot.line(x='Dep2_YearMonth',y='delayed_capacity')
     plt.show()
-    dfplot.to_csv("forexport_stress_global.csv")
-    return
+    trends = 'forexport_stress_{}_monthly {}_{}.csv'.format(SEGMENT['name'], datetime_ext, traffic)
+    dfplot.to_csv(trends)
+    return trends
 
 def get_latest_file():
-    """Extract the files with the latest date with the name following the pattern: de2dep_"""
-    list_of_files = glob.glob('Y:\\mt\\Dep2Dep_GLOBAL_ports_monthly_agg_*') # * means all if need specific format then *.csv
+    """Extract the files with the latest date with the name following the pattern: de2dep_ (first traffic type of the segment: GLOBAL, LADEN)"""
+    list_of_files = glob.glob(os.path.join(WORKDIR, 'Dep2Dep_{}_ports_monthly_agg_*'.format(SEGMENT['traffic_types'][0]))) # * means all if need specific format then *.csv
     latest_file = max(list_of_files, key=os.path.getctime)
     return latest_file
+
+def get_legs_file(nameoffile):
+    """Latest legs of stage 2 (Dep2Dep_<traffic type>_legs_*.parquet) next to the monthly aggregates nameoffile, None if there are none"""
+    pattern = re.sub(r'_ports_monthly_agg.*$', '_legs_*.parquet', os.path.basename(nameoffile))
+    list_of_files = glob.glob(os.path.join(os.path.dirname(nameoffile), pattern))
+    return max(list_of_files, key=os.path.getctime) if list_of_files else None
  
 #####################################################################
-def main(): 
-    
-    nameoffile = get_latest_file()
+@traced('total')
+def main(nameoffile=None, legsfile=None): 
+    """Stress indices of the Dep2Dep monthly aggregates nameoffile (default: latest GLOBAL/LADEN file of WORKDIR). Return: files written
+    ROLLING: rolling daily stress from the legs legsfile (default: latest legs file next to nameoffile)"""
+    nameoffile = nameoffile or get_latest_file()
     print("Processing file: {}".format(nameoffile))
     datetime_ext = define_datetime()
     traffic = define_traffic(nameoffile)
     
     print("Processing dats for {} traffic".format(traffic))
+    instrument.note(traffic=traffic)
     print("Saved file extensions: {}".format(datetime_ext))
     
     df = get_inputs(nameoffile)
@@ -204,20 +301,33 @@ def main():
     
     shangai_long_beach_show(df)
     
-    ## 2nd argument (sum or count) - method of aggregating count of ships, teu is medianed, time as well - questionable reasoning... why counts are counted instead of neing summed.
-    adf_lane = activity_by_lane(df,'sum', verbose=True)
-    adf_lane_count = activity_by_lane(df, 'count',verbose=True)
-    adf_lane = pd.merge(adf_lane, adf_lane_count[['SHIP_ID count']], how='inner',left_index=True, right_index=True)
+    ## count of ships: summed (SHIP_ID sum) and counted (SHIP_ID count = periods), teu is medianed, time as well - questionable reasoning...
+    adf_lane = activity_by_lane(df, verbose=True)
     ###############################################
     
-    df1 = reference_lead_time(df, adf_lane) 
+    lanes, code = lane_statistics(df, traffic)
+    df1 = reference_lead_time(lanes) 
     joined = join_ref(df, df1)
     df2 = stalled_capacity_pairs(joined)
     
-    dfagg, dfsave = stalled_capacity(df2)
-    save_files(dfagg, dfsave, datetime_ext, traffic, f_reversed)
+    ports = load_ports(PORTS_FILE, WORKDIR)
+    dfagg, dfsave = stalled_capacity(df2, ports)
+    files = save_files(dfagg, dfsave, datetime_ext, traffic, f_reversed)
     print("saved both output files")
-    plot_trends(dfagg)
+    files.update(save_matrices(stress_matrices(joined, ports), datetime_ext, traffic))
+    if ROLLING:
+        legsfile = legsfile or get_legs_file(nameoffile)
+        if legsfile is None:
+            print("ROLLING: no legs of stage 2 next to {} (ROLLING_LEGS in dep2dep)".format(nameoffile))
+        else:
+            print("Rolling stress from file: {}".format(legsfile))
+            files.update(save_rolling(*rolling_stress_indices(get_legs(legsfile), df1, ports), datetime_ext, traffic))
+    files['trends'] = plot_trends(dfagg, datetime_ext, traffic)
+
+    # Robustness checks: stalled capacity series for every setting of SENSITIVITY_GRID
+    files['sensitivity'] = 'stress_sensitivity {}_{}.csv'.format(datetime_ext, traffic)
+    sensitivity_grid(df, lanes, code, ports).to_csv(files['sensitivity'])
+    return files
 ###############################################################################
 ###############################################################################
 
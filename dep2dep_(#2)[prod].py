@@ -13,13 +13,62 @@ pd.set_option('display.max_columns', 500)
 #pd.set_option('display.width', 1000)
 pd.set_option("display.precision", 3)
 pd.set_option("display.expand_frame_repr", False)
-import glob
 #import pdb
+from gscsi.store import latest_snapshot, read_snapshot, snapshot_delta
+from gscsi.geofence import collapse_runs
+from gscsi.legs import TRAFFIC_CLASSES, map_traffic_type, build_legs
+from gscsi.fleet_registry import load_registry, ship_table as fleet_ship_table
+from gscsi.schema import compact
+from gscsi.aggregates import lane_aggregates, attach_ports, in_traffic_type, AGGREGATES
+from gscsi.incremental import load_state, snapshot_unchanged, rebuild, update, state_legs
+from gscsi.ports import load_ports
+from gscsi.shards import sharded_cells
+from gscsi.port_stays import arrival_runs, pair_arrivals, stay_hours, STAY_AGGREGATES
+from gscsi.rolling_stress import leg_frame
+from gscsi.timecodes import naive_utc, day_codes, week_codes, month_codes, month_labels, week_starts, seconds_between
+from gscsi.config import load_config
+from gscsi.segments import current_segment, weighted, load_status
+from gscsi import instrument
+from gscsi.instrument import traced
+
+# Market segment of the run (GSCSI_SEGMENT: containers or drybulk, see gscsi.segments): working directory and store,
+# capacity weight of the aggregates (TEU, DWT) and traffic types (ship classes, or laden/ballast legs)
+SEGMENT = current_segment()
+# Paths of the site configuration (pipeline.ini, see gscsi.config)
+CONFIG = load_config()['paths']
+WORKDIR = CONFIG[SEGMENT['workdir']]
+PORTS_FILE = CONFIG['ports']
+# Port attributes of the outputs with the corrections applied by stage 3 (gscsi.ports); off: ports.csv as published
+PORT_CORRECTIONS = False
+STORE = os.path.join(WORKDIR, 'portcalls_store')
+# Step timings and row counts (JSON lines, off unless a trace file is configured, see gscsi.instrument)
+instrument.configure('dep2dep')
+# Incremental mode: legs and lane-period aggregates are kept in STATE between runs, a run only processes
+# the departures added to the store since the previous run (same output as a full run).
+# Not available for drybulk: the load status of a leg depends on the deepest draught of the ship over all its legs
+INCREMENTAL = SEGMENT['traffic'] != 'draught'
+STATE = os.path.join(WORKDIR, 'dep2dep_state')
+# Traffic types with aggregates written by one run (ALL = every leg of the segment)
+TRAFFIC_TYPES = SEGMENT['traffic_types']
+# Frequencies of the port level aggregates (computed in one pass, one file each)
+AGG_FREQUENCIES = ['monthly', 'weekly', 'quarterly']
+# Full runs (INCREMENTAL = False) on histories larger than memory: departures are split into SHARDS shards by SHIP_ID
+# in SHARD_DIR and processed by SHARD_WORKERS processes (None = all cores), see gscsi.shards. None = in memory
+SHARDS = None
+SHARD_WORKERS = None
+SHARD_DIR = os.path.join(WORKDIR, 'dep2dep_shards')
+# Full runs: time at the destination port of every leg (arrivals paired with departures, see gscsi.port_stays),
+# medians of wait_turnaround_hrs and voyage_hrs_without_wait written next to diff_hrs
+PORT_STAYS = False
+# Legs of every traffic type written next to the aggregates (Dep2Dep_<traffic type>_legs_<date>.parquet), input of the
+# rolling daily stress of stage 3 (ROLLING there); full runs in memory and incremental runs
+ROLLING_LEGS = False
+# Columns needed by sequential_filter (Datetime: canonical naive UTC time written at ingest, see gscsi.timecodes)
+DEP_COLUMNS = ['SHIP_ID', 'IMO', 'Datetime', 'PORT_ID', 'DRAUGHT_METERSX10', 'MOVE_TYPE', 'SHIP_CLASS_NAME']
 
 def get_latest_file():
-    """Extract the files with the latest date with the name following the pattern: Saved_data_with_missing_"""
-    list_of_files = glob.glob('Y:\\mt\\Saved_data_with_missing_*') # * means all if need specific format then *.csv
-    latest_file = max(list_of_files, key=os.path.getctime)
+    """Extract the snapshot with the latest date with the name following the pattern of the segment: Saved_data_with_missing_ (containers)"""
+    latest_file = latest_snapshot(STORE, SEGMENT['snapshot'])
     return latest_file
         
 def define_datetime():
@@ -53,40 +102,28 @@ def plot_median_mean(nawc, traffic_type,location):
         plt.show()
     return nawc
     
-def get_data(filename):
-    """Load main dataframe from serialized file, 
-    make sure the timestamp column has correct data type 
+@traced('read')
+def get_data(filename, traffic_type, move_type='DEPARTURE'):
+    """Load departures (of the traffic type, if any; move_type: arrivals as well) from the store snapshot, only columns needed downstream,
+    with the time column parsed at ingest (Datetime), compact dtypes (gscsi.schema)
     and create TRAFFIC_TYPE varaibles based on SHIP_CLASS_NAME"""
-    df = pd.read_pickle(filename)
-    df['TRAFFIC_TYPE']=df['SHIP_CLASS_NAME'].apply(lambda x: 'REGIONAL' if x in ['FEEDER', 'FEEDERMAX','HANDYSIZE','SMALL FEEDER'] else ('GLOBAL' if x in ['POST PANAMAX','PANAMAX','NEW PANAMAX','ULCV'] else 'nan'))
-
-    df['Datetime'] = pd.to_datetime(df['TIMESTAMP_UTC']).dt.tz_localize(None)
+    classes = TRAFFIC_CLASSES[traffic_type] if traffic_type else None
+    df = compact(read_snapshot(filename, columns=DEP_COLUMNS, move_type=move_type, ship_class=classes))
+    df['TRAFFIC_TYPE'] = map_traffic_type(df['SHIP_CLASS_NAME'])
     return df
 
-def get_metadata(df):
+def get_metadata(vessels):
     """
-    Load metadata on ports (external file),
-    derive ship-specific information from current working dataframe 
-    and derive two additional port tables with prefilled headers for previous 
-    and current ports. Make sure column types match to facilitate merging of dataframes
+    Load metadata on ports (port registry of ports.csv, with the corrections of stage 3 if PORT_CORRECTIONS, see gscsi.ports)
+    and derive ship-specific information from the vessel registry kept up to date by stage 1
+    (compact schema of gscsi.schema)
     """
-    dfports=pd.read_csv('ports.csv', usecols=['PORT_ID', 'PORT_NAME', 'Latitude','Longitude', 'un_code', 'country_3', 'Economy name','Maritime_Region'])
-    ship_table = df.groupby(by='SHIP_ID').agg({'MMSI': 'first', 'IMO': 'first','SHIPNAME':'first',
-                                              'LENGTH':'max', 'WIDTH':'max', 'DWT':'max', 'GROSS_TONNAGE':'max',
-                                               'TEU':'max','SHIP_CLASS_NAME':'first'}).reset_index()
-    dfports['PORT_ID'] = dfports['PORT_ID'].astype(int)
+    ports = load_ports(PORTS_FILE, WORKDIR, PORT_CORRECTIONS)
+    ship_table = fleet_ship_table(vessels)
     ship_table['SHIP_ID'] = ship_table['SHIP_ID'].astype(int)
-    # Create previous and current  moves table headers (for further merging)
-    prev = dfports.copy()
-    cols = [x+"_PREV" for x in prev.columns]
-    prev.columns = cols
-    cur = dfports.copy()
-    cols = [x+"_CUR" for x in cur.columns]
-    cur.columns = cols
-    prev['PORT_ID_PREV'] =prev['PORT_ID_PREV'].astype(int)
-    cur['PORT_ID_CUR'] = cur['PORT_ID_CUR'].astype(int)
-    return dfports, ship_table, prev, cur
+    return ports, compact(ship_table)
 
+@traced('filter')
 def sequential_filter(df, traffic_type):
     """
     Function to eliminate spans of erroneous consequitive observations due
@@ -98,169 +135,171 @@ def sequential_filter(df, traffic_type):
     else:
          dep = df[(df['MOVE_TYPE']=='DEPARTURE')]
          
-    dep = dep.copy()
-    # sorting before the loop (just in case...)
-    dep.sort_values(by=['SHIP_ID','TIMESTAMP_UTC'],inplace=True)
-    print("Proportion of filtered observations (Traffic type + departures) ",len(dep)/len(df))
-    
-    #forming a group of observations for each ship to iterate over
-    g_dep = dep.groupby(['SHIP_ID','IMO'])
-    
-    new_list = []
-    new_accum = 0
-    
-    for g, v in g_dep:
-        if len(v)>1:
-            v = v.sort_values(by=['TIMESTAMP_UTC'], ascending=True)
-            v['value_grp'] = (v['PORT_ID'] != v['PORT_ID'].shift()).cumsum()
-            new = pd.DataFrame({'FirstDate' : v.groupby('value_grp')['TIMESTAMP_UTC'].first().values, 
-                                'FirstDraft' : v.groupby('value_grp')['DRAUGHT_METERSX10'].first().values,
-                                'LastDraft' : v.groupby('value_grp')['DRAUGHT_METERSX10'].last().values,
-                                'LastDate' : v.groupby('value_grp')['TIMESTAMP_UTC'].last().values,
-                                'Consecutive' : v.groupby('value_grp').size().values, 
-                                'PORT_ID' : v.groupby('value_grp')['PORT_ID'].first().values}).reset_index(drop=True)
-            new['SHIP_ID'] = g[0]
-            new['IMO'] = g[1]
-            new_accum += len(new)
-            new_list.append(new)
-        else:
-            continue
-        
-    print(new_accum)
-    deps = pd.concat(new_list)
-    print("Should be close to 1: ", len(deps)/len(dep))
+    # runs of consecutive departures from the same port, for all ships at once
+    deps = collapse_runs(dep)
+    instrument.note(departure_share=len(dep)/len(df), departures=len(dep), run_share=len(deps)/len(dep))
     return deps
 
-#class Ports():E
-  #"""tbc create a port class that would have a property dupsplit() duplcate split that would be used to create origin ports lookup table and destination ports lookup table
-  #"""
-
-def clean_deps(deps,prev,cur, ship_table):
+@traced('legs')
+def clean_deps(deps, ports, ship_table):
     """
     Function to generate previous port visit values, involves shifting grouped observations backby one. From here on,
     extensions in variables _CUR for Current and _PREV for Previous port vistis
-    It also merges shifted dataframes with the original table so that the the date and location of previous port
+    It also attaches port attributes of both ports and ship attributes (integer lookups, no merges) so that the date and location of previous port
     visit are displayed on one single line. Final step - generate traffic type based on ship classes and drop pairless observations generated
-    as a result of using .shift() method
+    as a result of using .shift() method. With PORT_STAYS the first date of the departure runs is kept (FirstDate).
+    Drybulk: TRAFFIC_TYPE is the load status of the leg (LADEN/BALLAST), from the draught at departure from the origin port
     """
-    deps['date'] = pd.to_datetime(deps['LastDate'])
-    data = deps[['SHIP_ID','PORT_ID','date']].copy()
-    data.rename(columns={'SHIP_ID':'SHIP_ID',
-                         'PORT_ID':'PORT_CUR',
-                         'date':'DATE_CUR'},inplace=True)
-
-    data = data.sort_values(by = ['SHIP_ID', 'DATE_CUR'], ascending=[True,True])
-    data['PORT_PREV'] = data.groupby(['SHIP_ID'])['PORT_CUR'].transform(lambda x:x.shift())
-    data['DATE_PREV'] = data.groupby(['SHIP_ID'])['DATE_CUR'].transform(lambda x:x.shift())
-    #data['TEU_PREV'] = data.groupby(['SHIP_ID'])['TEU'].transform(lambda x:x.shift())
-    p1 = pd.merge(data,prev, how='left', left_on="PORT_PREV", right_on="PORT_ID_PREV")#, suffixes=("","_PREV"))
-    p2 = pd.merge(p1,cur, how='left', left_on="PORT_CUR", right_on="PORT_ID_CUR")
-    out = pd.merge(p2, ship_table, how='left', left_on='SHIP_ID',right_on='SHIP_ID')
-    out['TRAFFIC_TYPE']=out['SHIP_CLASS_NAME'].apply(lambda x: 'REGIONAL' if x in ['FEEDER', 'FEEDERMAX', 'HANDYSIZE','SMALL FEEDER'] else ('GLOBAL' if x in ['POST PANAMAX','PANAMAX','NEW PANAMAX','ULCV'] else 'nan'))
-    #data['TEU_PREV'] = data.groupby(['SHIP_ID'])['TEU'].transform(lambda x:x.shift())
-    new = out.dropna(subset=['PORT_ID_PREV', 'PORT_ID_CUR'])
+    draught = SEGMENT['traffic'] == 'draught'
+    new = build_legs(deps, ports, ship_table, ['FirstDate'] if PORT_STAYS else (), ['LastDraft'] if draught else ())
+    if draught:
+        new['TRAFFIC_TYPE'] = load_status(new['LastDraft_PREV'], new['SHIP_ID']).array
+    instrument.merge_ratio(len(deps), len(new))
     return new
 
+@traced('time_difference')
 def time_difference(dataframe):
-    """Derive time difference (seconds, hours) between two departures from consec. visited ports"""
+    """Derive time difference (seconds, hours) between two departures from consec. visited ports.
+    Dates are the canonical naive UTC times of the legs, calendar columns come from integer period codes (gscsi.timecodes)"""
     df =dataframe.copy()
-    df['DATE_CUR'] = pd.to_datetime(df['DATE_CUR']).dt.tz_localize(None)
-    df['DATE_PREV'] = pd.to_datetime(df['DATE_PREV']).dt.tz_localize(None)
-    df['year'] = df['DATE_CUR'].dt.year
-    df['month'] = df['DATE_CUR'].dt.month
-    df['day'] = df['DATE_CUR'].dt.day
+    df['DATE_CUR'] = naive_utc(df['DATE_CUR'])
+    df['DATE_PREV'] = naive_utc(df['DATE_PREV'])
+    months = month_codes(df['DATE_CUR'])
+    df['year'] = 1970 + months // 12
+    df['month'] = months % 12 + 1
+    df['day'] = day_codes(df['DATE_CUR']) - day_codes(months.astype('datetime64[M]')) + 1
     #df['week_dep']=df['DATE_CUR'].dt.year.astype(str) + "-"+ df['DATE_CUR'].dt.isocalendar().week.astype(str).str.zfill(2)
-    df['Departure_YearMonth'] = df['DATE_CUR'].dt.year.astype(str) + "-"+df['DATE_CUR'].dt.month.astype(str).apply(lambda x: x.zfill(2))
-    df['week'] =df['DATE_CUR'].dt.normalize()-df['DATE_CUR'].dt.weekday.astype('timedelta64[D]')
-    df= df.copy()
-    df['delta_seconds']  = (df['DATE_CUR'] - df['DATE_PREV']).dt.total_seconds()
+    df['Departure_YearMonth'] = month_labels(months)
+    df['week'] = week_starts(week_codes(df['DATE_CUR']))
+    df['delta_seconds'] = seconds_between(df['DATE_CUR'], df['DATE_PREV'])
     df['diff_hrs'] = df['delta_seconds']/3600
     return df
 
+@traced('port_stays')
+def pair_port_stays(legs, df):
+    """Arrival run (FirstDate_ar, LastDate_ar) of the same visit of the destination port of every leg: arrivals of df are collapsed
+    like departures and matched to the departure runs in one sorted merge for all ships (gscsi.port_stays)"""
+    arrivals = arrival_runs(df)
+    paired = pair_arrivals(legs, arrivals)
+    instrument.note(arrival_runs=len(arrivals), paired_share=paired['FirstDate_ar'].notna().mean())
+    return paired
+
 def advanced_tdiff(df):
     """ Generate dates and derive time difference values between two consec. events due to some chances of seeing repeating erronous observations"""
     for c in ['DATE_CUR','DATE_PREV','LastDate_ar','LastDate_dep','FirstDate_ar','FirstDate_dep']:
-        df[c] = pd.to_datetime(df[c]).dt.tz_localize(None)
-    df['voyage_hrs_total']  = ((df['LastDate_dep'] - df['DATE_PREV']).dt.total_seconds())/3600
-    df['voyage_hrs_without_wait']  = ((df['FirstDate_ar'] - df['DATE_PREV']).dt.total_seconds())/3600
-    df['wait_turnaround_hrs']  = ((df['LastDate_dep'] - df['FirstDate_ar']).dt.total_seconds())/3600
-    return df
+        df[c] = naive_utc(df[c])
+    return stay_hours(df)
 
-def ports_dupsplit(dfports):
-    """Generate two adidtional dataframe (for origins and destinations) with port-specific attributes """
-    dfports = dfports[['PORT_ID', 'PORT_NAME',  'Latitude','Longitude', 'un_code', 'country_3','Latitude','Longitude']]
-    dfports_orig = dfports.copy()
-    dfports_dest = dfports.copy()
-    dfports_orig.columns = [x+" Origin" for x in dfports.columns]
-    dfports_dest.columns = [x+" Destination" for x in dfports.columns]
-    return dfports_dest, dfports_orig
+@traced('aggregate')
+def augment_to_ports_aggregates(df, ports, freqs, aggregates=AGGREGATES):
+    """Count, capacity sum (TEU, DWT) and median time by destination port, origin port and period for each frequency of freqs
+    ('weekly', 'monthly', 'quarterly'): legs are sorted once for all frequencies, port attributes attached once per lane.
+    Return: dict {freq: frame}"""
+    return lane_aggregates(df, ports, freqs, aggregates)
 
-def augment_to_ports_aggregates(df, dfports, freq):
-    
-    if freq == "monthly":
-        df['Departure_YearMonth'] = df['DATE_CUR'].dt.year.astype(str) + "-"+df['DATE_CUR'].dt.month.astype(str).apply(lambda x: x.zfill(2))
-        freq_var = 'Departure_YearMonth'
-    else:
-        print(freq)
-        freq_var = 'week'
-    frame = df.groupby(['PORT_CUR','PORT_PREV',freq_var]).agg({'SHIP_ID':['count'],'TEU':['sum'],'diff_hrs':['median']}).reset_index()
-    frame.columns = [' '.join(col).strip() for col in frame.columns.values]
-    frame.rename(columns={"PORT_CUR": "PORT_ID Destination", "PORT_PREV": "PORT_ID Origin"}, inplace=True)
-    print("Size of original dataframe: ",len(frame))
-    dfports_dest, dfports_orig = ports_dupsplit(dfports)
-    
-    m1 = pd.merge(frame,dfports_orig, how='left', left_on="PORT_ID Origin", right_on="PORT_ID Origin")
-    print('Size of dataframe after merging on origin port: ', len(m1))
-    m2 = pd.merge(m1,dfports_dest, how='left', left_on="PORT_ID Destination", right_on="PORT_ID Destination")
-    print('Size of dataframe after merging on destination port: ', len(m2))
-    return m2
+@traced('write')
+def write_aggregates(results):
+    """Save aggregates {traffic_type: {freq: frame}} to Dep2Dep_<traffic type>_ports_<freq>_agg_<date>.csv
+    Return: files written {'<traffic type>_<freq>': path}"""
+    files = {}
+    for traffic_type, by_freq in results.items():
+        for freq, result in by_freq.items():
+            files['{}_{}'.format(traffic_type, freq)] = "Dep2Dep_{}_ports_{}_agg{}.csv".format( traffic_type , freq, define_datetime())
+            result.to_csv(files['{}_{}'.format(traffic_type, freq)])
+    return files
+
+@traced('write_legs')
+def write_legs(data, traffic_types):
+    """Save the legs of every traffic type of traffic_types to Dep2Dep_<traffic type>_legs_<date>.parquet (gscsi.rolling_stress.leg_frame)
+    Return: files written {'<traffic type>_legs': path}"""
+    files = {}
+    for traffic_type in traffic_types:
+        files['{}_legs'.format(traffic_type)] = "Dep2Dep_{}_legs{}.parquet".format(traffic_type, define_datetime())
+        leg_frame(data[in_traffic_type(data, traffic_type)], SEGMENT['weight']).to_parquet(files['{}_legs'.format(traffic_type)], index=False)
+    return files
+
+@traced('incremental')
+def incremental_aggregates(filename, ports, ship_table):
+    """Aggregates of all traffic types and frequencies from the incremental state (see gscsi.incremental),
+    brought up to date with the departures added to the store since the previous run. Return: dict {traffic_type: {freq: frame}}"""
+    state = load_state(STATE)
+    cells = None
+    if state is not None:
+        new = None
+        if snapshot_unchanged(state):
+            new = snapshot_delta(state['snapshot'], filename, columns=DEP_COLUMNS, move_type='DEPARTURE')
+        if new is None:
+            print("Snapshot {} is not an extension of {} as processed by the last run".format(filename, state['snapshot']))
+        else:
+            cells = update(STATE, state, filename, compact(new), ship_table, TRAFFIC_TYPES, AGG_FREQUENCIES)
+    if cells is None:
+        df = get_data(filename, False)
+        cells = rebuild(STATE, filename, df, ship_table, TRAFFIC_TYPES, AGG_FREQUENCIES)
+    return {t: {f: attach_ports(cells[(t, f)], ports, f) for f in AGG_FREQUENCIES} for t in TRAFFIC_TYPES}
 
 ###############################################################################
-def main():
+@traced('total')
+def main(filename=None):
+    """Aggregates of the snapshot filename (default: latest snapshot of STORE). Return: files written (see write_aggregates)"""
+    draught = SEGMENT['traffic'] == 'draught'
+    if INCREMENTAL and draught:
+        raise ValueError("INCREMENTAL is not available for {}: the incremental state does not track the load status of the legs".format(SEGMENT['name']))
 
-    if os.path.exists("Y:\\mt\\"):
+    if os.path.exists(WORKDIR):
         # Change the current working Directory    
-        os.chdir("Y:\\mt\\")
+        os.chdir(WORKDIR)
         
-    ## Declare traffic type level 
-    traffic_type = 'GLOBAL' #other options: "REGIONAL" or False
+    ## Departures of all traffic types are loaded, filtered and turned into legs once,
+    ## legs are split by TRAFFIC_TYPE (see TRAFFIC_TYPES) only for the aggregates
     visual = True
     
-    filename = get_latest_file()
+    filename = filename or get_latest_file()
     print("Processing file: {}".format(filename))
+    ports, ship_table = get_metadata(load_registry(STORE)[1])
+    if INCREMENTAL:
+        if PORT_STAYS:
+            print("PORT_STAYS: time at port is only computed by full runs (INCREMENTAL = False)")
+        files = write_aggregates(incremental_aggregates(filename, ports, ship_table))
+        if ROLLING_LEGS:
+            files.update(write_legs(state_legs(STATE), TRAFFIC_TYPES))
+        return files
+    aggregates = weighted(AGGREGATES + STAY_AGGREGATES if PORT_STAYS else AGGREGATES, SEGMENT['weight'])
+    if SHARDS:
+        if ROLLING_LEGS:
+            print("ROLLING_LEGS: legs are only written by incremental runs and full runs in memory")
+        cells = sharded_cells(filename, SHARD_DIR, ports, ship_table, TRAFFIC_TYPES, AGG_FREQUENCIES, DEP_COLUMNS, SHARDS, workers=SHARD_WORKERS,
+                              stays=PORT_STAYS, weight=SEGMENT['weight'], draught=draught)
+        return write_aggregates({t: {f: attach_ports(cells[(t, f)], ports, f, aggregates) for f in AGG_FREQUENCIES} for t in TRAFFIC_TYPES})
     
-    df = get_data(filename)
+    df = get_data(filename, False, ['DEPARTURE', 'ARRIVAL'] if PORT_STAYS else 'DEPARTURE')
     
-    # Traffic type and TEU-ship dictionaries generation 
-    df_traffic = df[['SHIP_ID','TRAFFIC_TYPE']].drop_duplicates(subset=['SHIP_ID'])
-    df_traffic = df_traffic.groupby("SHIP_ID")['TRAFFIC_TYPE'].first().dropna().reset_index()
-    #df_teu = df.dropna(subset=['SHIP_ID','TEU']).groupby(['SHIP_ID'])['TEU'].first().reset_index()
-    #teudict = dict(zip(df_teu['SHIP_ID'], df_teu['TEU']))
-    #trfdict = dict(zip(df_traffic['SHIP_ID'], df_traffic['TRAFFIC_TYPE']))
-
-    dfports, ship_table, prev, cur = get_metadata(df)
     #df['DRAUGHT2'] = df['DRAUGHT'].fillna(df['DRAUGHT_METERSX10'])
-    deps = sequential_filter(df, traffic_type )
-    data_full = clean_deps(deps,prev,cur, ship_table)
+    deps = sequential_filter(df, False)
+    data_full = clean_deps(deps, ports, ship_table)
+    if PORT_STAYS:
+        data_full = advanced_tdiff(pair_port_stays(data_full, df))
     data = time_difference(data_full)
     
     if visual:
         data['diff_hrs'].hist(range=(0,1000))
         plt.show()
     
-    #df = advanced_tdiff(data_full)
-    
     ### If ship-level granular data is needed, uncomment section below to save intermediate df
     #data.to_pickle(autostamp("Dep2Dep_all_ships_agg{}".format(define_datetime()),".pkl"))
     
-    # Monthly aggregates on port level
-    result = augment_to_ports_aggregates(data, dfports, 'monthly')
-    result.to_csv("Dep2Dep_{}_ports_monthly_agg{}.csv".format( traffic_type , define_datetime()))
-    
-    #Weekly aggregates on port level
-    result = augment_to_ports_aggregates(data, dfports, 'weekly')
-    result.to_csv("Dep2Dep_{}_ports_weekly_agg{}.csv".format( traffic_type , define_datetime()))
-    
+    results = {}
+    for traffic_type in TRAFFIC_TYPES:
+        if traffic_type == 'ALL':
+            legs = data
+        else:
+            legs = data[data['TRAFFIC_TYPE'] == traffic_type]
+
+        # Monthly, weekly and quarterly aggregates on port level
+        results[traffic_type] = augment_to_ports_aggregates(legs, ports, AGG_FREQUENCIES, aggregates)
+    files = write_aggregates(results)
+    if ROLLING_LEGS:
+        files.update(write_legs(data, TRAFFIC_TYPES))
+    return files
 
 
 if __name__ == "__main__":
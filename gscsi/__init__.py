@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+Shared helpers for the GSCSI production scripts (#1 initial processing, #2 dep2dep, #3 stress indices)
+"""
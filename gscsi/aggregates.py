@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Lane-period aggregates of departure-to-departure legs (stage 2 outputs).
+Legs are sorted once by lane (PORT_CUR, PORT_PREV) and departure date, so that every (lane, period) cell
+is a contiguous block for all frequencies at once; periods are integer codes derived from the dates.
+Port attributes are looked up once per lane, not merged row by row.
+"""
+import numpy as np
+import pandas as pd
+from gscsi.timecodes import week_codes, month_codes, quarter_codes, month_labels, week_starts, WEEK_SHIFT
+
+# Period column written for each frequency
+PERIOD_COLUMNS = {'weekly': 'week', 'monthly': 'Departure_YearMonth', 'quarterly': 'Departure_YearQuarter'}
+AGGREGATES = [('SHIP_ID', 'count'), ('TEU', 'sum'), ('diff_hrs', 'median')]
+# Port attributes written for the origin and the destination (Latitude and Longitude twice, as published)
+PORT_ATTRIBUTES = ['PORT_NAME', 'Latitude', 'Longitude', 'un_code', 'country_3', 'Latitude', 'Longitude']
+
+
+def period_codes(dates, freq):
+    """Integer period of datetime64 values (see gscsi.timecodes): weeks starting on Monday, months or quarters since 1970"""
+    if freq == 'weekly':
+        return week_codes(dates)
+    if freq == 'monthly':
+        return month_codes(dates)
+    if freq == 'quarterly':
+        return quarter_codes(dates)
+    raise ValueError("Unknown frequency: {}".format(freq))
+
+
+def period_months(codes, freq):
+    """Months (YYYY-MM) overlapped by the periods of codes (a week can straddle two months, a quarter spans three)"""
+    codes = np.unique(np.asarray(codes, dtype=np.int64))
+    if freq == 'weekly':
+        first = (codes * 7 - WEEK_SHIFT).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        last = (codes * 7 + 6 - WEEK_SHIFT).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    elif freq == 'monthly':
+        first = last = codes
+    else:
+        first, last = codes * 3, codes * 3 + 2
+    months = np.unique(np.concatenate([np.arange(f, l + 1) for f, l in zip(first, last)] or [np.array([], dtype=np.int64)]))
+    return set(months.astype('datetime64[M]').astype(str))
+
+
+def period_labels(codes, freq):
+    """Period codes back to the labels of the output files (Monday of the week, YYYY-MM, YYYYQn)"""
+    codes = np.asarray(codes, dtype=np.int64)
+    if freq == 'weekly':
+        return pd.DatetimeIndex(week_starts(codes))
+    if freq == 'monthly':
+        return month_labels(codes)
+    return pd.Series(1970 + codes // 4).astype(str).to_numpy() + 'Q' + pd.Series(codes % 4 + 1).astype(str).to_numpy()
+
+
+def sort_legs(legs):
+    """Legs sorted by (PORT_CUR, PORT_PREV, DATE_CUR) and the integer lane code of every leg"""
+    legs = legs.sort_values(by=['PORT_CUR', 'PORT_PREV', 'DATE_CUR'], kind='mergesort')
+    cur, prev = legs['PORT_CUR'].to_numpy(), legs['PORT_PREV'].to_numpy()
+    new_lane = np.ones(len(legs), dtype=bool)
+    new_lane[1:] = (cur[1:] != cur[:-1]) | (prev[1:] != prev[:-1])
+    return legs, np.cumsum(new_lane) - 1
+
+
+def cell_aggregates(legs, lane, freq, aggregates=AGGREGATES):
+    """
+    count/sum/median of one frequency over sorted legs (see sort_legs).
+    Return: one row per (lane, period) cell in lane order: PORT_CUR, PORT_PREV, period (integer code) and the aggregates
+    """
+    period = period_codes(legs['DATE_CUR'], freq)
+    new_cell = np.ones(len(legs), dtype=bool)
+    new_cell[1:] = (lane[1:] != lane[:-1]) | (period[1:] != period[:-1])
+    cell = np.cumsum(new_cell) - 1
+    values = legs[[c for c, _ in aggregates]].reset_index(drop=True)
+    out = values.groupby(cell, sort=False).agg(dict(aggregates))
+    out.columns = [' '.join(c) for c in aggregates]
+    keys = pd.DataFrame({'PORT_CUR': legs['PORT_CUR'].to_numpy()[new_cell],
+                         'PORT_PREV': legs['PORT_PREV'].to_numpy()[new_cell],
+                         'period': period[new_cell]})
+    return pd.concat([keys, out.reset_index(drop=True)], axis=1)
+
+
+def attach_ports(cells, ports, freq, aggregates=AGGREGATES):
+    """
+    Output layout of one frequency from cells sorted by lane (see cell_aggregates): lanes with a port missing
+    from the port registry (gscsi.ports.PortRegistry) are left out, port attributes are looked up once per lane
+    """
+    cells = cells[ports.known(cells['PORT_PREV']) & ports.known(cells['PORT_CUR'])].reset_index(drop=True)
+    cur, prev = cells['PORT_CUR'].to_numpy(), cells['PORT_PREV'].to_numpy()
+    new_lane = np.ones(len(cells), dtype=bool)
+    new_lane[1:] = (cur[1:] != cur[:-1]) | (prev[1:] != prev[:-1])
+    lane = np.cumsum(new_lane) - 1
+    orig_attrs = ports.take(prev[new_lane], PORT_ATTRIBUTES, ' Origin')
+    dest_attrs = ports.take(cur[new_lane], PORT_ATTRIBUTES, ' Destination')
+    return pd.concat([pd.DataFrame({'PORT_ID Destination': cur, 'PORT_ID Origin': prev,
+                                    PERIOD_COLUMNS[freq]: period_labels(cells['period'], freq)}),
+                      cells[[' '.join(c) for c in aggregates]],
+                      orig_attrs.iloc[lane].reset_index(drop=True),
+                      dest_attrs.iloc[lane].reset_index(drop=True)], axis=1)
+
+
+def in_traffic_type(legs, traffic_type):
+    """Mask of the legs of a traffic type (ALL: every leg)"""
+    if traffic_type == 'ALL':
+        return np.ones(len(legs), dtype=bool)
+    return (legs['TRAFFIC_TYPE'].astype(object) == traffic_type).to_numpy()
+
+
+def lane_cells(legs, traffic_types, freqs, aggregates=AGGREGATES):
+    """Cells (see cell_aggregates) of every (traffic type, frequency) over legs. Return: dict {(traffic type, freq): cells}"""
+    cells = {}
+    for traffic_type in traffic_types:
+        sub, lane = sort_legs(legs[in_traffic_type(legs, traffic_type)])
+        for freq in freqs:
+            cells[(traffic_type, freq)] = cell_aggregates(sub, lane, freq, aggregates)
+    return cells
+
+
+def lane_aggregates(legs, ports, freqs=('weekly', 'monthly'), aggregates=AGGREGATES):
+    """
+    Aggregates of legs by (destination port, origin port, period) for several frequencies in one pass.
+    ports: port registry (gscsi.ports.PortRegistry), aggregates: (column, function) pairs (default AGGREGATES)
+    Return: dict {freq: frame} with the layout of the former groupby + two merges
+    """
+    legs, lane = sort_legs(legs)
+    return {freq: attach_ports(cell_aggregates(legs, lane, freq, aggregates), ports, freq, aggregates) for freq in freqs}
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Scaling benchmark of the stage 2 and stage 3 steps on synthetic port calls (gscsi.synthetic).
+For every size (rows of port calls), each step is timed (wall clock) and its peak memory recorded (tracemalloc:
+allocations of Python objects and numpy/pandas arrays made during the step). tracemalloc slows pure Python code
+somewhat, but runs are comparable as long as they are made the same way.
+The report is a JSON file with the commit, the versions, the machine, and one record per (size, step), so runs of
+different commits can be compared (--compare).
+
+Usage: python -m gscsi.benchmark [--sizes 1000000 10000000 100000000] [--seed 0] [--output benchmark.json]
+       python -m gscsi.benchmark --compare old.json new.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import contextlib
+import subprocess
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from gscsi.pipeline import ROOT, load_script
+from gscsi.synthetic import port_calls, port_table
+from gscsi.ports import PortRegistry
+from gscsi.schema import compact
+from gscsi.legs import map_traffic_type
+from gscsi.rolling_stress import leg_frame
+from gscsi.fleet_registry import update_registry, ship_table as fleet_ship_table
+
+SIZES = [1000000, 10000000, 100000000]
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def rows_out(result):
+    """Rows of a step result: length of a frame, of the first item of a tuple, sum over the values of a dict (nested)"""
+    if isinstance(result, dict):
+        return sum(rows_out(v) for v in result.values())
+    if isinstance(result, tuple):
+        return rows_out(result[0])
+    return len(result)
+
+
+def timed(records, size, step, func, *args, rows=rows_out, **kwargs):
+    """Run func, add its wall time, peak memory and rows out (rows: count of the rows of its result, default rows_out)
+    to records, return its result (prints of the step are silenced)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rows = rows(result)
+    records.append({'size': size, 'step': step, 'seconds': round(seconds, 4), 'peak_mb': round(peak / 2 ** 20, 1), 'rows_out': rows})
+    print("{:>11} {:<28} {:>9.2f} s {:>9.1f} MB {:>11} rows".format(size, step, seconds, peak / 2 ** 20, rows))
+    return result
+
+
+def run_size(size, stage2, stage3, seed=0, records=None):
+    """Synthetic port calls of size rows through the steps of stages 2 and 3 (as in their main, without file I/O)"""
+    records = [] if records is None else records
+    df = timed(records, size, 'generate', port_calls, size, seed=seed)
+    df['TRAFFIC_TYPE'] = map_traffic_type(df['SHIP_CLASS_NAME'])
+    ports = PortRegistry(compact(port_table(seed=seed)))
+    ship_table = fleet_ship_table(update_registry(None, None, df)[1])
+    ship_table['SHIP_ID'] = ship_table['SHIP_ID'].astype(int)
+    ship_table = compact(ship_table)
+
+    deps = timed(records, size, 'sequential_filter', stage2.sequential_filter, df, False)
+    del df
+    legs = timed(records, size, 'clean_deps', stage2.clean_deps, deps, ports, ship_table)
+    data = timed(records, size, 'time_difference', stage2.time_difference, legs)
+    del legs
+    aggregates = timed(records, size, 'augment_to_ports_aggregates', stage2.augment_to_ports_aggregates, data, ports, stage2.AGG_FREQUENCIES)
+    legs = timed(records, size, 'leg_frame', leg_frame, data, 'TEU')
+    del data
+
+    monthly = aggregates['monthly']
+    # stage 3 reads the csv written by stage 2, where the repeated Latitude/Longitude columns are renamed
+    monthly, _ = stage3.clean_inputs(monthly.loc[:, ~monthly.columns.duplicated()])
+    lanes, _ = timed(records, size, 'lane_statistics', stage3.lane_statistics, monthly, '(global)', True)
+    ref = timed(records, size, 'reference_lead_time', stage3.reference_lead_time, lanes)
+    joined = timed(records, size, 'join_ref', stage3.join_ref, monthly, ref)
+    pairs = timed(records, size, 'stalled_capacity_pairs', stage3.stalled_capacity_pairs, joined)
+    timed(records, size, 'stalled_capacity', stage3.stalled_capacity, pairs, ports)
+    # rows of the tidy files: (month, origin group, destination group) cells with pairs
+    timed(records, size, 'stress_matrices', stage3.stress_matrices, joined, ports,
+          rows=lambda matrices: sum(int(np.count_nonzero(m['pairs'])) for m in matrices.values()))
+    timed(records, size, 'rolling_stress', stage3.rolling_stress_indices, legs, ref, ports, rows=lambda r: len(r[0]) + len(r[1]))
+    return records
+
+
+def run(sizes=SIZES, seed=0, output='benchmark.json'):
+    """Benchmark of every size, written to output. Return: the report"""
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    stage2 = load_script('dep2dep_(#2)[prod].py', 'dep2dep')
+    stage3 = load_script('Stress indices derivation (#3) [prod].py', 'stress')
+    report = {'commit': _commit(), 'date': datetime.now().isoformat(), 'seed': seed,
+              'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+              'machine': platform.platform(), 'cpus': os.cpu_count(), 'results': []}
+    for size in sizes:
+        run_size(size, stage2, stage3, seed, report['results'])
+        # written after every size: a size that runs out of memory leaves the smaller ones in the report
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+def compare(old_file, new_file):
+    """Print the time and peak memory ratios new / old of every (size, step) of two reports"""
+    with open(old_file) as f:
+        old = pd.DataFrame(json.load(f)['results'])
+    with open(new_file) as f:
+        new = pd.DataFrame(json.load(f)['results'])
+    both = old.merge(new, on=['size', 'step'], suffixes=('_old', '_new'))
+    both['time_ratio'] = (both['seconds_new'] / both['seconds_old']).round(3)
+    both['memory_ratio'] = (both['peak_mb_new'] / both['peak_mb_old']).round(3)
+    print(both[['size', 'step', 'seconds_old', 'seconds_new', 'time_ratio', 'peak_mb_old', 'peak_mb_new', 'memory_ratio']].to_string(index=False))
+    return both
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scaling benchmark of the pipeline steps on synthetic port calls")
+    parser.add_argument('--sizes', nargs='*', type=int, default=SIZES, help="rows of port calls")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two reports instead of running")
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+    else:
+        if ROOT not in sys.path:
+            sys.path.insert(0, ROOT)
+        run(args.sizes, args.seed, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Site configuration of the three stages (data paths, segments and traffic types of the stress indices, instrumentation), read from an ini file:
+the file named by the GSCSI_CONFIG environment variable, else pipeline.ini at the root of the repository.
+Keys missing from the file keep the defaults below (the Windows share the scripts were written for).
+"""
+import os
+import configparser
+
+DEFAULT_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pipeline.ini')
+DEFAULTS = {
+    'paths': {
+        'workdir': 'Y:\\mt',
+        'historical': 'Y:\\PortCalls\\WorldBank',
+        'weekly': 'Y:\\Marine Traffic (sFTP weekly)',
+        'drybulk_workdir': 'Y:\\bulkcargo\\work',
+        'drybulk_historical': 'Y:\\bulkcargo\\data\\SAL-5426-out-port-calls.csv',
+        'drybulk_snapshot': 'Y:\\bulkcargo\\weekly\\SAL-5645-worldbank-out-port-calls.csv',
+        'ports': 'Y:\\mt\\ports.csv',
+    },
+    'segments': {
+        'names': 'containers',
+    },
+    'stress': {
+        'traffic_types': 'GLOBAL',
+        'drybulk_traffic_types': 'LADEN',
+    },
+    'instrument': {
+        'trace_file': '',
+    },
+}
+
+
+def load_config(config_file=None):
+    """Configuration of config_file (default: GSCSI_CONFIG, then pipeline.ini) over DEFAULTS"""
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_dict(DEFAULTS)
+    explicit = config_file or os.environ.get('GSCSI_CONFIG')
+    if explicit:
+        if not os.path.exists(explicit):
+            raise FileNotFoundError("Configuration file {} not found".format(explicit))
+        config.read(explicit)
+    elif os.path.exists(DEFAULT_FILE):
+        config.read(DEFAULT_FILE)
+    return config
+
+
+def as_list(value):
+    """Comma separated value of the configuration as a list"""
+    return [v.strip() for v in value.split(',') if v.strip()]
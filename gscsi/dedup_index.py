@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent index of the deduplication keys of the consolidated store:
+64-bit hashes of (SHIP_ID, IMO, TIMESTAMP_UTC, PORT_ID, MOVE_TYPE) kept in a sorted array on disk,
+so that incoming rows can be checked against the whole history without loading it.
+Keys are hashed in canonical dtypes (gscsi.schema.canonical), so the compact in-memory schema does not change them.
+"""
+import os
+import numpy as np
+import pandas as pd
+from gscsi.schema import canonical
+
+
+def key_hashes(df, subset):
+    """64-bit hash of the dedup key of every row"""
+    return pd.util.hash_pandas_object(canonical(df[subset]), index=False).to_numpy()
+
+
+def build_index(hashes):
+    """Sorted array of unique key hashes"""
+    return np.unique(hashes)
+
+
+def load_index(index_file):
+    """Load the index (None if it does not exist yet)"""
+    if not os.path.exists(index_file):
+        return None
+    return np.load(index_file)
+
+
+def save_index(index, index_file):
+    tmp = index_file + ".tmp"
+    with open(tmp, 'wb') as f:
+        np.save(f, index)
+    os.replace(tmp, index_file)
+
+
+def contains(index, hashes):
+    """Boolean mask: which hashes are already in the index (binary search)"""
+    if len(index) == 0:
+        return np.zeros(len(hashes), dtype=bool)
+    pos = np.searchsorted(index, hashes)
+    pos[pos == len(index)] = 0
+    return index[pos] == hashes
+
+
+def insert(index, hashes):
+    """Index with hashes added (stays sorted and unique)"""
+    return np.union1d(index, hashes)
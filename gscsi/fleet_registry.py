@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the ports and vessels seen in the port call feed, kept next to the store and updated
+with the rows added by each run: first/last seen dates, ship attributes (max LENGTH/WIDTH/DWT/GROSS_TONNAGE/TEU).
+New ports and vessels are found by a set difference between the weekly delta and the registry,
+and stage 2 takes its ship table from here instead of a groupby over the whole history.
+"""
+import os
+import numpy as np
+import pandas as pd
+from gscsi.dedup_index import key_hashes
+from gscsi.schema import concat
+
+PORT_KEY = ['PORT_ID', 'PORT_NAME']
+VESSEL_KEY = ['SHIP_ID', 'IMO']
+VESSEL_FIRST = ['MMSI', 'SHIPNAME', 'SHIP_CLASS_NAME']
+VESSEL_MAX = ['LENGTH', 'WIDTH', 'DWT', 'GROSS_TONNAGE', 'TEU']
+
+
+def _files(root):
+    return os.path.join(root, 'registry_ports.parquet'), os.path.join(root, 'registry_vessels.parquet')
+
+
+def load_registry(root):
+    """Ports and vessels registries of the store at root (empty on the first run)"""
+    ports_file, vessels_file = _files(root)
+    ports = pd.read_parquet(ports_file) if os.path.exists(ports_file) else None
+    vessels = pd.read_parquet(vessels_file) if os.path.exists(vessels_file) else None
+    return ports, vessels
+
+
+def save_registry(root, ports, vessels):
+    for df, file in zip((ports, vessels), _files(root)):
+        df.to_parquet(file + ".tmp", index=False)
+        os.replace(file + ".tmp", file)
+
+
+def _summarise(df, key, first=(), maxcols=()):
+    """One row per key: first/last seen, first non-null value of `first` columns (in time order), max of `maxcols`"""
+    agg = {'first_seen': ('Datetime', 'min'), 'last_seen': ('Datetime', 'max')}
+    agg.update({c: (c, 'first') for c in first if c in df.columns})
+    agg.update({c: (c, 'max') for c in maxcols if c in df.columns})
+    df = df.sort_values(by='Datetime', kind='mergesort')
+    return df.groupby(key, dropna=False, sort=False, observed=True).agg(**agg).reset_index()
+
+
+def _merge(registry, summary, key):
+    """Registry updated with a summary of new rows: values already registered win for `first` columns"""
+    if registry is None:
+        return summary
+    both = concat([registry, summary], ignore_index=True)
+    agg = {c: ('min' if c == 'first_seen' else 'max' if c == 'last_seen' or c in VESSEL_MAX else 'first')
+           for c in both.columns if c not in key}
+    return both.groupby(key, dropna=False, sort=False, observed=True).agg(agg).reset_index()
+
+
+def new_entities(registry, df, key):
+    """Distinct keys of df that are not in the registry (set difference on hashed keys)"""
+    keys = df[key].drop_duplicates()
+    if registry is None:
+        return keys
+    return keys[~np.isin(key_hashes(keys, key), key_hashes(registry, key))]
+
+
+def update_registry(ports, vessels, df):
+    """Registries updated with the rows df added to the store"""
+    ports = _merge(ports, _summarise(df, PORT_KEY), PORT_KEY)
+    vessels = _merge(vessels, _summarise(df, VESSEL_KEY, VESSEL_FIRST, VESSEL_MAX), VESSEL_KEY)
+    return ports, vessels
+
+
+def ship_table(vessels):
+    """Ship attributes by SHIP_ID (as in stage 2 get_metadata): first IMO/MMSI/name/class by first seen date, max dimensions"""
+    v = vessels.sort_values(by='first_seen', kind='mergesort')
+    return v.groupby(by='SHIP_ID').agg({'MMSI': 'first', 'IMO': 'first', 'SHIPNAME': 'first',
+                                        'LENGTH': 'max', 'WIDTH': 'max', 'DWT': 'max', 'GROSS_TONNAGE': 'max',
+                                        'TEU': 'max', 'SHIP_CLASS_NAME': 'first'}).reset_index()
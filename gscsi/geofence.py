@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Run-length collapsing of repeated port calls caused by geofencing issues around terrestrial AIS receivers.
+A run is a span of consecutive observations of one ship at the same port; it is reduced to one row with
+the first/last date and draught of the span and the number of observations in it.
+"""
+import numpy as np
+
+RUN_COLUMNS = ['FirstDate', 'FirstDraft', 'LastDraft', 'LastDate', 'Consecutive', 'PORT_ID', 'SHIP_ID', 'IMO']
+
+
+def run_ids(df, keys, port_col='PORT_ID'):
+    """
+    Run number of each row of a frame sorted by keys and time:
+    a new run starts whenever the ship (keys) or the port changes
+    """
+    start = np.zeros(len(df), dtype=bool)
+    if len(df):
+        start[0] = True
+    for col in keys + [port_col]:
+        v = df[col].to_numpy()
+        start[1:] |= v[1:] != v[:-1]
+    return np.cumsum(start) - 1
+
+
+def collapse_runs(df, keys=('SHIP_ID', 'IMO'), date_col='Datetime', min_obs=2):
+    """
+    Collapse runs of consecutive observations at the same port, for all ships at once.
+    Sorts once by ship and time, finds run boundaries over the whole frame and computes
+    FirstDate/LastDate/FirstDraft/LastDraft/Consecutive in a single grouped reduction.
+    As in the per-ship loop it replaces, ships with missing keys or fewer than min_obs observations are left out
+    and the index restarts at 0 for every ship. date_col: the canonical naive UTC time of the store (gscsi.timecodes).
+    """
+    keys = list(keys)
+    df = df.dropna(subset=keys).sort_values(by=keys + [date_col], kind='mergesort')
+    nobs = df.groupby(keys, sort=False)[date_col].transform('size').to_numpy()
+    df = df[nobs >= min_obs]
+
+    runs = df.groupby(run_ids(df, keys), sort=False).agg(
+        FirstDate=(date_col, 'first'), FirstDraft=('DRAUGHT_METERSX10', 'first'),
+        LastDraft=('DRAUGHT_METERSX10', 'last'), LastDate=(date_col, 'last'),
+        Consecutive=(date_col, 'size'), PORT_ID=('PORT_ID', 'first'),
+        SHIP_ID=(keys[0], 'first'), IMO=(keys[1], 'first'))
+    for col in ['FirstDate', 'LastDate']:
+        if getattr(runs[col].dtype, 'tz', None) is not None:
+            runs[col] = runs[col].dt.tz_convert(None)  # naive UTC, as the loop produced
+    runs.index = runs.groupby(keys, sort=False).cumcount().to_numpy()
+    return runs[RUN_COLUMNS]
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental Dep2Dep (stage 2): state kept between weekly runs, so that a run only stitches the departures
+added to the store since the last run onto the ships' last runs and recomputes the (lane, period) cells they touch.
+Medians are exact: a touched cell is recomputed from all its legs, which are kept by month of departure.
+
+State directory:
+    state.json                   snapshot processed by the last run and the digest of its listing, traffic types and
+                                 frequencies of the stored cells
+    groups.parquet               last run and number of departures of every (SHIP_ID, IMO)
+    ships.parquet                last run of every ship in leg order, the run before it, last departure date,
+                                 ship attributes (TEU, TRAFFIC_TYPE) its legs were built with
+    legs/<YYYY-MM>.parquet       legs by month of DATE_CUR (all ports, the port table is applied to the output)
+    cells_<type>_<freq>.parquet  aggregates by (PORT_CUR, PORT_PREV, period)
+
+New departures that cannot be stitched exactly (earlier than the last departure already processed for the ship,
+or extending a run that is not the ship's last), or traffic types and frequencies without stored cells, make the run
+fall back to a full rebuild of the state.
+"""
+import os
+import json
+import shutil
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from gscsi.geofence import collapse_runs
+from gscsi.legs import previous_runs, take_rows, map_traffic_type
+from gscsi.aggregates import sort_legs, cell_aggregates, period_codes, period_months, in_traffic_type, lane_cells
+from gscsi.dedup_index import key_hashes
+from gscsi.store import listing_digest
+from gscsi.schema import concat
+from gscsi.timecodes import month_codes, month_labels, hours_between
+
+KEYS = ['SHIP_ID', 'IMO']
+CELL_KEY = ['PORT_CUR', 'PORT_PREV', 'period']
+SHIP_ATTRS = ['TEU', 'TRAFFIC_TYPE']
+GROUP_COLUMNS = ['SHIP_ID', 'IMO', 'PORT_ID', 'FirstDate', 'FirstDraft', 'LastDraft', 'LastDate', 'Consecutive', 'NOBS']
+SHIP_COLUMNS = ['SHIP_ID', 'LAST_IMO', 'LAST_PORT', 'LAST_DATE', 'PREV_PORT', 'PREV_DATE', 'MAX_DATE'] + SHIP_ATTRS
+
+
+def load_state(state_dir):
+    """Snapshot processed by the last run (None if there is no state yet)"""
+    state_file = os.path.join(state_dir, 'state.json')
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def snapshot_unchanged(state):
+    """Whether the snapshot of the state still lists the partitions it was processed with (the path alone is not enough:
+    stage 1 names snapshots by day and rewrites the listing when it runs twice on the same day)"""
+    return os.path.exists(state['snapshot']) and state.get('digest') == listing_digest(state['snapshot'])
+
+
+def _save_state(state_dir, snapshot, groups, ships, cells):
+    groups[GROUP_COLUMNS].to_parquet(os.path.join(state_dir, 'groups.parquet'), index=False)
+    ships[SHIP_COLUMNS].to_parquet(os.path.join(state_dir, 'ships.parquet'), index=False)
+    for (traffic_type, freq), frame in cells.items():
+        frame.to_parquet(os.path.join(state_dir, 'cells_{}_{}.parquet'.format(traffic_type, freq)), index=False)
+    # written last: a run interrupted before this point is redone from the previous snapshot
+    tmp = os.path.join(state_dir, 'state.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'snapshot': snapshot, 'digest': listing_digest(snapshot),
+                   'traffic_types': list(dict.fromkeys(t for t, _ in cells)), 'freqs': list(dict.fromkeys(f for _, f in cells)),
+                   'updated': datetime.now().isoformat()}, f, indent=1)
+    os.replace(tmp, os.path.join(state_dir, 'state.json'))
+
+
+def ship_attrs(ship_table, ship_ids):
+    """TEU and TRAFFIC_TYPE of ships (as attached to legs by build_legs), aligned to ship_ids"""
+    rows = take_rows(ship_table, 'SHIP_ID', ship_ids)
+    return pd.DataFrame({'TEU': rows['TEU'].to_numpy(),
+                         'TRAFFIC_TYPE': map_traffic_type(rows['SHIP_CLASS_NAME']).astype(object).to_numpy()})
+
+
+def _leg_table(data, ship_table):
+    """Legs (rows of previous_runs with a previous run) with ship attributes and diff_hrs, as in time_difference"""
+    legs = data.dropna(subset=['PORT_PREV']).reset_index(drop=True)
+    # IDs in the compact schema (gscsi.schema), as in the legs of full runs
+    legs = legs[['SHIP_ID', 'PORT_CUR', 'DATE_CUR', 'PORT_PREV', 'DATE_PREV']].astype({'SHIP_ID': np.int32, 'PORT_CUR': np.int32})
+    legs = pd.concat([legs, ship_attrs(ship_table, legs['SHIP_ID'])], axis=1)
+    legs['diff_hrs'] = hours_between(legs['DATE_CUR'], legs['DATE_PREV'])
+    return legs
+
+
+def _month(dates):
+    return month_labels(month_codes(dates))
+
+
+def _legs_file(state_dir, month):
+    return os.path.join(state_dir, 'legs', month + '.parquet')
+
+
+def _read_legs(state_dir, month):
+    f = _legs_file(state_dir, month)
+    return pd.read_parquet(f) if os.path.exists(f) else None
+
+
+def _write_legs(state_dir, month, legs):
+    f = _legs_file(state_dir, month)
+    if len(legs):
+        legs.to_parquet(f + '.tmp', index=False)
+        os.replace(f + '.tmp', f)
+    elif os.path.exists(f):
+        os.remove(f)
+
+
+def state_legs(state_dir):
+    """All legs of the state, by month of DATE_CUR"""
+    months = sorted(f[:-len('.parquet')] for f in os.listdir(os.path.join(state_dir, 'legs')) if f.endswith('.parquet'))
+    return concat([_read_legs(state_dir, m) for m in months], ignore_index=True) if months else None
+
+
+def _cell_hashes(port_cur, port_prev, period):
+    """Hashes of (PORT_CUR, PORT_PREV, period) cell keys, in fixed dtypes"""
+    keys = pd.DataFrame({'PORT_CUR': np.asarray(port_cur, dtype=np.int64), 'PORT_PREV': np.asarray(port_prev, dtype=np.float64),
+                         'period': np.asarray(period, dtype=np.int64)})
+    return key_hashes(keys, CELL_KEY)
+
+
+def _ship_state(data, groups, ship_table):
+    """Ship state from the last row of every ship in previous_runs output (carrying IMO)"""
+    last = data.groupby('SHIP_ID', sort=False).tail(1)
+    ships = pd.DataFrame({'SHIP_ID': last['SHIP_ID'].to_numpy(), 'LAST_IMO': last['IMO'].to_numpy(),
+                          'LAST_PORT': last['PORT_CUR'].to_numpy(), 'LAST_DATE': last['DATE_CUR'].to_numpy(),
+                          'PREV_PORT': last['PORT_PREV'].to_numpy(), 'PREV_DATE': last['DATE_PREV'].to_numpy()})
+    max_date = groups.groupby('SHIP_ID')['LastDate'].max()
+    ships = ships.set_index('SHIP_ID').reindex(max_date.index)
+    ships['MAX_DATE'] = max_date
+    ships = ships.reset_index()
+    return pd.concat([ships, ship_attrs(ship_table, ships['SHIP_ID'])], axis=1)
+
+
+def rebuild(state_dir, snapshot, departures, ship_table, traffic_types, freqs):
+    """
+    Full computation from all departures of the snapshot, saving a fresh state.
+    Return: dict {(traffic type, freq): cells}
+    """
+    print("Rebuilding Dep2Dep state in {}".format(state_dir))
+    shutil.rmtree(state_dir, ignore_errors=True)
+    os.makedirs(os.path.join(state_dir, 'legs'))
+    runs = collapse_runs(departures, min_obs=1).reset_index(drop=True)
+    nobs = runs.groupby(KEYS, sort=False)['Consecutive'].transform('sum').to_numpy()
+    groups = runs.groupby(KEYS, sort=False).tail(1).copy()
+    groups['NOBS'] = nobs[groups.index]
+    data = previous_runs(runs[nobs > 1], carry=['IMO'])
+    legs = _leg_table(data, ship_table)
+    for month, part in legs.groupby(_month(legs['DATE_CUR']), sort=True):
+        _write_legs(state_dir, month, part)
+    cells = lane_cells(legs, traffic_types, freqs)
+    _save_state(state_dir, snapshot, groups, _ship_state(data, groups, ship_table), cells)
+    return cells
+
+
+def _stitch(new, groups, ships):
+    """
+    Runs of the new departures joined to the state.
+    Return: group state rows to replace, candidate runs (with seed rows from the state) for previous_runs,
+    legs (SHIP_ID, DATE_CUR) to remove; None when the new departures cannot be stitched exactly
+    """
+    runs = collapse_runs(new, min_obs=1)
+    runs['first'] = runs.index == 0
+    runs = runs.reset_index(drop=True)
+    new_count = runs.groupby(KEYS, sort=False)['Consecutive'].transform('sum').to_numpy()
+    old = groups.set_index(KEYS)
+    ship = ships.set_index('SHIP_ID')
+
+    # departures dated before the last one processed for the ship
+    first_date = runs.groupby('SHIP_ID')['FirstDate'].min()
+    if (first_date <= ship['MAX_DATE'].reindex(first_date.index)).any():
+        print("Departures older than the last processed ones")
+        return None
+
+    key = pd.MultiIndex.from_frame(runs[KEYS])
+    o = old.reindex(key)
+    extended = (runs['first'] & (runs['PORT_ID'].to_numpy() == o['PORT_ID'].to_numpy())).to_numpy()
+    for c in ['FirstDate', 'FirstDraft']:
+        runs.loc[extended, c] = o[c].to_numpy()[extended]
+    runs.loc[extended, 'Consecutive'] += o['Consecutive'].to_numpy()[extended].astype(runs['Consecutive'].dtype)
+    old_nobs = o['NOBS'].fillna(0).to_numpy()
+    nobs = old_nobs + new_count
+    s = ship.reindex(runs['SHIP_ID'])
+    is_last = ((s['LAST_IMO'].to_numpy() == runs['IMO'].to_numpy()) &
+               (s['LAST_DATE'].to_numpy() == o['LastDate'].to_numpy()))
+    if (extended & (old_nobs > 1) & ~is_last).any():
+        print("New departures extend a run that is not the last one of the ship")
+        return None
+
+    # groups reaching two departures: their single earlier departure joins the legs
+    joining = runs['first'].to_numpy() & (old_nobs == 1) & ~extended & (nobs > 1)
+    single = o[joining].reset_index()
+    single_last = ship['LAST_DATE'].reindex(single['SHIP_ID']).to_numpy()
+    if (single['LastDate'].to_numpy() < single_last).any():
+        print("A ship's earlier single departure falls before its last run")
+        return None
+
+    cand = runs[nobs > 1][['SHIP_ID', 'IMO', 'PORT_ID', 'LastDate']].assign(seed=False)
+    cand = concat([cand, single[['SHIP_ID', 'IMO', 'PORT_ID', 'LastDate']].assign(seed=False)], ignore_index=True)
+    r_extended = set(runs.loc[extended & (old_nobs > 1), 'SHIP_ID'])
+    seeds = ship[ship.index.isin(cand['SHIP_ID']) & ship['LAST_DATE'].notna()].reset_index()
+    ext = seeds['SHIP_ID'].isin(r_extended).to_numpy()
+    prev_seed = seeds[ext & seeds['PREV_DATE'].notna().to_numpy()]
+    cand = concat([cand,
+                   pd.DataFrame({'SHIP_ID': seeds['SHIP_ID'][~ext], 'IMO': seeds['LAST_IMO'][~ext],
+                                 'PORT_ID': seeds['LAST_PORT'][~ext], 'LastDate': seeds['LAST_DATE'][~ext], 'seed': True}),
+                   pd.DataFrame({'SHIP_ID': prev_seed['SHIP_ID'], 'IMO': np.nan,
+                                 'PORT_ID': prev_seed['PREV_PORT'], 'LastDate': prev_seed['PREV_DATE'], 'seed': True})],
+                  ignore_index=True)
+    removed = prev_seed[['SHIP_ID', 'LAST_DATE']].rename(columns={'LAST_DATE': 'DATE_CUR'})
+
+    runs['NOBS'] = nobs
+    new_groups = runs.groupby(KEYS, sort=False).tail(1)
+    return new_groups, cand, removed
+
+
+def update(state_dir, state, snapshot, new, ship_table, traffic_types, freqs):
+    """
+    Bring the state from its snapshot to snapshot, given the departures added in between (store.snapshot_delta).
+    Return: dict {(traffic type, freq): cells}, or None when a full rebuild is needed
+    """
+    missing = [t for t in traffic_types if t not in state.get('traffic_types', [])] + [f for f in freqs if f not in state.get('freqs', [])]
+    if missing:
+        print("No cells in the state for {}".format(', '.join(missing)))
+        return None
+    groups = pd.read_parquet(os.path.join(state_dir, 'groups.parquet'))
+    ships = pd.read_parquet(os.path.join(state_dir, 'ships.parquet'))
+    new = new.dropna(subset=KEYS)
+    print("{} new departures".format(len(new)))
+
+    # ships whose attributes changed since their legs were built (registry revisions)
+    attrs = ship_attrs(ship_table, ships['SHIP_ID'])
+    changed = np.zeros(len(ships), dtype=bool)
+    for c in SHIP_ATTRS:
+        a, b = ships[c].astype(object).to_numpy(), attrs[c].to_numpy()
+        changed |= ~((a == b) | (pd.isna(a) & pd.isna(b)))
+    changed = set(ships.loc[changed, 'SHIP_ID'])
+
+    no_date = np.array([], dtype='datetime64[ns]')
+    added = pd.DataFrame({'SHIP_ID': np.array([], dtype=np.int64), 'PORT_CUR': np.array([], dtype=np.int64),
+                          'DATE_CUR': no_date, 'PORT_PREV': np.array([]), 'DATE_PREV': no_date})
+    removed = pd.DataFrame({'SHIP_ID': np.array([], dtype=np.int64), 'DATE_CUR': no_date})
+    if len(new):
+        stitched = _stitch(new, groups, ships)
+        if stitched is None:
+            return None
+        new_groups, cand, removed = stitched
+        data = previous_runs(cand, carry=['IMO', 'seed'])
+        added = data[~data['seed'].astype(bool)]
+        groups = concat([groups[~pd.MultiIndex.from_frame(groups[KEYS]).isin(pd.MultiIndex.from_frame(new_groups[KEYS]))],
+                         new_groups[GROUP_COLUMNS]], ignore_index=True)
+        last = added.groupby('SHIP_ID', sort=False).tail(1)
+        upd = pd.DataFrame({'SHIP_ID': last['SHIP_ID'].to_numpy(), 'LAST_IMO': last['IMO'].to_numpy(),
+                            'LAST_PORT': last['PORT_CUR'].to_numpy(), 'LAST_DATE': last['DATE_CUR'].to_numpy(),
+                            'PREV_PORT': last['PORT_PREV'].to_numpy(), 'PREV_DATE': last['DATE_PREV'].to_numpy()})
+        ships = ships.set_index('SHIP_ID')
+        ships = ships.reindex(ships.index.union(groups['SHIP_ID'].unique()))
+        for c in upd.columns[1:]:
+            ships.loc[upd['SHIP_ID'].to_numpy(), c] = upd[c].to_numpy()
+        ships['MAX_DATE'] = groups.groupby('SHIP_ID')['LastDate'].max()
+        ships = ships.reset_index()
+    attrs = ship_attrs(ship_table, ships['SHIP_ID'])
+    for c in SHIP_ATTRS:
+        ships[c] = attrs[c].to_numpy()
+
+    added_legs = _leg_table(added, ship_table)
+    touched = _edit_legs(state_dir, added_legs, removed, changed, ship_table)
+    cells = _recompute(state_dir, touched, traffic_types, freqs)
+    _save_state(state_dir, snapshot, groups, ships, cells)
+    print("{} legs added, {} removed, {} ships with new attributes".format(len(added_legs), len(removed), len(changed)))
+    return cells
+
+
+def _edit_legs(state_dir, added, removed, changed, ship_table):
+    """Apply leg changes to the month files. Return: the legs whose cells change (before and after the edit)"""
+    months = set(_month(added['DATE_CUR'])) | set(_month(removed['DATE_CUR']))
+    if changed:
+        months |= {f[:-len('.parquet')] for f in os.listdir(os.path.join(state_dir, 'legs')) if f.endswith('.parquet')}
+    add_month, rm_month = _month(added['DATE_CUR']), _month(removed['DATE_CUR'])
+    touched = [added]
+    for month in sorted(months):
+        legs = _read_legs(state_dir, month)
+        if legs is None:
+            legs = added.iloc[:0]
+        drop = removed[rm_month == month]
+        if len(drop):
+            gone = pd.MultiIndex.from_frame(legs[['SHIP_ID', 'DATE_CUR']]).isin(pd.MultiIndex.from_frame(drop))
+            touched.append(legs[gone])
+            legs = legs[~gone]
+        if changed:
+            rev = legs['SHIP_ID'].isin(changed).to_numpy()
+            if rev.any():
+                touched.append(legs[rev])
+                legs = legs.copy()
+                attrs = ship_attrs(ship_table, legs.loc[rev, 'SHIP_ID'])
+                for c in SHIP_ATTRS:
+                    legs[c] = legs[c].astype(object)
+                    legs.loc[rev, c] = attrs[c].to_numpy()
+                touched.append(legs[rev])
+        legs = concat([legs, added[add_month == month]], ignore_index=True)
+        _write_legs(state_dir, month, legs)
+    return concat(touched, ignore_index=True)
+
+
+def _recompute(state_dir, touched, traffic_types, freqs):
+    """Stored cells with the cells of touched legs recomputed from all their legs"""
+    cells = {}
+    periods = {freq: period_codes(touched['DATE_CUR'], freq) for freq in freqs}
+    months = set()
+    for freq in freqs:
+        months |= period_months(periods[freq], freq)
+    frames = [_read_legs(state_dir, m) for m in sorted(months)]
+    legs = concat([f for f in frames if f is not None], ignore_index=True) if any(f is not None for f in frames) else touched.iloc[:0]
+    for traffic_type in traffic_types:
+        t = touched[in_traffic_type(touched, traffic_type)]
+        sub = legs[in_traffic_type(legs, traffic_type)]
+        for freq in freqs:
+            stored = pd.read_parquet(os.path.join(state_dir, 'cells_{}_{}.parquet'.format(traffic_type, freq)))
+            keys = _cell_hashes(t['PORT_CUR'], t['PORT_PREV'], period_codes(t['DATE_CUR'], freq))
+            leg_keys = _cell_hashes(sub['PORT_CUR'], sub['PORT_PREV'], period_codes(sub['DATE_CUR'], freq))
+            fresh, lane = sort_legs(sub[np.isin(leg_keys, keys)])
+            kept = ~np.isin(_cell_hashes(stored['PORT_CUR'], stored['PORT_PREV'], stored['period']), keys)
+            frame = concat([stored[kept], cell_aggregates(fresh, lane, freq)], ignore_index=True)
+            cells[(traffic_type, freq)] = frame.sort_values(by=CELL_KEY, kind='mergesort').reset_index(drop=True)
+    return cells
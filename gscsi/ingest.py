@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Ingestion of Marine Traffic port call files.
+Source files are parsed concurrently on a process pool against one declared schema
+(explicit dtypes, usecols, one timestamp format) and assembled with a single concatenation.
+A manifest (path, size, mtime, content hash, rows) keeps track of the source files
+already loaded into the consolidated store (the partitioned store of gscsi.store), so that a weekly run
+only parses the delta and appends its new rows, checked against the persisted dedup-key index.
+"""
+import os
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from gscsi.schema import compact, concat
+from gscsi.timecodes import naive_utc
+from gscsi.dedup_index import key_hashes, build_index, load_index, save_index, contains, insert
+from gscsi.store import (write_snapshot, append_snapshot, latest_snapshot, append_parts, write_listing,
+                         snapshot_parts, load_listing, month_key)
+
+MANIFEST_COLUMNS = ['path', 'size', 'mtime_ns', 'sha256', 'rows']
+DEDUP_SUBSET = ['SHIP_ID', 'IMO', 'TIMESTAMP_UTC', 'PORT_ID', 'MOVE_TYPE']
+SORT_BY = ['SHIP_ID', 'Datetime']
+
+# Declared schema of port call files: only these columns are read, with these types
+# (IMO and MMSI can be missing, hence float; blank IDs are read as <NA>, see ID_COLUMNS).
+# Parsed frames are then cast to the compact schema of gscsi.schema
+PORTCALL_DTYPES = {
+    'SHIP_ID': 'Int64', 'PORT_ID': 'Int64', 'IMO': 'float64', 'MMSI': 'float64',
+    'SHIPNAME': str, 'PORT_NAME': str, 'MOVE_TYPE': str, 'SHIP_CLASS_NAME': str, 'COMFLEET_GROUPEDTYPE': str,
+    'DRAUGHT': 'float64', 'DRAUGHT_METERSX10': 'float64', 'LENGTH': 'float64', 'WIDTH': 'float64',
+    'DWT': 'float64', 'GROSS_TONNAGE': 'float64', 'TEU': 'float64',
+    'TIMESTAMP_UTC': str,
+}
+TIMESTAMP_FORMAT = 'ISO8601'
+# Rows without one of these IDs are dropped (and counted) when a file is read: every later stage keys on them
+ID_COLUMNS = ['SHIP_ID', 'PORT_ID']
+# Rough in-memory size of one parsed row, used to turn the streaming memory budget into a chunk size
+BYTES_PER_ROW = 1000
+
+# Layout of each kind of source file
+SOURCE_FORMATS = {
+    'historical': {'sep': ';', 'decimal': ',', 'compression': None, 'rename': {}, 'source_file': True},
+    'weekly_containers': {'sep': ',', 'decimal': '.', 'compression': 'gzip', 'rename': {'DRAUGHT': 'DRAUGHT_METERSX10'}, 'source_file': True},
+    'drybulk_snapshot': {'sep': ';', 'decimal': '.', 'compression': None, 'rename': {}, 'source_file': False},
+    'weekly_drybulk': {'sep': ',', 'decimal': '.', 'compression': 'gzip', 'rename': {'DRAUGHT': 'DRAUGHT_METERSX10'}, 'source_file': False},
+}
+
+
+def _in_schema(column):
+    return column in PORTCALL_DTYPES
+
+
+def _typed(df, file, spec):
+    """Renames, rows without IDs dropped, timestamps, source file and compact dtypes of a freshly read frame"""
+    df.rename(columns=spec['rename'], inplace=True)
+    missing = df[ID_COLUMNS].isna().any(axis=1)
+    if missing.any():
+        print("{}: {} rows without {} dropped".format(file, int(missing.sum()), ' or '.join(ID_COLUMNS)))
+        df = df[~missing].copy()
+    df = df.astype({c: 'int64' for c in ID_COLUMNS})
+    df['TIMESTAMP_UTC'] = pd.to_datetime(df['TIMESTAMP_UTC'], format=TIMESTAMP_FORMAT, utc=True)
+    df['Datetime'] = naive_utc(df['TIMESTAMP_UTC'])  # canonical time of all later stages (gscsi.timecodes)
+    if spec['source_file']:
+        df['source_file'] = file
+    return compact(df)
+
+
+def read_source(file, fmt, chunksize=None):
+    """
+    Parse one source file of format fmt (key of SOURCE_FORMATS) against the declared schema.
+    With chunksize, return an iterator over frames of at most chunksize rows instead
+    """
+    spec = SOURCE_FORMATS[fmt]
+    reader = pd.read_csv(file, sep=spec['sep'], decimal=spec['decimal'], compression=spec['compression'],
+                         usecols=_in_schema, dtype=PORTCALL_DTYPES, chunksize=chunksize)
+    if chunksize is None:
+        return _typed(reader, file, spec)
+    return (_typed(chunk, file, spec) for chunk in reader)
+
+
+def _read_source(job):
+    return read_source(*job)
+
+
+def read_sources(sources, workers=None):
+    """
+    Parse source files concurrently on a process pool.
+    sources: dict {file: format}; workers: pool size (None = number of cores, 1 = serial in this process)
+    Return: list of frames in the order of sources (concatenate once on the caller's side, with gscsi.schema.concat)
+    """
+    jobs = list(sources.items())
+    if workers == 1 or len(jobs) < 2:
+        return [read_source(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_read_source, jobs))
+
+
+def _spill_source(job):
+    """Read one source file chunk by chunk and spill every chunk to parquet pieces by month. Return: rows read"""
+    file, fmt, seq, spill_dir, chunksize = job
+    rows = 0
+    for c, chunk in enumerate(read_source(file, fmt, chunksize)):
+        rows += len(chunk)
+        for month, piece in chunk.groupby(month_key(chunk), sort=False):
+            folder = os.path.join(spill_dir, month)
+            os.makedirs(folder, exist_ok=True)
+            piece.to_parquet(os.path.join(folder, "{:06d}_{:06d}.parquet".format(seq, c)), index=False)
+    return rows
+
+
+def spill_sources(sources, spill_dir, chunksize, workers=None):
+    """
+    Streaming read: parse source files in chunks (concurrently) and spill them to spill_dir/<month>/ pieces,
+    named so that the file order is kept. A duplicate always falls in the same month as the row it duplicates
+    (TIMESTAMP_UTC is part of the dedup key), so months can then be deduplicated one at a time.
+    Return: rows read from each file, in the order of sources
+    """
+    jobs = [(f, fmt, i, spill_dir, chunksize) for i, (f, fmt) in enumerate(sources.items())]
+    if workers == 1 or len(jobs) < 2:
+        return [_spill_source(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_spill_source, jobs))
+
+
+def spilled_months(spill_dir):
+    """Iterate over (month, rows of that month in file order) of a spill directory"""
+    if not os.path.isdir(spill_dir):
+        return
+    for month in sorted(os.listdir(spill_dir)):
+        folder = os.path.join(spill_dir, month)
+        pieces = [pd.read_parquet(os.path.join(folder, f)) for f in sorted(os.listdir(folder))]
+        yield month, concat(pieces)
+
+
+def chunk_rows(memory_budget_mb, workers):
+    """Rows per chunk so that all workers together stay within the memory budget"""
+    workers = workers or os.cpu_count() or 1
+    return max(10000, int(memory_budget_mb * 2 ** 20 / BYTES_PER_ROW / workers))
+
+
+def file_hash(file, blocksize=1 << 20):
+    """Content hash (sha256) of a source file, read block by block"""
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_manifest(manifest_file):
+    """Load the manifest of ingested files (empty manifest on the first run)"""
+    if os.path.exists(manifest_file):
+        return pd.read_csv(manifest_file, dtype={'path': str, 'sha256': str})
+    return pd.DataFrame(columns=MANIFEST_COLUMNS)
+
+
+def save_manifest(manifest, manifest_file):
+    """Write the manifest next to the store (via a temporary file, so a crash never leaves half a manifest)"""
+    tmp = manifest_file + ".tmp"
+    manifest[MANIFEST_COLUMNS].to_csv(tmp, index=False)
+    os.replace(tmp, manifest_file)
+
+
+def scan_files(files, manifest):
+    """
+    Compare source files on disk with the manifest.
+    Size and mtime are checked first, the content hash is only computed for new files
+    and for files whose size/mtime moved (a touched but identical file is not re-read).
+    Return: new files, changed files, removed files and the manifest records of the files on disk
+    (rows of new and changed files are filled in once they are parsed)
+    """
+    known = manifest.set_index('path')
+    new, changed, records = [], [], []
+    for file in files:
+        st = os.stat(file)
+        rec = {'path': file, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': None, 'rows': None}
+        if file in known.index:
+            old = known.loc[file]
+            if old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+                rec['sha256'], rec['rows'] = old['sha256'], old['rows']
+            else:
+                rec['sha256'] = file_hash(file)
+                if rec['sha256'] == old['sha256']:
+                    rec['rows'] = old['rows']
+                else:
+                    changed.append(file)
+        else:
+            rec['sha256'] = file_hash(file)
+            new.append(file)
+        records.append(rec)
+    removed = sorted(set(known.index) - set(files))
+    return new, changed, removed, pd.DataFrame(records, columns=MANIFEST_COLUMNS)
+
+
+def merge_into_store(store, new, subset=DEDUP_SUBSET, sort_by=SORT_BY):
+    """
+    Append freshly parsed rows to the consolidated store and deduplicate.
+    Stable sort, so on equal keys the rows already in the store are kept
+    """
+    frame = concat([store, new]) if store is not None else new
+    frame = frame.sort_values(by=sort_by, kind='mergesort')
+    return frame.drop_duplicates(subset=subset, keep='first')
+
+
+def _stream_into_store(to_read, root, parts, index, memory_budget_mb, workers, on_rows):
+    """
+    Streaming path of update_store: spill the files by month, then deduplicate and append one month at a time
+    (peak memory ~ one chunk per worker while reading, one month of new rows while writing).
+    Return: rows read per file, partitions written, the hashes of the rows added and the columns read
+    """
+    spill_dir = os.path.join(root, '_spill')
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    rows = spill_sources(to_read, spill_dir, chunk_rows(memory_budget_mb, workers), workers)
+    written, added_hashes, columns = 0, [], []
+    for month, batch in spilled_months(spill_dir):
+        columns = list(batch.columns)
+        batch = merge_into_store(None, batch)
+        hashes = key_hashes(batch, DEDUP_SUBSET)
+        if index is not None:
+            seen = contains(index, hashes)
+            batch, hashes = batch[~seen], hashes[~seen]
+        written += append_parts(parts, batch, root)
+        added_hashes.append(hashes)
+        print("Month {}: {} new rows".format(month, len(batch)))
+        if on_rows is not None and len(batch):
+            on_rows(batch)
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    return rows, written, added_hashes, columns
+
+
+def update_store(sources, root, name, manifest_file, index_file, workers=None, memory_budget_mb=None, on_rows=None):
+    """
+    Bring the consolidated store of one segment (containers or drybulk) up to date and save it as snapshot `name`
+    (snapshots are named <prefix>_<date>, the latest snapshot with the same prefix is the base).
+    sources: dict {file: format} (see SOURCE_FORMATS), workers: size of the parsing pool
+    Only new files are parsed. Their rows are deduplicated among themselves, checked against the persisted
+    index of dedup keys and appended to the latest snapshot, without loading the history.
+    If a file already in the manifest changed or disappeared, its old rows cannot be told apart after
+    deduplication, so the store is rebuilt from scratch (same when there is no index or snapshot yet).
+    memory_budget_mb: streaming mode, files are read in chunks and written month by month within the budget
+    on_rows: called with every batch of rows added to the store (all of them at once outside streaming mode)
+    Return: rows added to the store (None in streaming mode), total rows in the store, number of duplicates
+    dropped over the whole history (same figure as a full rebuild would print) and the path of the snapshot
+    """
+    manifest = load_manifest(manifest_file)
+    new, changed, removed, records = scan_files(list(sources), manifest)
+    print("New files: {}, changed: {}, removed: {}".format(len(new), len(changed), len(removed)))
+
+    index = load_index(index_file)
+    base = latest_snapshot(root, name.rsplit("_", 1)[0])
+    rebuild = bool(changed or removed) or index is None or base is None
+    if changed or removed:
+        print("Previously ingested files changed, rebuilding {} from scratch".format(root))
+    to_read = {f: sources[f] for f in (sources if rebuild else new)}
+    records = records.set_index('path')
+
+    if memory_budget_mb:
+        parts = {} if rebuild else snapshot_parts(base)
+        rows, written, hashes, columns = _stream_into_store(to_read, root, parts, None if rebuild else index,
+                                                   memory_budget_mb, workers, on_rows)
+        for file, n in zip(to_read, rows):
+            records.at[file, 'rows'] = n
+        if not rebuild:
+            columns = load_listing(base)['columns']
+        snapshot, total = write_listing(root, name, columns, parts, written)
+        hashes = np.concatenate(hashes) if hashes else np.array([], dtype=np.uint64)
+        index = build_index(hashes) if rebuild else insert(index, hashes)
+        added = None
+    else:
+        frames = read_sources(to_read, workers)
+        for file, df in zip(to_read, frames):
+            records.at[file, 'rows'] = len(df)
+        if rebuild:
+            added = merge_into_store(None, concat(frames))
+            snapshot = write_snapshot(added, root, name)
+            total = len(added)
+            index = build_index(key_hashes(added, DEDUP_SUBSET))
+        else:
+            added = merge_into_store(None, concat(frames)) if frames else pd.DataFrame()
+            if len(added):
+                hashes = key_hashes(added, DEDUP_SUBSET)
+                seen = contains(index, hashes)
+                added, index = added[~seen], insert(index, hashes[~seen])
+            else:
+                print("Nothing new to ingest")
+            snapshot, total = append_snapshot(added, root, name, base)
+        if on_rows is not None and len(added):
+            on_rows(added)
+
+    save_index(index, index_file)
+    save_manifest(records.reset_index(), manifest_file)
+    dropped = int(records['rows'].sum()) - total
+    return added, total, dropped, snapshot
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the stages: wall time, CPU time, memory and row counts of named steps (read, dedup, filter,
+legs, aggregate, stress, ...), written as JSON lines so that weekly runs can be compared and graphed.
+
+Tracing is off unless a trace file is given: GSCSI_TRACE, else trace_file of the [instrument] section of the
+configuration (relative to the working directory). When it is off, traced functions are called directly and
+step/note/record return at once.
+
+One line per step: run (GSCSI_RUN_ID, shared by the stages of a pipeline run), stage, segment (GSCSI_SEGMENT, if set), step, start, wall_s, cpu_s,
+max_rss_mb (high-water mark of the process memory at the end of the step, the step raised it by rss_growth_mb),
+rows_in, rows_out and the fields noted by the step (e.g. blowup = rows_out / rows_in of merges and joins).
+"""
+import os
+import sys
+import json
+import time
+import functools
+from datetime import datetime
+import numpy as np
+from gscsi.config import load_config
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+_trace = None
+_open_steps = []
+
+
+def _max_rss_mb():
+    """High-water mark of the memory of the process (MB), None if it cannot be read"""
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10  # bytes on macOS, KB elsewhere
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 2 ** 20
+    return None
+
+
+def _rows(x):
+    """Row count of a step input or output: frames and arrays, first item of tuples, sum over dicts"""
+    if isinstance(x, tuple):
+        return _rows(x[0]) if x else None
+    if isinstance(x, dict):
+        counts = [_rows(v) for v in x.values()]
+        counts = [c for c in counts if c is not None]
+        return sum(counts) if counts else None
+    if hasattr(x, 'shape') and len(getattr(x, 'shape')):
+        return x.shape[0]
+    return None
+
+
+def _clean(value):
+    if isinstance(value, (np.integer, np.floating, np.bool_)):
+        return value.item()
+    return value
+
+
+def configure(stage, trace_file=None):
+    """Trace the steps of stage to trace_file (default: GSCSI_TRACE, then the configuration). Return: whether tracing is on"""
+    global _trace
+    config = load_config()
+    trace_file = trace_file or os.environ.get('GSCSI_TRACE') or config['instrument']['trace_file']
+    if not trace_file:
+        _trace = None
+        return False
+    run_id = os.environ.setdefault('GSCSI_RUN_ID', '{:%Y%m%dT%H%M%S}-{}'.format(datetime.now(), os.getpid()))
+    _trace = {'file': os.path.join(config['paths']['workdir'], trace_file), 'run': run_id, 'stage': stage,
+              'segment': os.environ.get('GSCSI_SEGMENT')}
+    return True
+
+
+def enabled():
+    return _trace is not None
+
+
+def _head(name):
+    """Fields of every line of the step name: run, stage, segment (if set), step, start"""
+    head = {'run': _trace['run'], 'stage': _trace['stage'], 'step': name, 'start': datetime.now().isoformat()}
+    if _trace['segment']:
+        head['segment'] = _trace['segment']
+    return head
+
+
+def _write(line):
+    with open(_trace['file'], 'a') as f:
+        f.write(json.dumps({k: _clean(v) for k, v in line.items()}) + '\n')
+
+
+class _Step(object):
+    """Open step: its measures are taken on exit, rows_out and other fields can be set while it runs"""
+
+    def __init__(self, name, rows_in=None):
+        self.line = dict(_head(name), rows_in=rows_in, rows_out=None)
+
+    def note(self, **fields):
+        self.line.update(fields)
+
+    def __enter__(self):
+        self._rss = _max_rss_mb()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        _open_steps.append(self)
+        return self
+
+    def __exit__(self, kind, value, tb):
+        _open_steps.remove(self)
+        self.line['wall_s'] = round(time.perf_counter() - self._wall, 4)
+        self.line['cpu_s'] = round(time.process_time() - self._cpu, 4)
+        rss = _max_rss_mb()
+        self.line['max_rss_mb'] = None if rss is None else round(rss, 1)
+        self.line['rss_growth_mb'] = None if rss is None else round(rss - self._rss, 1)
+        if kind is not None:
+            self.line['error'] = kind.__name__
+        if _trace is not None:
+            _write(self.line)
+        return False
+
+
+class _Off(object):
+    """Step of a disabled trace"""
+
+    def note(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, tb):
+        return False
+
+
+_OFF = _Off()
+
+
+def step(name, rows_in=None):
+    """Context manager measuring the step name (a no-op when tracing is off)"""
+    return _OFF if _trace is None else _Step(name, rows_in)
+
+
+def note(**fields):
+    """Add fields (counts, ratios) to the innermost open step"""
+    if _trace is not None and _open_steps:
+        _open_steps[-1].note(**fields)
+
+
+def record(name, **fields):
+    """One line with fields and no measures (events outside of steps)"""
+    if _trace is not None:
+        _write(dict(_head(name), **fields))
+
+
+def merge_ratio(rows_left, rows_out):
+    """Note rows_out / rows_left of a merge or join of the open step (1 for lookups, above 1 for blow-ups)"""
+    if _trace is not None:
+        note(merge_rows_in=rows_left, merge_rows_out=rows_out, blowup=rows_out / rows_left if rows_left else None)
+
+
+def traced(name):
+    """Decorator: the function is a step, rows_in from its first argument, rows_out from its result"""
+    def wrap(func):
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            if _trace is None:
+                return func(*args, **kwargs)
+            with _Step(name, _rows(args[0]) if args else None) as s:
+                result = func(*args, **kwargs)
+                s.line['rows_out'] = _rows(result)
+            return result
+        return run
+    return wrap
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable per-lane quantile sketches of the monthly lane times (stage 3), kept between runs so that lane quantiles
+are updated from the months added since the last run instead of being recomputed from the full lane history.
+All lanes are held in one flat table of centroids (value, weight) sorted by (lane, value). A lane keeps its raw
+values (weight 1: quantiles are exact, same as np.quantile) until it holds more than `capacity` centroids; it is then
+compressed t-digest style, with finer centroids in the tails (rank error of the order of 1/capacity).
+Two sketches merge by concatenating their centroids and compressing.
+
+State file (.npz): lane keys, centroids, capacity and the months folded in so far with their row count and value sum.
+A folded month that differs in a later input makes the run rebuild the sketches from the full input.
+"""
+import os
+import numpy as np
+import pandas as pd
+from gscsi.lane_stats import LANE, lane_index
+
+CAPACITY = 200
+PENDING = 2
+
+
+def _build(cur, prev, mean, weight):
+    """Sketch of centroids given with the lane of each: lanes sorted by (cur, prev), centroids by (lane, value)"""
+    keys = pd.DataFrame({LANE[0]: np.asarray(cur, dtype=np.int64), LANE[1]: np.asarray(prev, dtype=np.int64)})
+    lanes, code = lane_index(keys)
+    mean = np.asarray(mean, dtype=np.float64)
+    weight = np.asarray(weight, dtype=np.float64)
+    order = np.lexsort((mean, code))
+    return {'cur': lanes[LANE[0]].to_numpy(), 'prev': lanes[LANE[1]].to_numpy(),
+            'lane': code[order].astype(np.int32), 'mean': mean[order], 'weight': weight[order]}
+
+
+def from_values(cur, prev, values):
+    """Sketch of raw values, one centroid of weight 1 per value"""
+    return _build(cur, prev, values, np.ones(len(values)))
+
+
+def empty():
+    return from_values([], [], [])
+
+
+def compress(sketch, capacity=CAPACITY):
+    """
+    Merge the centroids of the lanes holding more than capacity of them into at most capacity / 2 + 1 centroids,
+    binned on the arcsine scale of their rank (t-digest k1 scale) so that tail centroids stay small
+    """
+    lane, mean, weight = sketch['lane'], sketch['mean'], sketch['weight']
+    n_lanes = len(sketch['cur'])
+    big = np.bincount(lane, minlength=n_lanes)[lane] > capacity
+    if not big.any():
+        return sketch
+    total = np.bincount(lane, weights=weight, minlength=n_lanes)
+    cum = np.cumsum(weight)
+    lane_before = np.concatenate([[0], np.cumsum(total)[:-1]])
+    q = (cum - weight / 2 - lane_before[lane]) / total[lane]
+    bins = np.floor(capacity / (2 * np.pi) * (np.arcsin(2 * q - 1) + np.pi / 2))
+    new_group = np.ones(len(lane), dtype=bool)
+    new_group[1:] = (lane[1:] != lane[:-1]) | ~big[1:] | (bins[1:] != bins[:-1])
+    group = np.cumsum(new_group) - 1
+    size = np.bincount(group)
+    w = np.bincount(group, weights=weight)
+    m = np.bincount(group, weights=weight * mean) / w
+    single = size == 1
+    m[single] = mean[new_group][single]  # untouched centroids keep their exact value
+    return {'cur': sketch['cur'], 'prev': sketch['prev'], 'lane': lane[new_group], 'mean': m, 'weight': w}
+
+
+def merge(a, b, capacity=CAPACITY):
+    """Sketch of the union of the values of sketches a and b"""
+    s = _build(np.concatenate([a['cur'][a['lane']], b['cur'][b['lane']]]),
+               np.concatenate([a['prev'][a['lane']], b['prev'][b['lane']]]),
+               np.concatenate([a['mean'], b['mean']]), np.concatenate([a['weight'], b['weight']]))
+    return compress(s, capacity)
+
+
+def quantiles(sketch, qs):
+    """
+    Quantiles of every lane of the sketch, interpolated between centroids by rank as np.quantile ('linear') does
+    between values (identical results for lanes that are not compressed).
+    Return: frame like lane_quantiles - one row per lane (sorted), a column per quantile and 'period count'
+    """
+    lane, mean, weight = sketch['lane'], sketch['mean'], sketch['weight']
+    n_lanes = len(sketch['cur'])
+    counts = np.bincount(lane, minlength=n_lanes)
+    total = np.bincount(lane, weights=weight, minlength=n_lanes)
+    first = np.cumsum(counts) - counts
+    last = first + counts - 1
+    before = np.cumsum(weight) - weight
+    # rank of every centroid in its lane: values of weight 1 sit at 0, 1, ..., n-1
+    gpos = before + (weight - 1) / 2
+    pos = gpos - before[first][lane]
+    out = pd.DataFrame({LANE[0]: sketch['cur'], LANE[1]: sketch['prev']})
+    for quantile in qs:
+        t = (total - 1) * quantile
+        idx = np.clip(np.searchsorted(gpos, before[first] + t, side='right') - 1, first, last)
+        # one step of correction for rounding in the global search
+        idx = np.where((pos[idx] > t) & (idx > first), idx - 1, idx)
+        nxt = np.minimum(idx + 1, last)
+        idx = np.where(pos[nxt] <= t, nxt, idx)
+        nxt = np.minimum(idx + 1, last)
+        a, b = mean[idx], mean[nxt]
+        span = pos[nxt] - pos[idx]
+        g = np.clip(np.divide(t - pos[idx], span, out=np.zeros(n_lanes), where=span > 0), 0, 1)
+        diff = b - a
+        out[quantile] = np.where(g >= 0.5, b - diff * (1 - g), a + diff * g)
+    out['period count'] = total.astype(np.int64)
+    return out
+
+
+def save(path, sketch, months, capacity):
+    """Write the sketch and the folded months (frame: month, rows, total) to a binary .npz file"""
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, capacity=capacity, months=months['month'].to_numpy().astype(str),
+             rows=months['rows'].to_numpy(dtype=np.int64), total=months['total'].to_numpy(dtype=np.float64),
+             **{k: v for k, v in sketch.items()})
+    os.replace(tmp, path)
+
+
+def load(path):
+    """Sketch, folded months and capacity of a state file (None if there is none)"""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        sketch = {k: f[k] for k in ['cur', 'prev', 'lane', 'mean', 'weight']}
+        months = pd.DataFrame({'month': f['months'], 'rows': f['rows'], 'total': f['total']})
+        return sketch, months, int(f['capacity'])
+
+
+def lane_sketches(df, path, period_col, column, capacity=CAPACITY, pending=PENDING, keys=LANE):
+    """
+    Sketch of column by lane over all rows of df, updated from the state file at path.
+    Months folded in by earlier runs come from the state; later months are folded in and saved, except the last
+    `pending` months of df (stage 2 may still revise them), which are only added to the returned sketch.
+    """
+    stats = df.groupby(period_col)[column].agg(['size', 'sum']).sort_index()
+    stats = pd.DataFrame({'month': stats.index.astype(str), 'rows': stats['size'].to_numpy(), 'total': stats['sum'].to_numpy()})
+    fold = stats.iloc[:max(len(stats) - pending, 0)]
+
+    state = load(path)
+    if state is not None:
+        sketch, done, saved_capacity = state
+        check = done.merge(fold, on='month', how='left', suffixes=('', '_now'))
+        if (saved_capacity != capacity or check['rows_now'].isna().any() or (check['rows'] != check['rows_now']).any()
+                or not np.allclose(check['total'], check['total_now'], rtol=1e-12, atol=0)):
+            print("Folded months changed in the input (or capacity changed): rebuilding lane sketches")
+            state = None
+    if state is None:
+        sketch, done = empty(), fold.iloc[:0]
+
+    month = df[period_col].astype(str)
+    new = df[month.isin(set(fold['month']) - set(done['month']))]
+    if len(new) or state is None:
+        sketch = merge(sketch, from_values(new[keys[0]], new[keys[1]], new[column]), capacity)
+        save(path, sketch, fold, capacity)
+    print("Lane sketches: {} months from state, {} folded in, {} pending".format(len(done), len(fold) - len(done), len(stats) - len(fold)))
+    rest = df[~month.isin(set(fold['month']))]
+    return merge(sketch, from_values(rest[keys[0]], rest[keys[1]], rest[column]), capacity)
+
+
+def lane_codes(lanes, df, keys=LANE):
+    """Row of lanes (a frame sorted by keys) of every row of df"""
+    return pd.MultiIndex.from_frame(lanes[keys]).get_indexer(pd.MultiIndex.from_frame(df[keys]))
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Per-lane statistics of the monthly lane aggregates (stage 3), computed for all lanes at once:
+rows are coded by lane, sorted once by (lane, value) and every quantile is read off the sorted
+array by position, with the same linear interpolation as np.quantile.
+"""
+import numpy as np
+import pandas as pd
+
+LANE = ['PORT_ID_CUR', 'PORT_ID_PREV']
+
+
+def lane_index(df, keys=LANE):
+    """Distinct lanes of df sorted by keys, and the lane code of every row"""
+    lanes = df[keys].drop_duplicates().sort_values(by=keys).reset_index(drop=True)
+    code = pd.MultiIndex.from_frame(lanes).get_indexer(pd.MultiIndex.from_frame(df[keys]))
+    return lanes, code
+
+
+def group_quantiles(code, values, quantiles, n_groups=None):
+    """
+    Quantiles of values by group code in one sort (np.quantile 'linear' method, per group).
+    Return: array (n_groups, len(quantiles)) and the number of values of every group
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_groups = int(code.max()) + 1 if n_groups is None else n_groups
+    x = values[np.lexsort((values, code))]
+    counts = np.bincount(code, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    last = np.maximum(counts - 1, 0)
+    out = np.full((n_groups, len(quantiles)), np.nan)
+    has = counts > 0
+    for j, q in enumerate(quantiles):
+        virtual = (counts - 1) * q
+        prev = np.floor(virtual)
+        gamma = virtual - prev
+        prev = prev.astype(np.int64)
+        a = x[(starts + prev)[has]]
+        b = x[(starts + np.minimum(prev + 1, last))[has]]
+        g = gamma[has]
+        diff = b - a
+        res = a + diff * g
+        upper = g >= 0.5
+        res[upper] = (b - diff * (1 - g))[upper]
+        out[has, j] = res
+    return out, counts
+
+
+def lane_quantiles(df, column, quantiles, keys=LANE):
+    """
+    Quantiles of column by lane and the number of rows (periods) of every lane.
+    Return: frame with one row per lane (sorted), a column per quantile and 'period count', and the lane code of every row of df
+    """
+    lanes, code = lane_index(df, keys)
+    q, counts = group_quantiles(code, df[column].to_numpy(), quantiles, len(lanes))
+    for j, quantile in enumerate(quantiles):
+        lanes[quantile] = q[:, j]
+    lanes['period count'] = counts
+    return lanes, code
+
+
+def reference_lead_times(lanes, k, low_quantile):
+    """(k+1) * median - k * low quantile of every lane of lane_quantiles output"""
+    return (k + 1) * lanes[.5].to_numpy() - k * lanes[low_quantile].to_numpy()
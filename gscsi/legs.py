@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Construction of departure-to-departure legs: previous port visit of every departure,
+with port and ship attributes attached by integer lookups (no merges).
+"""
+import numpy as np
+import pandas as pd
+from gscsi.timecodes import naive_utc
+
+# Ship classes by traffic type
+TRAFFIC_CLASSES = {'REGIONAL': ['FEEDER', 'FEEDERMAX', 'HANDYSIZE', 'SMALL FEEDER'],
+                   'GLOBAL': ['POST PANAMAX', 'PANAMAX', 'NEW PANAMAX', 'ULCV']}
+CLASS_TRAFFIC = {c: t for t, classes in TRAFFIC_CLASSES.items() for c in classes}
+
+
+def map_traffic_type(ship_class):
+    """TRAFFIC_TYPE (categorical) of a SHIP_CLASS_NAME column ('nan' for classes outside both traffic types)"""
+    return ship_class.astype(object).map(CLASS_TRAFFIC).fillna('nan').astype('category')
+
+
+def take_rows(table, key, codes):
+    """
+    Rows of table aligned to codes, found by integer position lookup on the (unique) key column.
+    Codes missing from the table give NaN rows, like a left merge would
+    """
+    table = table.drop_duplicates(subset=[key])
+    rows = table.set_axis(table[key].to_numpy()).reindex(np.asarray(codes))
+    return rows.reset_index(drop=True)
+
+
+def previous_runs(deps, carry=(), carry_prev=()):
+    """
+    Departure runs (collapse_runs) sorted by ship and LastDate: SHIP_ID, PORT_CUR, DATE_CUR, the carry columns of deps,
+    and the port and date of the ship's previous run (PORT_PREV, DATE_PREV; NaN for its first run) with the carry_prev
+    columns of that run (<column>_PREV)
+    """
+    data = pd.DataFrame({'SHIP_ID': deps['SHIP_ID'].to_numpy(),
+                         'PORT_CUR': deps['PORT_ID'].to_numpy(),
+                         'DATE_CUR': naive_utc(deps['LastDate'])})
+    for c in list(carry) + [c for c in carry_prev if c not in carry]:
+        data[c] = deps[c].to_numpy()
+    data = data.sort_values(by=['SHIP_ID', 'DATE_CUR'], ascending=[True, True]).reset_index(drop=True)
+    shifted = data.groupby('SHIP_ID')[['PORT_CUR', 'DATE_CUR'] + list(carry_prev)].shift()
+    data['PORT_PREV'] = shifted['PORT_CUR'].astype(float)
+    data['DATE_PREV'] = shifted['DATE_CUR']
+    for c in carry_prev:
+        data[c + '_PREV'] = shifted[c]
+    return data.drop(columns=[c for c in carry_prev if c not in carry])
+
+
+def build_legs(deps, ports, ship_table, carry=(), carry_prev=()):
+    """
+    One row per departure with the port and date of the ship's previous departure (_PREV) next to
+    the current one (_CUR), port attributes of both ends (ports: gscsi.ports.PortRegistry), ship attributes and TRAFFIC_TYPE.
+    Departures without a previous one, or with a port missing from the port table, are dropped.
+    carry, carry_prev: columns of deps kept on the legs for the current and the previous departure (see previous_runs)
+    """
+    data = previous_runs(deps, carry, carry_prev)
+
+    ships = ship_table.drop(columns=['SHIP_ID'])
+    out = pd.concat([data,
+                     ports.take(data['PORT_PREV'], suffix='_PREV'),
+                     ports.take(data['PORT_CUR'], suffix='_CUR'),
+                     take_rows(ship_table, 'SHIP_ID', data['SHIP_ID'])[ships.columns]], axis=1)
+    out['TRAFFIC_TYPE'] = map_traffic_type(out['SHIP_CLASS_NAME'])
+    return out.dropna(subset=['PORT_ID_PREV', 'PORT_ID_CUR'])
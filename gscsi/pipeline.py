@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline runner: runs the three stages as a DAG (initial processing -> dep2dep -> one stress index stage per
+traffic type of the configuration) and passes the files written by a stage to the next ones explicitly,
+instead of every stage looking for the newest file of the working directory.
+Stages 2 and 3 run for every segment of the configuration (containers, drybulk, see gscsi.segments) over the stores
+written by stage 1; with several segments, the stages of every segment run in a worker process of their own,
+concurrently (stage names of segments other than containers end with the segment: dep2dep_drybulk, stress_drybulk_LADEN).
+
+Every stage is fingerprinted: code of the script and of gscsi, content hash of its input files (outputs of the
+upstream stages, ports.csv, registries), its parameters (module constants: traffic types, frequencies, k, ...).
+A stage whose fingerprint and output files are unchanged since its last run is skipped and its cached outputs are
+handed downstream. Fingerprints, outputs and their hashes are kept in pipeline_cache.json in the working directory.
+The source files of stage 1 are fingerprinted by name, size and modification time (they are not read to be hashed).
+
+Usage: python -m gscsi.pipeline [--config FILE] [--force STAGE ...] [--dry-run]
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from gscsi.config import load_config, as_list
+from gscsi.segments import SEGMENTS, DEFAULT_SEGMENT
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_FILE = 'pipeline_cache.json'
+CHUNK = 1 << 20
+
+
+def file_hash(path):
+    """sha1 of the content of a file (None if it does not exist)"""
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def listing_hash(paths):
+    """sha1 of the names, sizes and modification times of the files under paths (files or folders)"""
+    h = hashlib.sha1()
+    for p in paths:
+        files = [p] if os.path.isfile(p) else sorted(os.path.join(r, f) for r, _, fs in os.walk(p) for f in fs)
+        for f in files:
+            st = os.stat(f)
+            h.update('{}|{}|{}\n'.format(f, st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def code_hash(script):
+    """sha1 of the script and of the gscsi package sources"""
+    package = os.path.join(ROOT, 'gscsi')
+    return hashlib.sha1(''.join(file_hash(f) for f in [os.path.join(ROOT, script)] +
+                                sorted(os.path.join(package, f) for f in os.listdir(package) if f.endswith('.py'))).encode()).hexdigest()
+
+
+def load_script(script, name):
+    """Import a stage script (file names of the stages are not valid module names)"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, script))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _ports(module):
+    return [module.PORTS_FILE, os.path.join(os.path.dirname(module.PORTS_FILE), 'port_corrections.csv')]
+
+
+def segment_stages(config, segment):
+    """dep2dep and stress stages of a segment (traffic types of the stress stages: traffic_types of the [stress] section
+    for containers, <segment>_traffic_types for the others)"""
+    suffix = '' if segment == DEFAULT_SEGMENT else '_' + segment
+    dep2dep = 'dep2dep' + suffix
+    out = [{'name': dep2dep, 'segment': segment, 'script': 'dep2dep_(#2)[prod].py', 'after': ['initial_processing'],
+            'params': ['INCREMENTAL', 'TRAFFIC_TYPES', 'AGG_FREQUENCIES', 'ROLLING_LEGS', 'PORT_CORRECTIONS'],
+            'inputs': lambda m, up: [up['initial_processing'][segment], os.path.join(m.STORE, 'registry_vessels.parquet')] + _ports(m),
+            'run': lambda m, up: m.main(up['initial_processing'][segment])}]
+    for traffic_type in as_list(config['stress']['traffic_types' if not suffix else segment + '_traffic_types']):
+        key, legs = '{}_monthly'.format(traffic_type), '{}_legs'.format(traffic_type)
+        out.append({'name': 'stress{}_{}'.format(suffix, traffic_type), 'segment': segment,
+                    'script': 'Stress indices derivation (#3) [prod].py',
+                    'after': [dep2dep], 'traffic_type': traffic_type, 'frequency': 'monthly',
+                    'params': ['K', 'LOW_QUANTILE', 'MIN_PERIOD_COUNT', 'SENSITIVITY_GRID', 'EXACT', 'SKETCH_CAPACITY',
+                               'ROLLING', 'ROLLING_WINDOWS', 'ROLLING_START'],
+                    'inputs': lambda m, up, key=key, legs=legs: [up[dep2dep][key]] + ([up[dep2dep][legs]] if legs in up[dep2dep] else []) + _ports(m),
+                    'run': lambda m, up, key=key, legs=legs: m.main(up[dep2dep][key], up[dep2dep].get(legs))})
+    return out
+
+
+def stages(config):
+    """
+    Stages of the pipeline: name, script, upstream stages, parameters (module constants),
+    input files (function of the module and the upstream outputs) and run (same arguments, returns {output: path}).
+    Stages of a segment have its name (segment), the scripts are imported with GSCSI_SEGMENT set to it
+    """
+    out = [
+        {'name': 'initial_processing', 'script': 'initial_processing (#1)[prod].py', 'after': [],
+         'params': ['INCREMENTAL'],
+         'sources': lambda m, up: [m.path, m.new_path, m.HIST_DRYBULK, m.JUNE_DRYBULK],
+         'inputs': lambda m, up: [],
+         'run': lambda m, up: m.main()},
+    ]
+    for segment in as_list(config['segments']['names']):
+        if segment not in SEGMENTS:
+            raise ValueError("Unknown segment in the configuration: {}".format(segment))
+        out += segment_stages(config, segment)
+    return out
+
+
+def order(graph):
+    """Stages sorted so that every stage comes after its upstream stages"""
+    done, out = set(), []
+    pending = list(graph)
+    while pending:
+        ready = [s for s in pending if all(a in done for a in s['after'])]
+        if not ready:
+            raise ValueError("Cycle or unknown stage in {}".format([s['name'] for s in pending]))
+        for s in ready:
+            out.append(s)
+            done.add(s['name'])
+            pending.remove(s)
+    return out
+
+
+def fingerprint(stage, module, upstream):
+    """Fingerprint of a stage: code, parameters, traffic type/frequency, content of inputs, listing of sources"""
+    parts = {'code': code_hash(stage['script']),
+             'params': {p: repr(getattr(module, p)) for p in stage['params']},
+             'traffic_type': stage.get('traffic_type'), 'frequency': stage.get('frequency'),
+             'inputs': {f: file_hash(f) for f in stage['inputs'](module, upstream)}}
+    if 'sources' in stage:
+        parts['sources'] = listing_hash([p for p in stage['sources'](module, upstream) if os.path.exists(p)])
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def up_to_date(entry, print_id):
+    """Whether the cached outputs of a stage still exist with the content they were written with"""
+    if entry is None or entry.get('fingerprint') != print_id:
+        return False
+    return all(file_hash(f) == h for f, h in entry['hashes'].items())
+
+
+def _load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_cache(path, cache):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _run_stages(graph, outputs, stale, cache, force, dry_run, workdir, cache_file=None):
+    """Run the stages of graph (in order) that are not up to date: outputs, stale (stages not run by a dry run) and cache
+    are updated, the cache is saved to cache_file after every stage (if given)"""
+    for stage in graph:
+        name = stage['name']
+        if 'segment' in stage:
+            os.environ['GSCSI_SEGMENT'] = stage['segment']  # read by the scripts when they are imported (gscsi.segments)
+        module = load_script(stage['script'], name)
+        upstream = {a: outputs.get(a, {}) for a in stage['after']}
+        if any(a in stale for a in stage['after']):
+            print_id = None  # inputs not known before the upstream stage has run (dry run)
+        else:
+            print_id = fingerprint(stage, module, upstream)
+        entry = cache.get(name)
+        if name not in force and 'all' not in force and up_to_date(entry, print_id):
+            print("{}: up to date, skipped".format(name))
+            outputs[name] = entry['outputs']
+            continue
+        if dry_run:
+            print("{}: would run".format(name))
+            stale.add(name)
+            continue
+        print("{}: running".format(name))
+        start = datetime.now()
+        if 'segment' in stage and os.path.isdir(module.WORKDIR):
+            os.chdir(module.WORKDIR)  # outputs of a segment next to its Dep2Dep files
+        result = stage['run'](module, upstream)
+        # relative to the folder the stage wrote them in (working directory of its segment)
+        outputs[name] = {k: os.path.abspath(v) for k, v in result.items() if v is not None}
+        os.chdir(workdir)
+        # taken again after the run: a stage can create some of its inputs
+        cache[name] = {'fingerprint': fingerprint(stage, module, upstream), 'outputs': outputs[name],
+                       'hashes': {f: file_hash(f) for f in outputs[name].values()},
+                       'started': start.isoformat(), 'finished': datetime.now().isoformat()}
+        if cache_file:
+            _save_cache(cache_file, cache)
+
+
+def _run_segment(segment, outputs, stale, force, dry_run):
+    """Stages of one segment, in a worker process of run. Return: outputs, stale stages and cache entries of its stages"""
+    config = load_config()
+    workdir = config['paths']['workdir']
+    os.chdir(workdir)
+    cache = _load_cache(os.path.join(workdir, CACHE_FILE))
+    graph = [s for s in order(stages(config)) if s.get('segment') == segment]
+    outputs, stale = dict(outputs), set(stale)
+    _run_stages(graph, outputs, stale, cache, force, dry_run, workdir)
+    names = [s['name'] for s in graph]
+    return ({n: outputs[n] for n in names if n in outputs}, [n for n in names if n in stale],
+            {n: cache[n] for n in names if n in cache})
+
+
+def run(config_file=None, force=(), dry_run=False):
+    """Run the stages that are not up to date, in order (segments concurrently). Return: outputs of every stage {stage: {output: path}}"""
+    if config_file:
+        os.environ['GSCSI_CONFIG'] = os.path.abspath(config_file)
+    os.environ.setdefault('MPLBACKEND', 'Agg')  # batch runs: plots are not shown
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    config = load_config()
+    workdir = config['paths']['workdir']
+    os.chdir(workdir)
+    cache_file = os.path.join(workdir, CACHE_FILE)
+    cache = _load_cache(cache_file)
+    # one run ID for the step traces of all stages (gscsi.instrument)
+    os.environ['GSCSI_RUN_ID'] = '{:%Y%m%dT%H%M%S}-{}'.format(datetime.now(), os.getpid())
+
+    graph = order(stages(config))
+    outputs, stale = {}, set()
+    _run_stages([s for s in graph if 'segment' not in s], outputs, stale, cache, force, dry_run, workdir, cache_file)
+    segments = list(dict.fromkeys(s['segment'] for s in graph if 'segment' in s))
+    if len(segments) < 2:
+        _run_stages([s for s in graph if 'segment' in s], outputs, stale, cache, force, dry_run, workdir, cache_file)
+        return outputs
+    with ProcessPoolExecutor(max_workers=len(segments)) as pool:
+        jobs = [pool.submit(_run_segment, segment, outputs, stale, force, dry_run) for segment in segments]
+        for job in jobs:
+            done, not_run, entries = job.result()
+            outputs.update(done)
+            stale.update(not_run)
+            cache.update(entries)
+            _save_cache(cache_file, cache)
+    return outputs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the GSCSI pipeline, skipping stages whose outputs are up to date")
+    parser.add_argument('--config', help="configuration file (default: GSCSI_CONFIG or pipeline.ini)")
+    parser.add_argument('--force', nargs='*', default=[], help="stages to rerun even if up to date ('all' for every stage)")
+    parser.add_argument('--dry-run', action='store_true', help="only print the stages that would run")
+    args = parser.parse_args(argv)
+    for name, files in run(args.config, args.force, args.dry_run).items():
+        print(name, json.dumps(files, indent=1))
+
+
+if __name__ == "__main__":
+    main()
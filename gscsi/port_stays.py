@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Arrival/departure pairing: time spent at the destination port of every leg, next to the Dep2Dep transit time.
+Arrivals are collapsed into runs like departures (gscsi.geofence). Every departure run is matched to the last arrival
+run of the same ship at the same port that starts before it, in one sorted merge for all ships (merge_asof by ship
+and port). A match dated before the ship's previous departure belongs to an earlier visit (the arrival of this visit
+is missing) and is left out.
+
+Columns of a paired leg (as used by advanced_tdiff in stage 2): FirstDate_ar, LastDate_ar (arrival run),
+FirstDate_dep, LastDate_dep (departure run, LastDate_dep = DATE_CUR).
+"""
+import numpy as np
+import pandas as pd
+from gscsi.geofence import collapse_runs
+from gscsi.timecodes import naive_utc, hours_between
+
+# Aggregates of paired legs written next to AGGREGATES (gscsi.aggregates)
+STAY_AGGREGATES = [('wait_turnaround_hrs', 'median'), ('voyage_hrs_without_wait', 'median')]
+STAY_COLUMNS = ['FirstDate_ar', 'LastDate_ar', 'FirstDate_dep', 'LastDate_dep']
+
+
+def arrival_runs(calls, date_col='Datetime'):
+    """Runs of the arrivals of calls (all ships at once): SHIP_ID, PORT_ID, FirstDate_ar, LastDate_ar"""
+    runs = collapse_runs(calls[calls['MOVE_TYPE'] == 'ARRIVAL'], date_col=date_col, min_obs=1)
+    return pd.DataFrame({'SHIP_ID': runs['SHIP_ID'].to_numpy(dtype=np.int64), 'PORT_ID': runs['PORT_ID'].to_numpy(dtype=np.int64),
+                         'FirstDate_ar': naive_utc(runs['FirstDate']), 'LastDate_ar': naive_utc(runs['LastDate'])})
+
+
+def pair_arrivals(legs, arrivals):
+    """
+    legs (build_legs with the FirstDate of the departure runs carried) with the arrival run of the same visit of their
+    destination port (NaT when there is none): adds STAY_COLUMNS
+    """
+    left = pd.DataFrame({'row': np.arange(len(legs)), 'SHIP_ID': legs['SHIP_ID'].to_numpy(dtype=np.int64),
+                         'PORT_ID': legs['PORT_CUR'].to_numpy(dtype=np.int64), 'FirstDate_dep': naive_utc(legs['FirstDate'])})
+    left = left.sort_values('FirstDate_dep', kind='mergesort')
+    right = arrivals.dropna(subset=['FirstDate_ar']).sort_values('FirstDate_ar', kind='mergesort')
+    pairs = pd.merge_asof(left, right, left_on='FirstDate_dep', right_on='FirstDate_ar', by=['SHIP_ID', 'PORT_ID'],
+                          direction='backward').sort_values('row')
+    out = legs.drop(columns=['FirstDate']).reset_index(drop=True)
+    first_ar, last_ar = pairs['FirstDate_ar'].to_numpy(), pairs['LastDate_ar'].to_numpy()
+    same_visit = first_ar > naive_utc(out['DATE_PREV'])
+    out['FirstDate_ar'] = np.where(same_visit, first_ar, np.datetime64('NaT'))
+    out['LastDate_ar'] = np.where(same_visit, last_ar, np.datetime64('NaT'))
+    out['FirstDate_dep'] = pairs['FirstDate_dep'].to_numpy()
+    out['LastDate_dep'] = naive_utc(out['DATE_CUR'])
+    return out
+
+
+def stay_hours(legs):
+    """Hours of a paired leg: voyage_hrs_total (departure to departure), voyage_hrs_without_wait (departure to arrival)
+    and wait_turnaround_hrs (arrival to last departure)"""
+    legs['voyage_hrs_total'] = hours_between(legs['LastDate_dep'], legs['DATE_PREV'])
+    legs['voyage_hrs_without_wait'] = hours_between(legs['FirstDate_ar'], legs['DATE_PREV'])
+    legs['wait_turnaround_hrs'] = hours_between(legs['LastDate_dep'], legs['FirstDate_ar'])
+    return legs
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Port registry shared by stage 2 (dep2dep) and stage 3 (stress indices): attributes of ports.csv loaded once,
+with corrections keyed by PORT_ID and a binary cache (parquet in the working directory of the caller, rebuilt when
+ports.csv or the corrections change; nothing is written next to ports.csv).
+A dense array maps PORT_ID to its row, so attributes are attached to port IDs by integer take instead of merges
+with suffixed copies of the table (_PREV/_CUR, Origin/Destination).
+
+Corrections file (csv): PORT_ID, column, value - default port_corrections.csv next to ports.csv. If it does not exist,
+the fixes formerly applied by row position in stage 3 (LEGACY_ROW_FIXES) are applied.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from gscsi.schema import compact
+
+PORT_COLUMNS = ['PORT_ID', 'PORT_NAME', 'Latitude', 'Longitude', 'un_code', 'country_3', 'Economy name', 'Maritime_Region']
+# (row of ports.csv, column, value) - former df.at[row, column] = value fixes of stage 3
+LEGACY_ROW_FIXES = [(52, 'country_3', 'IDN'), (249, 'country_3', 'JPN'), (321, 'country_3', 'BRA'),
+                    (1756, 'country_3', 'GLP'), (1757, 'country_3', 'AIA'),
+                    (52, 'Maritime_Region', 'South East Asia'), (249, 'Maritime_Region', 'North Asia'),
+                    (321, 'Maritime_Region', 'South America East Coast'),
+                    (1756, 'Maritime_Region', 'Carribean Sea & Central America'),
+                    (1757, 'Maritime_Region', 'Carribean Sea & Central America')]
+
+
+class PortRegistry(object):
+    """Port table (one row per PORT_ID, first one kept) and the dense PORT_ID -> row array"""
+
+    def __init__(self, table):
+        dup = table['PORT_ID'].duplicated()
+        if dup.any():
+            print("Duplicated PORT_ID in the port table (first kept): ", sorted(table.loc[dup, 'PORT_ID'].unique()))
+        self.table = table[~dup].reset_index(drop=True)
+        ids = self.table['PORT_ID'].to_numpy(dtype=np.int64)
+        self.row = np.full(ids.max() + 1 if len(ids) else 0, -1, dtype=np.int64)
+        self.row[ids] = np.arange(len(ids))
+
+    def rows(self, port_ids):
+        """Row of the table of every port ID (-1 for IDs missing from the table or NaN)"""
+        ids = np.asarray(port_ids, dtype=np.float64)
+        ok = np.isfinite(ids) & (ids >= 0) & (ids < len(self.row))
+        out = np.full(len(ids), -1, dtype=np.int64)
+        out[ok] = self.row[ids[ok].astype(np.int64)]
+        return out
+
+    def known(self, port_ids):
+        """Whether each port ID is in the table"""
+        return self.rows(port_ids) >= 0
+
+    def take(self, port_ids, columns=None, suffix=''):
+        """
+        Attributes (columns, default all) of port_ids as a frame aligned to them, column names with suffix.
+        IDs missing from the table give NaN rows, like a left merge would
+        """
+        rows = self.rows(port_ids)
+        table = self.table[list(columns) if columns is not None else list(self.table.columns)]
+        if (rows < 0).any():
+            # extra all-NaN last row, taken by the -1 rows
+            table = table.reindex(np.arange(len(table) + 1))
+        out = table.iloc[rows].reset_index(drop=True)
+        out.columns = [c + suffix for c in table.columns]
+        return out
+
+    def codes(self, column):
+        """Dense array indexed by PORT_ID with the category code of column (-1 for unknown ports or missing values) and the categories"""
+        values = self.table[column].astype('category')
+        dense = np.full(len(self.row), -1, dtype=np.int64)
+        known = self.row >= 0
+        dense[known] = values.cat.codes.to_numpy()[self.row[known]]
+        return dense, values.cat.categories
+
+
+def read_ports(ports_file):
+    """ports.csv as published (no corrections)"""
+    return pd.read_csv(ports_file, usecols=PORT_COLUMNS)[PORT_COLUMNS]
+
+
+def legacy_corrections(raw):
+    """LEGACY_ROW_FIXES keyed by the PORT_ID of their row in raw (rows beyond the end of raw are left out)"""
+    fixes = [(raw['PORT_ID'].iat[row], column, value) for row, column, value in LEGACY_ROW_FIXES if row < len(raw)]
+    return pd.DataFrame(fixes, columns=['PORT_ID', 'column', 'value'])
+
+
+def apply_corrections(raw, corrections):
+    """Copy of raw with the corrections (PORT_ID, column, value) applied"""
+    out = raw.copy()
+    rows = pd.Index(out['PORT_ID']).get_indexer(corrections['PORT_ID'])
+    for row, (port_id, column, value) in zip(rows, corrections[['PORT_ID', 'column', 'value']].itertuples(index=False)):
+        if row < 0:
+            print("Correction of unknown port {} ({}) ignored".format(port_id, column))
+            continue
+        if pd.api.types.is_numeric_dtype(out[column].dtype):
+            value = float(value)
+        out.iat[row, out.columns.get_loc(column)] = value
+    return out
+
+
+def _digest(ports_file, corrections):
+    h = hashlib.sha1()
+    with open(ports_file, 'rb') as fh:
+        h.update(fh.read())
+    h.update(b'\0')
+    if corrections is not None:
+        h.update(corrections.to_csv(index=False).encode())
+    return h.hexdigest()
+
+
+def load_ports(ports_file, cache_dir=None, corrections=True, corrections_file=None):
+    """
+    Port registry of ports_file. corrections: apply the corrections of corrections_file (default port_corrections.csv
+    next to ports_file), or LEGACY_ROW_FIXES when there is no such file. cache_dir: folder of the binary cache, reused
+    while ports_file and the corrections are unchanged (no cache if None or missing)
+    """
+    raw = fixes = source = None
+    if corrections:
+        if corrections_file is None:
+            corrections_file = os.path.join(os.path.dirname(ports_file), 'port_corrections.csv')
+        if os.path.exists(corrections_file):
+            fixes, source = pd.read_csv(corrections_file), corrections_file
+        else:
+            raw = read_ports(ports_file)
+            fixes, source = legacy_corrections(raw), 'LEGACY_ROW_FIXES'
+    cache = cache_info = None
+    digest = _digest(ports_file, fixes)
+    if cache_dir is not None and os.path.isdir(cache_dir):
+        base = os.path.join(cache_dir, os.path.splitext(os.path.basename(ports_file))[0] + ('_registry' if corrections else '_raw_registry'))
+        cache, cache_info = base + '.parquet', base + '.json'
+        if os.path.exists(cache) and os.path.exists(cache_info):
+            with open(cache_info) as f:
+                if json.load(f).get('digest') == digest:
+                    return PortRegistry(pd.read_parquet(cache))
+    table = read_ports(ports_file) if raw is None else raw
+    if fixes is not None:
+        table = apply_corrections(table, fixes)
+    table['PORT_ID'] = table['PORT_ID'].astype(int)
+    table = compact(table)
+    if cache is not None:
+        table.to_parquet(cache, index=False)
+        with open(cache_info, 'w') as f:
+            json.dump({'digest': digest, 'source': ports_file, 'corrections': source}, f, indent=1)
+    return PortRegistry(table)
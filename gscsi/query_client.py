@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Python client of the local query service (gscsi.query_service): results as DataFrames.
+
+    client = QueryClient()
+    client.lane(1253, 2727, start='2021-01', end='2021-12')
+    client.port(2727, traffic='ALL')['stress_by_port']
+    client.region('North America West Coast')
+"""
+import json
+from urllib.parse import urlencode
+from urllib.request import urlopen
+from urllib.error import HTTPError
+import pandas as pd
+from gscsi.query_service import HOST, PORT
+
+
+class QueryClient(object):
+    """Queries of a query service at url (default: the local one)"""
+
+    def __init__(self, url='http://{}:{}'.format(HOST, PORT), timeout=10):
+        self.url, self.timeout = url.rstrip('/'), timeout
+
+    def get(self, endpoint, **params):
+        """JSON answer of endpoint (parameters left at None are not sent); errors of the service as ValueError/KeyError"""
+        query = urlencode({k: v for k, v in params.items() if v is not None})
+        try:
+            with urlopen('{}/{}?{}'.format(self.url, endpoint.strip('/'), query), timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except HTTPError as e:
+            message = json.loads(e.read()).get('error', str(e))
+            raise (KeyError if e.code == 404 else ValueError)(message)
+
+    def lane(self, origin, destination, traffic=None, freq='monthly', start=None, end=None):
+        """Dep2Dep aggregates of the lane origin -> destination (port IDs)"""
+        return pd.DataFrame(self.get('lane', origin=origin, destination=destination, traffic=traffic, freq=freq, start=start, end=end)['rows'])
+
+    def port(self, port, traffic=None, freq='monthly', start=None, end=None):
+        """Dep2Dep aggregates of the lanes ending at port, and its stress_by_port rows: dict of DataFrames"""
+        answer = self.get('port', port=port, traffic=traffic, freq=freq, start=start, end=end)
+        return {k: pd.DataFrame(v) for k, v in answer.items()}
+
+    def region(self, region, traffic=None, start=None, end=None):
+        """Stalled capacity of the destination region (stressdata)"""
+        return pd.DataFrame(self.get('region', region=region, traffic=traffic, start=start, end=end)['rows'])
+
+    def region_pair(self, origin, destination, traffic=None, start=None, end=None):
+        """Stalled capacity from the origin to the destination region (stress_matrix)"""
+        return pd.DataFrame(self.get('region_pair', origin=origin, destination=destination, traffic=traffic, start=start, end=end)['rows'])
+
+    def files(self):
+        return self.get('files')
+
+    def metrics(self):
+        """Request counts, errors and latency percentiles (ms) of every endpoint, time of the last load of the results"""
+        return self.get('metrics')
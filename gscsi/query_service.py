@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP/JSON query service over the latest outputs of stages 2 and 3 of a segment, so that the history of one port,
+lane or region is looked up without opening the csv files in full (client: gscsi.query_client).
+
+The newest file of every kind and traffic type in the working directory of the segment (GSCSI_SEGMENT, see
+gscsi.segments) is loaded into memory-resident tables: rows sorted once by key and period, with the row range of every
+key in a dict, so that a point query is a dict lookup and a period range two binary searches within the range of the key.
+    Dep2Dep aggregates: by lane (PORT_ID Origin, PORT_ID Destination) and by destination port, per traffic type and frequency
+    stress_by_port: by port (PORT_ID; files written before stage 3 kept it: by PORT_NAME_CUR, port IDs are translated with
+        the port table of the configuration and IDs whose name is shared with other ports are rejected)
+    stressdata: by destination region (Maritime_Region_CUR)
+    stress_matrix (Maritime_Region): by origin and destination region
+The files are polled every RELOAD_SECONDS; when a new run lands, new tables are built in the background and swapped in
+(queries keep being answered by the old ones meanwhile). Request latencies (last WINDOW requests of every endpoint)
+are reported by /metrics.
+
+Endpoints (GET, query parameters; start and end are inclusive period labels, a prefix matches: end=2021-12 includes
+the weeks of December 2021):
+    /lane?origin=&destination=[&traffic=&freq=&start=&end=]
+    /port?port=[&traffic=&freq=&start=&end=]
+    /region?region=[&traffic=&start=&end=]
+    /region_pair?origin=&destination=[&traffic=&start=&end=]
+    /files, /metrics
+
+Usage: python -m gscsi.query_service [--config FILE] [--host 127.0.0.1] [--port 8765] [--reload SECONDS]
+"""
+import os
+import re
+import glob
+import json
+import time
+import argparse
+import threading
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pandas as pd
+from gscsi.config import load_config
+from gscsi.segments import current_segment
+from gscsi.ports import load_ports
+
+HOST, PORT = '127.0.0.1', 8765
+RELOAD_SECONDS = 30
+WINDOW = 1000
+# Result files: kind -> pattern of the name (groups: traffic type, and frequency for Dep2Dep)
+FILES = {'dep2dep': re.compile(r'^Dep2Dep_(\w+?)_ports_(weekly|monthly|quarterly)_agg.*\.csv$'),
+         'stress_by_port': re.compile(r'^stress_by_port .*_\((.+)\)\.csv$'),
+         'stressdata': re.compile(r'^stressdata .*_\((.+)\)\.csv$'),
+         'stress_matrix': re.compile(r'^stress_matrix_Maritime_Region .*_\((.+)\)\.csv$')}
+# Traffic types of the Dep2Dep file names and of the stress file names ((global), (all traffic), ...)
+STRESS_TRAFFIC = {'GLOBAL': 'global', 'REGIONAL': 'regional', 'ALL': 'all traffic', 'LADEN': 'laden', 'BALLAST': 'ballast'}
+
+
+class Table(object):
+    """Rows of a result file sorted by key columns and period, with the row range of every key"""
+
+    def __init__(self, frame, keys, period):
+        self.keys, self.period_column = keys, period
+        self.frame = frame.sort_values(by=keys + [period], kind='mergesort').reset_index(drop=True)
+        self.period = self.frame[period].astype(str).to_numpy()
+        values = [self.frame[k].to_numpy() for k in keys]
+        new = np.zeros(len(self.frame), dtype=bool)
+        new[:1] = True
+        for v in values:
+            new[1:] |= v[1:] != v[:-1]
+        starts = np.flatnonzero(new)
+        ends = np.append(starts[1:], len(self.frame))
+        firsts = zip(*[v[starts].tolist() for v in values])
+        self.ranges = {key: (s, e) for key, s, e in zip(firsts, starts.tolist(), ends.tolist())}
+
+    def rows(self, key, start=None, end=None):
+        """Rows of key (tuple of the key columns) with period labels between start and end (inclusive, prefixes match)"""
+        s, e = self.ranges.get(tuple(key), (0, 0))
+        periods = self.period[s:e]
+        lo = s + int(np.searchsorted(periods, start, 'left')) if start else s
+        hi = s + int(np.searchsorted(periods, end + '\uffff', 'right')) if end else e
+        return self.frame.iloc[lo:hi]
+
+
+def latest_files(workdir):
+    """Newest result file of every kind and traffic type (and frequency) in workdir: {(kind, traffic[, freq]): path}"""
+    latest = {}
+    for path in glob.glob(os.path.join(workdir, '*.csv')):
+        for kind, pattern in FILES.items():
+            match = pattern.match(os.path.basename(path))
+            if match:
+                key = (kind,) + match.groups()
+                if key not in latest or os.path.getmtime(path) > os.path.getmtime(latest[key]):
+                    latest[key] = path
+    return latest
+
+
+def signature(files):
+    """Names, sizes and modification times of files (a new run changes it)"""
+    return sorted((k, p, os.path.getsize(p), os.path.getmtime(p)) for k, p in files.items() if os.path.exists(p))
+
+
+def _read(path):
+    df = pd.read_csv(path, index_col=0)
+    return df.loc[:, [c for c in df.columns if not re.search(r'\.\d+$', c)]]  # repeated columns (Latitude Origin.1, ...)
+
+
+def build_index(files):
+    """Tables of the result files (see latest_files): {(kind, traffic[, freq], index): Table}"""
+    tables = {}
+    for key, path in files.items():
+        df = _read(path)
+        kind = key[0]
+        if kind == 'dep2dep':
+            period = [c for c in ('Departure_YearMonth', 'week', 'Departure_YearQuarter') if c in df.columns][0]
+            tables[key + ('lane',)] = Table(df, ['PORT_ID Origin', 'PORT_ID Destination'], period)
+            tables[key + ('port',)] = Table(df, ['PORT_ID Destination'], period)
+        elif kind == 'stress_by_port':
+            tables[key] = Table(df, ['PORT_ID' if 'PORT_ID' in df.columns else 'PORT_NAME_CUR'], 'Departure_YearMonth')
+        elif kind == 'stressdata':
+            tables[key] = Table(df, ['Maritime_Region_CUR'], 'Dep2_YearMonth')
+        else:
+            tables[key] = Table(df, ['Maritime_Region_PREV', 'Maritime_Region_CUR'], 'Dep2_YearMonth')
+    return tables
+
+
+class Metrics(object):
+    """Latencies of the last WINDOW requests and counts of requests and errors of every endpoint"""
+
+    def __init__(self, window=WINDOW):
+        self.lock = threading.Lock()
+        self.window = window
+        self.latency, self.count, self.errors = {}, {}, {}
+
+    def record(self, endpoint, seconds, error=False):
+        with self.lock:
+            self.latency.setdefault(endpoint, deque(maxlen=self.window)).append(seconds * 1000)
+            self.count[endpoint] = self.count.get(endpoint, 0) + 1
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + int(error)
+
+    def summary(self):
+        with self.lock:
+            out = {}
+            for endpoint, values in self.latency.items():
+                ms = np.array(values)
+                out[endpoint] = {'requests': self.count[endpoint], 'errors': self.errors[endpoint],
+                                 'p50_ms': round(float(np.percentile(ms, 50)), 3), 'p95_ms': round(float(np.percentile(ms, 95)), 3),
+                                 'p99_ms': round(float(np.percentile(ms, 99)), 3), 'max_ms': round(float(ms.max()), 3)}
+            return out
+
+
+class QueryService(object):
+    """Tables of the latest results of workdir, reloaded when they change, and the queries of the endpoints"""
+
+    def __init__(self, workdir, ports=None, traffic_types=('GLOBAL', 'REGIONAL', 'ALL')):
+        self.workdir, self.ports = workdir, ports
+        names = ports.table['PORT_NAME'] if ports is not None else pd.Series([], dtype=object)
+        self.shared_names = set(names[names.duplicated()])
+        self.default_traffic = traffic_types[0]
+        self.metrics = Metrics()
+        self.tables, self.files, self.loaded = {}, {}, None
+        self.reload()
+
+    def reload(self):
+        """Load the latest files if they changed since the last load. Return: whether new tables were swapped in"""
+        files = latest_files(self.workdir)
+        if self.loaded is not None and signature(files) == self.loaded['signature']:
+            return False
+        start = time.perf_counter()
+        tables = build_index(files)
+        # one assignment: queries running meanwhile use the old tables
+        self.tables, self.files = tables, files
+        self.loaded = {'signature': signature(files), 'at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'load_s': round(time.perf_counter() - start, 3)}
+        print("Loaded {} result files from {} in {} s".format(len(files), self.workdir, self.loaded['load_s']))
+        return True
+
+    def watch(self, seconds=RELOAD_SECONDS):
+        """Poll the result files every seconds in a daemon thread (a failed load, e.g. of a file being written, is retried)"""
+        def poll():
+            while True:
+                time.sleep(seconds)
+                try:
+                    self.reload()
+                except Exception as e:
+                    print("Reload failed (retried in {} s): {}".format(seconds, e))
+        thread = threading.Thread(target=poll, daemon=True)
+        thread.start()
+        return thread
+
+    def _table(self, key):
+        if key not in self.tables:
+            raise KeyError("No result file for {}".format(' '.join(key)))
+        return self.tables[key]
+
+    def lane(self, origin, destination, traffic=None, freq='monthly', start=None, end=None):
+        return self._table(('dep2dep', traffic or self.default_traffic, freq, 'lane')).rows((int(origin), int(destination)), start, end)
+
+    def port(self, port, traffic=None, freq='monthly', start=None, end=None):
+        """Dep2Dep rows of the lanes ending at port and its stress_by_port rows (by PORT_ID; older files: if the port table
+        names the port, ValueError if its name is shared with other ports)"""
+        traffic = traffic or self.default_traffic
+        out = {'dep2dep': self._table(('dep2dep', traffic, freq, 'port')).rows((int(port),), start, end)}
+        key = ('stress_by_port', STRESS_TRAFFIC.get(traffic, traffic))
+        if key in self.tables and self.tables[key].keys == ['PORT_ID']:
+            out['stress_by_port'] = self.tables[key].rows((int(port),), start, end)
+        elif self.ports is not None and key in self.tables and self.ports.known([float(port)])[0]:
+            name = self.ports.take([float(port)], ['PORT_NAME'])['PORT_NAME'].iloc[0]
+            if name in self.shared_names:
+                raise ValueError("Port name {} of port {} is shared with other ports: {} has no PORT_ID column".format(name, port, self.files[key]))
+            out['stress_by_port'] = self.tables[key].rows((name,), start, end)
+        return out
+
+    def region(self, region, traffic=None, start=None, end=None):
+        return self._table(('stressdata', STRESS_TRAFFIC.get(traffic or self.default_traffic, traffic))).rows((region,), start, end)
+
+    def region_pair(self, origin, destination, traffic=None, start=None, end=None):
+        key = ('stress_matrix', STRESS_TRAFFIC.get(traffic or self.default_traffic, traffic))
+        return self._table(key).rows((origin, destination), start, end)
+
+    def answer(self, endpoint, params):
+        """JSON body of a request (ValueError/KeyError/TypeError for bad or unknown parameters)"""
+        if endpoint == '/metrics':
+            return json.dumps({'endpoints': self.metrics.summary(), 'loaded': self.loaded['at'], 'load_s': self.loaded['load_s']})
+        if endpoint == '/files':
+            return json.dumps({' '.join(k): p for k, p in self.files.items()})
+        queries = {'/lane': self.lane, '/port': self.port, '/region': self.region, '/region_pair': self.region_pair}
+        if endpoint not in queries:
+            raise KeyError("Unknown endpoint {}".format(endpoint))
+        result = queries[endpoint](**params)
+        if isinstance(result, dict):
+            return '{' + ', '.join('"{}": {}'.format(k, v.to_json(orient='records')) for k, v in result.items()) + '}'
+        return '{"rows": ' + result.to_json(orient='records') + '}'
+
+
+def handler(service):
+    """Request handler class of an HTTP server answering the queries of service"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            start = time.perf_counter()
+            url = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                status, body = 200, service.answer(url.path, params)
+            except KeyError as e:
+                status, body = 404, json.dumps({'error': str(e).strip('"\'')})
+            except (ValueError, TypeError) as e:
+                status, body = 400, json.dumps({'error': str(e)})
+            data = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            if url.path != '/metrics':
+                service.metrics.record(url.path, time.perf_counter() - start, status != 200)
+
+        def log_message(self, format, *args):
+            pass  # latencies and errors are in /metrics
+    return Handler
+
+
+def serve(service, host=HOST, port=PORT, reload_seconds=RELOAD_SECONDS):
+    """Answer queries on host:port until interrupted, reloading the results every reload_seconds"""
+    service.watch(reload_seconds)
+    server = ThreadingHTTPServer((host, port), handler(service))
+    print("Serving the results of {} on http://{}:{}".format(service.workdir, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local HTTP/JSON query service over the latest stage 2/3 results")
+    parser.add_argument('--config', help="configuration file (default: GSCSI_CONFIG or pipeline.ini)")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--reload', type=float, default=RELOAD_SECONDS, help="seconds between checks for new results")
+    args = parser.parse_args(argv)
+    if args.config:
+        os.environ['GSCSI_CONFIG'] = os.path.abspath(args.config)
+    config = load_config()
+    segment = current_segment()
+    ports_file = config['paths']['ports']
+    ports = load_ports(ports_file) if os.path.exists(ports_file) else None
+    serve(QueryService(config['paths'][segment['workdir']], ports, segment['traffic_types']), args.host, args.port, args.reload)
+
+
+if __name__ == "__main__":
+    main()
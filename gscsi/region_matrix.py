@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Origin x destination stress matrices (stage 3): delayed ships and delayed capacity of the lane-month rows of the stress
+computation summed by (month, origin group, destination group), groups being a port attribute: Maritime_Region,
+country_3 or Economy name.
+Ports are mapped to integer group codes once (dense PORT_ID -> code array, gscsi.ports.PortRegistry.codes), every row
+gets one flat cell index (month, origin, destination) and the sums are scatter-adds (np.bincount) into dense arrays
+(months x groups x groups), without merges or groupbys. Ports missing from the port table, or without a value of the
+attribute, are in the group UNKNOWN (only added when there are such ports).
+"""
+import numpy as np
+import pandas as pd
+
+LEVELS = ['Maritime_Region', 'country_3', 'Economy name']
+MEASURES = ['delayed_ship', 'delayed_capacity']
+UNKNOWN = 'UNKNOWN'
+
+
+def group_codes(dense, port_ids):
+    """Group code of port_ids from a dense PORT_ID -> code array (-1 for IDs out of it or NaN)"""
+    ids = np.asarray(port_ids, dtype=np.float64)
+    ok = np.isfinite(ids) & (ids >= 0) & (ids < len(dense))
+    out = np.full(len(ids), -1, dtype=np.int64)
+    out[ok] = dense[ids[ok].astype(np.int64)]
+    return out
+
+
+def region_matrix(pairs, ports, level='Maritime_Region', measures=MEASURES):
+    """
+    Sums of measures of pairs (rows with PORT_ID_PREV, PORT_ID_CUR, Dep2_YearMonth) by month, origin and destination group.
+    ports: port registry (gscsi.ports.PortRegistry).
+    Return: dict with level, months and groups (labels), pairs (count of rows) and every measure: arrays (months, groups, groups)
+    """
+    dense, groups = ports.codes(level)
+    groups = list(groups)
+    orig = group_codes(dense, pairs['PORT_ID_PREV'])
+    dest = group_codes(dense, pairs['PORT_ID_CUR'])
+    if (orig < 0).any() or (dest < 0).any():
+        orig[orig < 0] = len(groups)
+        dest[dest < 0] = len(groups)
+        groups.append(UNKNOWN)
+    month, months = pd.factorize(pairs['Dep2_YearMonth'], sort=True)
+    n, g = len(months), len(groups)
+    cell = (month.astype(np.int64) * g + orig) * g + dest
+    out = {'level': level, 'months': list(months), 'groups': groups,
+           'pairs': np.bincount(cell, minlength=n * g * g).reshape(n, g, g)}
+    for m in measures:
+        out[m] = np.bincount(cell, weights=pairs[m].to_numpy(dtype=np.float64), minlength=n * g * g).reshape(n, g, g)
+    return out
+
+
+def tidy(matrix, measures=MEASURES):
+    """One row per (month, origin group, destination group) cell with at least one pair: Dep2_YearMonth,
+    <level>_PREV, <level>_CUR, pairs and the measures"""
+    month, orig, dest = np.nonzero(matrix['pairs'])
+    months, groups = np.asarray(matrix['months'], dtype=object), np.asarray(matrix['groups'], dtype=object)
+    out = pd.DataFrame({'Dep2_YearMonth': months[month], matrix['level'] + '_PREV': groups[orig],
+                        matrix['level'] + '_CUR': groups[dest], 'pairs': matrix['pairs'][month, orig, dest]})
+    for m in measures:
+        out[m] = matrix[m][month, orig, dest]
+    return out
+
+
+def wide(matrix, measure='delayed_capacity'):
+    """Matrix form of a measure: one row per (month, origin group), one column per destination group"""
+    g = len(matrix['groups'])
+    index = pd.MultiIndex.from_product([matrix['months'], matrix['groups']], names=['Dep2_YearMonth', matrix['level'] + '_PREV'])
+    return pd.DataFrame(matrix[measure].reshape(-1, g), index=index, columns=pd.Index(matrix['groups'], name=matrix['level'] + '_CUR'))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Rolling daily stress (stage 3): stalled ships and capacity of every destination port (or region) on a daily grid,
+over trailing windows of N days, from the legs of stage 2 (one row per departure-to-departure leg, see ROLLING_LEGS
+in dep2dep) instead of the monthly lane medians, so that congestion shows up within days.
+
+The delay of a leg is its excess over the reference lead time of its lane (from the monthly medians, as for the
+monthly index): max(diff_hrs - reference_lead_time, 0). A leg counts on the day of its departure from the destination
+port (DATE_CUR, as Dep2_YearMonth for the monthly index). Over the window of N days ending on a day:
+    delayed_ship      sum of delays / (24 * N)                      (730 hours for the monthly index)
+    delayed_capacity  sum of capacity * delay / (24 * N)
+    port_delay        sum of capacity * delay / sum of capacity     (hours)
+
+Legs are binned once into a flat (group, day) grid - for every group, the days from its first leg to the last day of
+the data - and the window sums are differences of two prefix sums along it: every window size costs one vectorized
+pass over the grid, whatever the number of legs.
+"""
+import numpy as np
+import pandas as pd
+from gscsi.lane_stats import LANE
+from gscsi.lane_sketch import lane_codes
+from gscsi.timecodes import naive_utc, day_codes
+
+WINDOWS = [7, 28, 91]
+LEG_COLUMNS = ['PORT_ID_PREV', 'PORT_ID_CUR', 'DATE_CUR', 'diff_hrs']
+
+
+def leg_frame(legs, weight):
+    """Legs of stage 2 (time_difference, or the legs of the incremental state) as written for the rolling index:
+    LEG_COLUMNS and the capacity weight (TEU, DWT)"""
+    legs = legs.dropna(subset=['PORT_PREV'])
+    return pd.DataFrame({'PORT_ID_PREV': legs['PORT_PREV'].to_numpy(dtype=np.int64), 'PORT_ID_CUR': legs['PORT_CUR'].to_numpy(dtype=np.int64),
+                         'DATE_CUR': naive_utc(legs['DATE_CUR']), 'diff_hrs': legs['diff_hrs'].to_numpy(dtype=np.float64),
+                         weight: legs[weight].to_numpy(dtype=np.float64)})
+
+
+def leg_delays(legs, lanes, weight):
+    """
+    Legs (leg_frame) of the lanes of lanes (PORT_ID_CUR, PORT_ID_PREV, reference_lead_time; sorted by lane) with their
+    day (days since 1970), delay (hours over the reference lead time) and capacity; legs of other lanes are left out
+    """
+    code = lane_codes(lanes, legs.astype({key: lanes[key].dtype for key in LANE}))
+    # extra NaN last value, taken by the legs of other lanes (code -1)
+    ref = np.append(lanes['reference_lead_time'].to_numpy(dtype=np.float64), np.nan)[code]
+    diff, capacity = legs['diff_hrs'].to_numpy(dtype=np.float64), legs[weight].to_numpy(dtype=np.float64)
+    ok = np.isfinite(ref) & np.isfinite(diff) & np.isfinite(capacity)
+    return pd.DataFrame({'PORT_ID_CUR': legs['PORT_ID_CUR'].to_numpy()[ok], 'day': day_codes(legs['DATE_CUR'])[ok],
+                         'delay': np.maximum(diff[ok] - ref[ok], 0), 'capacity': capacity[ok]})
+
+
+def window_sums(group, day, values, windows, start=None, end=None):
+    """
+    Sums of values ({name: array}, one value per event) over trailing windows (days) of every group, on its daily grid.
+    group: integer codes (0..n-1), day: integer days. The grid of a group runs from its first event (not earlier than
+    the widest window before start) to end (default: last day of all events); only days from start on with at least
+    one event in the widest window are returned.
+    Return: group and day of the grid rows kept, {(name, window): sums} with name 'count' for the number of events
+    """
+    group, day = np.asarray(group, dtype=np.int64), np.asarray(day, dtype=np.int64)
+    n = int(group.max()) + 1 if len(group) else 0
+    end = (int(day.max()) if len(day) else 0) if end is None else end
+    first = np.full(n, end + 1, dtype=np.int64)
+    np.minimum.at(first, group, day)
+    if start is not None:
+        first = np.maximum(first, start - max(windows) + 1)
+    keep = (day >= first[group]) & (day <= end)
+    length = np.maximum(end - first + 1, 0)
+    offset = np.concatenate([[0], np.cumsum(length)])
+    cell = offset[group[keep]] + day[keep] - first[group[keep]]
+    grid_group = np.repeat(np.arange(n), length)
+    position = np.arange(offset[-1])
+    grid_start = offset[:-1][grid_group]
+    grid_day = first[grid_group] + position - grid_start
+    # prefix[i] = sum of the first i grid cells: the sum over cells lo..i is prefix[i + 1] - prefix[lo]
+    prefix = {'count': np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=offset[-1]))])}
+    for name, v in values.items():
+        prefix[name] = np.concatenate([[0.], np.cumsum(np.bincount(cell, weights=np.asarray(v, dtype=np.float64)[keep], minlength=offset[-1]))])
+    widest = prefix['count'][position + 1] - prefix['count'][np.maximum(position - max(windows) + 1, grid_start)]
+    kept = widest > 0
+    if start is not None:
+        kept &= grid_day >= start
+    row = position[kept]
+    sums = {}
+    for w in windows:
+        lo = np.maximum(row - w + 1, grid_start[row])
+        count = prefix['count'][row + 1] - prefix['count'][lo]
+        sums[('count', w)] = count
+        for name in values:
+            # windows without events are exact zeros, not the rounding residue of the difference
+            sums[(name, w)] = np.where(count > 0, prefix[name][row + 1] - prefix[name][lo], 0.)
+    return grid_group[row], grid_day[row], sums
+
+
+def rolling_stress(legs, keys, windows=WINDOWS, start=None, end=None, name='PORT_ID', capacity='capacity'):
+    """
+    Rolling stress of legs (leg_delays) grouped by keys (destination port, region... of every leg; missing keys are
+    left out) for every window. start, end: first and last day of the grid (datetime-like, default: all the data).
+    Return: one row per (window, group, day) with legs in the window: name, date, window_days, legs, delayed_ship,
+    delayed_capacity, capacity and port_delay
+    """
+    code, labels = pd.factorize(np.asarray(keys), sort=True)
+    ok = code >= 0
+    delay, weight = legs['delay'].to_numpy()[ok], legs['capacity'].to_numpy()[ok]
+    bounds = [None if d is None else int(day_codes(pd.DatetimeIndex([d]))[0]) for d in (start, end)]
+    group, day, sums = window_sums(code[ok], legs['day'].to_numpy()[ok], {'delay': delay, 'capacity_delay': weight * delay, 'capacity': weight},
+                                   windows, *bounds)
+    frames = []
+    for w in windows:
+        frame = pd.DataFrame({name: labels[group], 'date': day.astype('datetime64[D]'), 'window_days': w,
+                              'legs': sums[('count', w)], 'delayed_ship': sums[('delay', w)] / (24 * w),
+                              'delayed_capacity': sums[('capacity_delay', w)] / (24 * w), capacity: sums[('capacity', w)]})
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frame['port_delay'] = sums[('capacity_delay', w)] / sums[('capacity', w)]
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
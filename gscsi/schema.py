@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Compact in-memory schema of port call frames, shared by stage 1 (ingest, store) and stage 2 (get_data, get_metadata).
+Repeated strings (port and ship names, ship class, move type, fleet group, traffic type, source file and
+the attributes of ports.csv) are held as categoricals, SHIP_ID and PORT_ID as 32-bit integers.
+Frames with categoricals must be concatenated with concat() below (pd.concat falls back to object
+columns when categories differ).
+"""
+import numpy as np
+import pandas as pd
+
+CATEGORICAL = ['PORT_NAME', 'SHIPNAME', 'SHIP_CLASS_NAME', 'MOVE_TYPE', 'COMFLEET_GROUPEDTYPE', 'TRAFFIC_TYPE',
+               'source_file', 'un_code', 'country_3', 'Economy name', 'Maritime_Region']
+INT32 = ['SHIP_ID', 'PORT_ID']
+INT32_MIN, INT32_MAX = np.iinfo(np.int32).min, np.iinfo(np.int32).max
+
+
+def to_int32(s):
+    """Integer column as int32 (raise instead of wrapping around if a value does not fit)"""
+    if s.dtype == np.int32:
+        return s
+    if len(s) and (s.min() < INT32_MIN or s.max() > INT32_MAX):
+        raise ValueError("{} has values outside the 32-bit range".format(s.name))
+    return s.astype(np.int32)
+
+
+def compact(df):
+    """Cast the columns of df listed in the schema (in place, also returned). Columns with missing IDs are left as they are"""
+    for c in df.columns:
+        if c in CATEGORICAL and not isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype('category')
+        elif c in INT32 and pd.api.types.is_integer_dtype(df[c].dtype):
+            df[c] = to_int32(df[c])
+    return df
+
+
+def concat(frames, **kwargs):
+    """pd.concat keeping categorical columns categorical (categories of all frames are unified first)"""
+    frames = list(frames)
+    for c in CATEGORICAL:
+        cols = [f[c] for f in frames if c in f.columns]
+        if len(cols) < 2 or not all(isinstance(s.dtype, pd.CategoricalDtype) for s in cols):
+            continue
+        categories = cols[0].cat.categories
+        for s in cols[1:]:
+            categories = categories.union(s.cat.categories)
+        frames = [f.assign(**{c: f[c].cat.set_categories(categories)}) if c in f.columns else f for f in frames]
+    return pd.concat(frames, **kwargs)
+
+
+def canonical(df):
+    """Columns of df with the dtypes used before the compact schema (stable inputs for hashing)"""
+    out = {}
+    for c in df.columns:
+        s = df[c]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            s = s.astype(object)
+        elif pd.api.types.is_integer_dtype(s.dtype):
+            s = s.astype(np.int64)
+        elif isinstance(s.dtype, pd.DatetimeTZDtype):
+            s = s.astype('datetime64[ns, UTC]')
+        out[c] = s
+    return pd.DataFrame(out, index=df.index)
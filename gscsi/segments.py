@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Market segments of stages 2 and 3: containerships and drybulk carriers, both ingested by stage 1 into their own store.
+A segment sets the working directory (key of the [paths] section), the prefix of its store snapshots, the capacity
+weight of the aggregates (TEU, DWT) and its traffic types: ship classes for containers (gscsi.legs), load status of
+the leg for drybulk (LADEN/BALLAST from the draught at departure from the origin port).
+
+The segment of a process is GSCSI_SEGMENT (default: containers), read by the stage scripts when they are imported,
+so that segments run side by side in separate processes (see gscsi.pipeline).
+"""
+import os
+import numpy as np
+import pandas as pd
+
+SEGMENTS = {
+    'containers': {'name': 'containers', 'workdir': 'workdir', 'snapshot': 'Saved_data_with_missing_', 'weight': 'TEU',
+                   'traffic': 'ship_class', 'traffic_types': ['GLOBAL', 'REGIONAL', 'ALL']},
+    'drybulk': {'name': 'drybulk', 'workdir': 'drybulk_workdir', 'snapshot': 'Saved_drybulk_all_', 'weight': 'DWT',
+                'traffic': 'draught', 'traffic_types': ['LADEN', 'BALLAST', 'ALL']},
+}
+DEFAULT_SEGMENT = 'containers'
+# A leg is laden when the ship left the origin port with at least LADEN_RATIO of the deepest draught seen for the ship
+LADEN_RATIO = .75
+
+
+def current_segment():
+    """Segment of this process (GSCSI_SEGMENT, default containers)"""
+    name = os.environ.get('GSCSI_SEGMENT') or DEFAULT_SEGMENT
+    if name not in SEGMENTS:
+        raise ValueError("Unknown segment: {} (one of {})".format(name, ', '.join(SEGMENTS)))
+    return SEGMENTS[name]
+
+
+def weighted(aggregates, weight):
+    """Aggregates (column, function) with the TEU column replaced by the weight of a segment"""
+    return [(weight if c == 'TEU' else c, f) for c, f in aggregates]
+
+
+def load_status(draught, ship_ids, ratio=LADEN_RATIO):
+    """
+    LADEN or BALLAST (categorical) of legs from the draught at departure from the origin port, relative to the deepest
+    draught of the ship among the legs; 'nan' where the draught is missing or zero
+    """
+    draught = pd.Series(np.asarray(draught, dtype=float)).where(lambda d: d > 0)
+    deepest = draught.groupby(np.asarray(ship_ids)).transform('max')
+    status = np.where(draught >= ratio * deepest, 'LADEN', 'BALLAST')
+    return pd.Series(np.where(draught.isna(), 'nan', status)).astype('category')
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Ship-sharded execution of stage 2 (dep2dep) for histories larger than memory, on all cores.
+Everything before the lane aggregation (run collapsing, legs, time differences) depends on one ship at a time:
+
+    1. split: the partitions of the store snapshot are read in batches of BATCH_ROWS rows and their departures are
+       hash-partitioned by SHIP_ID into shard files (shard_dir/<shard>/<batch>.parquet), with their arrivals when
+       the time at port is computed as well (stays, see gscsi.port_stays)
+    2. legs: every shard is turned into legs on a process pool (collapse_runs, build_legs, diff_hrs, pair_arrivals), and its legs are
+       spilled by hash of the lane (PORT_CUR, PORT_PREV) into lane buckets (shard_dir/lanes/<bucket>/<shard>.parquet).
+       The load status of drybulk legs (gscsi.segments.load_status) only depends on the legs of the ship: it is exact per shard
+    3. cells: every lane bucket holds all the legs of its lanes, so its (lane, period) cells are exact (medians included);
+       buckets are aggregated on the process pool and their cells concatenated
+
+Memory is bounded by one batch of store partitions, one shard and one lane bucket per worker (plus the cells), not by the history.
+"""
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from gscsi.store import load_listing
+from gscsi.schema import compact, concat
+from gscsi.dedup_index import key_hashes
+from gscsi.geofence import collapse_runs
+from gscsi.legs import build_legs
+from gscsi.aggregates import lane_cells, AGGREGATES
+from gscsi.port_stays import arrival_runs, pair_arrivals, stay_hours, STAY_AGGREGATES
+from gscsi.segments import weighted, load_status
+from gscsi.instrument import traced
+from gscsi.timecodes import hours_between
+
+LEG_COLUMNS = ['SHIP_ID', 'PORT_CUR', 'PORT_PREV', 'DATE_CUR', 'TEU', 'TRAFFIC_TYPE', 'diff_hrs']
+CELL_KEY = ['PORT_CUR', 'PORT_PREV', 'period']
+# Rows of store partitions read at once by split_snapshot (few large shard files rather than one per partition and shard)
+BATCH_ROWS = 2000000
+
+# registry and ship table of the worker processes (set once per worker by _init)
+_context = {}
+
+
+def _init(ports, ship_table):
+    _context['ports'] = ports
+    _context['ship_table'] = ship_table
+
+
+def _map(func, jobs, workers, ports, ship_table):
+    """func over jobs on a process pool (workers: None = number of cores, 1 = serial in this process)"""
+    if workers == 1 or len(jobs) < 2:
+        _init(ports, ship_table)
+        return [func(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(ports, ship_table)) as pool:
+        return list(pool.map(func, jobs))
+
+
+def _split(frame, buckets):
+    """Rows of frame by bucket: dict {bucket: frame} of the non-empty buckets, row order kept within a bucket"""
+    order = np.argsort(buckets, kind='stable')
+    values, starts = np.unique(buckets[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    return {b: frame.iloc[order[s:e]] for b, s, e in zip(values, starts, ends)}
+
+
+def _write_pieces(pieces, folder, name):
+    """Frames {bucket: frame} to folder/<bucket>/name.parquet"""
+    for b, piece in pieces.items():
+        os.makedirs(os.path.join(folder, str(b)), exist_ok=True)
+        piece.to_parquet(os.path.join(folder, str(b), name + '.parquet'), index=False)
+
+
+def _read_pieces(folder):
+    if not os.path.isdir(folder):
+        return None
+    pieces = [pd.read_parquet(os.path.join(folder, f)) for f in sorted(os.listdir(folder))]
+    return concat(pieces, ignore_index=True) if pieces else None
+
+
+@traced('shard_split')
+def split_snapshot(snapshot, shard_dir, n_shards, columns, move_types=('DEPARTURE',)):
+    """Port calls (move_types) of every partition of snapshot (columns) hash-partitioned by SHIP_ID. Return: rows written"""
+    root = os.path.dirname(os.path.dirname(snapshot))
+    parts = load_listing(snapshot)['parts']
+    # batches of consecutive partitions of at most BATCH_ROWS rows (a larger partition is a batch of its own)
+    batch = np.cumsum([p['rows'] for p in parts]) // BATCH_ROWS
+    rows = 0
+    for b in np.unique(batch):
+        files = [os.path.join(root, p['file']) for p, pb in zip(parts, batch) if pb == b]
+        deps = pq.ParquetDataset(files, filters=[('MOVE_TYPE', 'in', list(move_types))]).read(columns=columns).to_pandas()
+        if len(deps):
+            deps = compact(deps)
+            _write_pieces(_split(deps, key_hashes(deps, ['SHIP_ID']) % n_shards), shard_dir, '{:06d}'.format(b))
+            rows += len(deps)
+    return rows
+
+
+def _shard_legs(job):
+    """Legs of the departures of one shard, spilled by lane bucket. Return: departures, runs and legs of the shard"""
+    shard_dir, lane_dir, shard, n_buckets, stays, weight, draught = job
+    deps = _read_pieces(os.path.join(shard_dir, str(shard)))
+    if deps is None:
+        return 0, 0, 0
+    if stays:
+        calls, deps = deps, deps[deps['MOVE_TYPE'] == 'DEPARTURE']
+    runs = collapse_runs(deps)
+    legs = build_legs(runs, _context['ports'], _context['ship_table'], ['FirstDate'] if stays else (), ['LastDraft'] if draught else ())
+    if draught:
+        legs['TRAFFIC_TYPE'] = load_status(legs['LastDraft_PREV'], legs['SHIP_ID']).array
+    legs['diff_hrs'] = hours_between(legs['DATE_CUR'], legs['DATE_PREV'])
+    columns = LEG_COLUMNS + ([weight] if weight not in LEG_COLUMNS else [])
+    if stays:
+        legs = stay_hours(pair_arrivals(legs, arrival_runs(calls)))
+        columns = columns + [c for c, _ in STAY_AGGREGATES]
+    legs = legs[columns].reset_index(drop=True)
+    _write_pieces(_split(legs, key_hashes(legs, ['PORT_CUR', 'PORT_PREV']) % n_buckets), lane_dir, '{:06d}'.format(shard))
+    return len(deps), len(runs), len(legs)
+
+
+def _bucket_cells(job):
+    lane_dir, bucket, traffic_types, freqs, aggregates = job
+    legs = _read_pieces(os.path.join(lane_dir, str(bucket)))
+    if legs is None:
+        return None
+    return lane_cells(legs, traffic_types, freqs, aggregates)
+
+
+@traced('shard_legs')
+def shard_legs(shard_dir, lane_dir, n_shards, n_buckets, ports, ship_table, workers=None, stays=False, weight='TEU', draught=False):
+    """Legs of every shard, spilled to lane buckets (process pool). Return: departures, runs and legs in total"""
+    counts = _map(_shard_legs, [(shard_dir, lane_dir, s, n_buckets, stays, weight, draught) for s in range(n_shards)], workers, ports, ship_table)
+    return tuple(int(c) for c in np.sum(counts, axis=0)) if counts else (0, 0, 0)
+
+
+@traced('shard_cells')
+def bucket_cells(lane_dir, n_buckets, traffic_types, freqs, workers=None, aggregates=AGGREGATES):
+    """Cells of every (traffic type, frequency) from the lane buckets (process pool), sorted by (lane, period) as in lane_aggregates"""
+    parts = _map(_bucket_cells, [(lane_dir, b, traffic_types, freqs, aggregates) for b in range(n_buckets)], workers, None, None)
+    parts = [p for p in parts if p is not None]
+    cells = {}
+    for key in [(t, f) for t in traffic_types for f in freqs]:
+        frame = concat([p[key] for p in parts], ignore_index=True)
+        cells[key] = frame.sort_values(by=CELL_KEY, kind='mergesort').reset_index(drop=True)
+    return cells
+
+
+def sharded_cells(snapshot, shard_dir, ports, ship_table, traffic_types, freqs, columns, n_shards, n_buckets=None, workers=None,
+                  stays=False, weight='TEU', draught=False):
+    """
+    Cells of every (traffic type, frequency) of the departures of snapshot, computed shard by shard in shard_dir
+    (removed afterwards). n_buckets: lane buckets (default n_shards). stays: legs are paired with their arrivals and
+    the cells have the STAY_AGGREGATES as well (gscsi.port_stays). weight: capacity summed by the cells (TEU, DWT).
+    draught: TRAFFIC_TYPE is the load status of the legs (drybulk, columns with DRAUGHT_METERSX10).
+    Return: dict {(traffic type, freq): cells}
+    """
+    n_buckets = n_buckets or n_shards
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    lane_dir = os.path.join(shard_dir, 'lanes')
+    try:
+        rows = split_snapshot(snapshot, shard_dir, n_shards, columns, ('DEPARTURE', 'ARRIVAL') if stays else ('DEPARTURE',))
+        n_deps, n_runs, n_legs = shard_legs(shard_dir, lane_dir, n_shards, n_buckets, ports, ship_table, workers, stays, weight, draught)
+        print("{} port calls in {} shards, {} departures, {} runs ({:.3f}), {} legs".format(rows, n_shards, n_deps, n_runs, n_runs / max(n_deps, 1), n_legs))
+        aggregates = weighted(AGGREGATES + STAY_AGGREGATES if stays else AGGREGATES, weight)
+        return bucket_cells(lane_dir, n_buckets, traffic_types, freqs, workers, aggregates)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
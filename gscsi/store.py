@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Partitioned columnar store of port calls (parquet), replacing the weekly full-history pickles.
+Rows are partitioned by month (Datetime) and fleet segment (SHIP_CLASS_NAME). Partition files are
+content addressed, so a weekly snapshot only writes the partitions that changed and shares the rest
+with the previous snapshots. A snapshot is a small json file listing its partition files.
+"""
+import os
+import json
+import hashlib
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from gscsi.schema import compact, concat, canonical
+from gscsi.dedup_index import key_hashes
+from gscsi.timecodes import month_codes, month_labels
+
+SEGMENT_COL = 'SHIP_CLASS_NAME'
+DATE_COL = 'Datetime'
+UNKNOWN = 'UNKNOWN'
+ROW_GROUP_SIZE = 64000
+
+
+def partition_digest(part):
+    """Content hash of one partition (column names + values), used as its file name"""
+    h = hashlib.sha1("|".join(map(str, part.columns)).encode())
+    h.update(pd.util.hash_pandas_object(canonical(part), index=False).values.tobytes())
+    return h.hexdigest()[:20]
+
+
+def _write_part(part, root, month, segment):
+    """Write one partition, unless a partition with the same content is already in the store"""
+    part = compact(part.sort_values(by=['MOVE_TYPE', 'SHIP_ID', DATE_COL], kind='mergesort'))
+    rel = os.path.join('parts', month, segment.replace(" ", "_"), partition_digest(part) + '.parquet')
+    full = os.path.join(root, rel)
+    written = not os.path.exists(full)
+    if written:
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        part.to_parquet(full + ".tmp", index=False, row_group_size=ROW_GROUP_SIZE)
+        os.replace(full + ".tmp", full)
+    return {'month': month, 'segment': segment, 'file': rel, 'rows': len(part)}, written
+
+
+def _write_listing(root, name, columns, parts, written):
+    snapshot = os.path.join(root, 'snapshots', name + '.json')
+    os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+    with open(snapshot, 'w') as f:
+        json.dump({'created': datetime.now().isoformat(), 'columns': list(columns), 'parts': parts}, f, indent=1)
+    print("Snapshot {}: {} partitions, {} written, {} shared with earlier snapshots".format(name, len(parts), written, len(parts) - written))
+    return snapshot
+
+
+def month_key(df):
+    """Month partition of every row (YYYY-MM of Datetime)"""
+    return pd.Series(month_labels(month_codes(df[DATE_COL]), UNKNOWN), index=df.index)
+
+
+def _partition_keys(df):
+    return [month_key(df), df[SEGMENT_COL].astype(object).fillna(UNKNOWN).astype(str)]
+
+
+def write_snapshot(df, root, name):
+    """
+    Write df as snapshot `name` of the store at `root`.
+    Within a partition rows are ordered by MOVE_TYPE, SHIP_ID and Datetime so that row group statistics
+    let the reader skip arrivals when only departures are requested.
+    Return: path of the snapshot file
+    """
+    parts, written = [], 0
+    for (m, s), part in df.groupby(_partition_keys(df), sort=True):
+        p, w = _write_part(part, root, m, s)
+        parts.append(p)
+        written += w
+    return _write_listing(root, name, df.columns, parts, written)
+
+
+def append_parts(parts, new, root):
+    """
+    Add rows of new to the partitions listed in parts (dict {(month, segment): entry}, updated in place).
+    Only the partitions that receive new rows are read and rewritten.
+    Return: number of partition files written
+    """
+    written = 0
+    if len(new):
+        for (m, s), part in new.groupby(_partition_keys(new), sort=True):
+            if (m, s) in parts:
+                part = concat([pd.read_parquet(os.path.join(root, parts[(m, s)]['file'])), part])
+            parts[(m, s)], w = _write_part(part, root, m, s)
+            written += w
+    return written
+
+
+def write_listing(root, name, columns, parts, written=0):
+    """Write snapshot `name` from a dict of partition entries. Return: path of the snapshot file and its total number of rows"""
+    parts = [parts[k] for k in sorted(parts)]
+    snapshot = _write_listing(root, name, columns, parts, written)
+    return snapshot, sum(p['rows'] for p in parts)
+
+
+def snapshot_parts(snapshot):
+    """Partition entries of a snapshot as a dict {(month, segment): entry} (empty dict for no snapshot)"""
+    if snapshot is None:
+        return {}
+    return {(p['month'], p['segment']): p for p in load_listing(snapshot)['parts']}
+
+
+def append_snapshot(new, root, name, base):
+    """
+    Write snapshot `name` = snapshot `base` + rows of new.
+    Only the partitions that receive new rows are read and rewritten, all others are shared with base.
+    Return: path of the snapshot file and its total number of rows
+    """
+    parts = snapshot_parts(base)
+    written = append_parts(parts, new, root)
+    return write_listing(root, name, load_listing(base)['columns'], parts, written)
+
+
+def load_listing(snapshot):
+    """Listing (creation time, columns, partition files) of a snapshot"""
+    with open(snapshot) as f:
+        return json.load(f)
+
+
+def listing_digest(snapshot):
+    """Digest of the partition files listed by a snapshot (content addressed): it changes when the listing of the same
+    name is rewritten with other rows, e.g. by a second run of stage 1 on the same day"""
+    h = hashlib.sha1()
+    for p in sorted(load_listing(snapshot)['parts'], key=lambda p: p['file']):
+        h.update(p['file'].encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def latest_snapshot(root, pattern=""):
+    """Snapshot file of the store with the latest creation time, whose name starts with pattern (None if there is none)"""
+    folder = os.path.join(root, 'snapshots')
+    if not os.path.isdir(folder):
+        return None
+    snapshots = [os.path.join(folder, f) for f in os.listdir(folder) if f.startswith(pattern) and f.endswith('.json')]
+    return max(snapshots, key=os.path.getctime) if snapshots else None
+
+
+def _as_list(x):
+    return [x] if isinstance(x, str) else list(x)
+
+
+def read_snapshot(snapshot, columns=None, move_type=None, ship_class=None, start=None, end=None):
+    """
+    Read a snapshot with column projection and predicate pushdown.
+    move_type, ship_class: a value or a list of values; start (inclusive), end (exclusive): dates on Datetime.
+    Ship class and month are resolved from the snapshot listing (partitions outside are never opened),
+    all predicates are also pushed to parquet row groups.
+    """
+    meta = load_listing(snapshot)
+    root = os.path.dirname(os.path.dirname(snapshot))
+    parts = meta['parts']
+    filters = []
+    if ship_class is not None:
+        classes = _as_list(ship_class)
+        parts = [p for p in parts if p['segment'] in classes]
+        filters.append((SEGMENT_COL, 'in', classes))
+    if start is not None:
+        start = pd.Timestamp(start)
+        parts = [p for p in parts if p['month'] == UNKNOWN or p['month'] >= start.strftime('%Y-%m')]
+        filters.append((DATE_COL, '>=', start))
+    if end is not None:
+        end = pd.Timestamp(end)
+        parts = [p for p in parts if p['month'] == UNKNOWN or p['month'] <= end.strftime('%Y-%m')]
+        filters.append((DATE_COL, '<', end))
+    if move_type is not None:
+        filters.append(('MOVE_TYPE', 'in', _as_list(move_type)))
+
+    if not parts:
+        return pd.DataFrame(columns=columns if columns is not None else meta['columns'])
+    files = [os.path.join(root, p['file']) for p in parts]
+    table = pq.ParquetDataset(files, filters=filters or None).read(columns=columns)
+    return table.to_pandas()
+
+
+def snapshot_delta(old, new, columns=None, move_type=None):
+    """
+    Rows of snapshot new that are not in snapshot old. Partition files shared by both snapshots are not opened,
+    a partition rewritten by an append is compared row by row with its version in old.
+    Return: the new rows (columns, move_type as in read_snapshot), or None when rows of old are missing
+    from new (the store was rebuilt rather than appended to)
+    """
+    old_parts, new_parts = snapshot_parts(old), snapshot_parts(new)
+    if set(old_parts) - set(new_parts):
+        return None
+    root = os.path.dirname(os.path.dirname(new))
+    frames = []
+    for key, p in sorted(new_parts.items()):
+        o = old_parts.get(key)
+        if o is not None and o['file'] == p['file']:
+            continue
+        part = pd.read_parquet(os.path.join(root, p['file']))
+        if o is not None:
+            before = pd.read_parquet(os.path.join(root, o['file']))
+            if list(before.columns) != list(part.columns):
+                return None
+            h_new, h_old = key_hashes(part, list(part.columns)), key_hashes(before, list(before.columns))
+            if not np.isin(h_old, h_new).all():
+                return None
+            part = part[~np.isin(h_new, h_old)]
+        frames.append(part)
+    if not frames:
+        return pd.DataFrame(columns=columns if columns is not None else load_listing(new)['columns'])
+    delta = concat(frames, ignore_index=True)
+    if move_type is not None:
+        delta = delta[delta['MOVE_TYPE'].isin(_as_list(move_type))]
+    return delta[columns] if columns is not None else delta
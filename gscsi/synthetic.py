@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Seeded synthetic port calls with the schema of the stage 1 store, and the matching ports.csv table, for benchmarks
+and tests (the Marine Traffic data cannot be shared).
+Ports belong to maritime regions, with Zipf-like popularity. Ships are deployed on liner services (loops of
+4 to 12 ports): regional services (feeders, handysize) stay within one region, global services span 2 to 4 regions.
+A small share of calls deviate from the rotation. Every port call is an arrival and a departure, and a share
+of calls have repeated departures at the same port (geofencing around terrestrial AIS receivers, see gscsi.geofence).
+Ship classes cover the GLOBAL and REGIONAL traffic types of gscsi.legs. Generation is vectorized, and the same seed
+gives the same table.
+"""
+import numpy as np
+import pandas as pd
+from gscsi.legs import TRAFFIC_CLASSES
+from gscsi.schema import compact
+
+REGIONS = ['North Asia', 'South East Asia', 'North Europe', 'Mediterranean', 'Middle East', 'Indian Subcontinent',
+           'West Africa', 'East Africa', 'North America East Coast', 'North America West Coast',
+           'South America East Coast', 'Carribean Sea & Central America', 'Oceania']
+# centre (latitude, longitude) and a country of every region
+REGION_SITES = [(30, 125, 'CHN'), (5, 105, 'SGP'), (53, 5, 'NLD'), (38, 15, 'ITA'), (25, 52, 'ARE'), (15, 75, 'IND'),
+                (5, 0, 'GHA'), (-5, 40, 'KEN'), (35, -75, 'USA'), (35, -122, 'USA'), (-25, -45, 'BRA'), (15, -75, 'PAN'),
+                (-33, 150, 'AUS')]
+# TEU range of every ship class
+CLASS_TEU = {'SMALL FEEDER': (300, 1000), 'FEEDER': (1000, 2000), 'FEEDERMAX': (2000, 3000), 'HANDYSIZE': (1000, 2500),
+             'PANAMAX': (3000, 5100), 'POST PANAMAX': (5100, 10000), 'NEW PANAMAX': (10000, 14500), 'ULCV': (14500, 24000)}
+# Mean hours at berth, of a voyage within a region and between regions
+DWELL_HOURS, REGIONAL_HOURS, GLOBAL_HOURS = 20, 48, 400
+CALL_ROWS = 2.3  # rows per port call on average (arrival, departure and repeated departures)
+SHIPS_PER_SERVICE = 6
+DEVIATION_RATE = .03
+
+
+def port_table(n_ports=2000, seed=0):
+    """Ports in the layout of ports.csv (PORT_ID, PORT_NAME, Latitude, Longitude, un_code, country_3, Economy name, Maritime_Region)"""
+    rng = np.random.default_rng(seed)
+    ids = np.arange(1, n_ports + 1)
+    region = ids % len(REGIONS)
+    sites = np.array([s[:2] for s in REGION_SITES], dtype=float)
+    countries = np.array([s[2] for s in REGION_SITES])
+    return pd.DataFrame({'PORT_ID': ids, 'PORT_NAME': ['PORT {}'.format(i) for i in ids],
+                         'Latitude': sites[region, 0] + rng.normal(0, 5, n_ports),
+                         'Longitude': sites[region, 1] + rng.normal(0, 8, n_ports),
+                         'un_code': ['UN{:05d}'.format(i) for i in ids], 'country_3': countries[region],
+                         'Economy name': countries[region], 'Maritime_Region': np.array(REGIONS)[region]})
+
+
+def _popular_ports(rng, region, size, per_region, n_regions):
+    """Ports of the given regions drawn by Zipf-like popularity (port IDs of a region are region + k * n_regions)"""
+    rank = np.minimum(rng.zipf(1.6, size) - 1, per_region - 1)
+    port = region + n_regions * rank
+    return np.where(port == 0, n_regions, port)  # PORT_ID 0 does not exist, n_regions is in region 0 as well
+
+
+def port_calls(n_rows, n_ports=2000, years=2, start='2019-01-01', repeat_rate=.15, seed=0):
+    """
+    About n_rows port calls (arrivals and departures) over `years` years from start, between n_ports ports (as in
+    port_table); the fleet is sized to n_rows. repeat_rate: share of calls with 1 to 3 repeated departures.
+    Return: frame with the columns and compact dtypes of the stage 1 store, sorted by SHIP_ID and time
+    """
+    rng = np.random.default_rng(seed)
+    horizon = 24 * 365 * years
+    n_regions = len(REGIONS)
+    per_region = max(1, n_ports // n_regions)
+
+    # liner services: rotation of 4 to 12 ports, in one region (regional) or 2 to 4 regions (global)
+    n_services = max(2, int(n_rows / (CALL_ROWS * horizon / (DWELL_HOURS + REGIONAL_HOURS)) / SHIPS_PER_SERVICE))
+    service_regional = np.arange(n_services) % 2 == 0
+    length = rng.integers(4, 13, n_services)
+    slot = np.arange(12)
+    home = rng.integers(0, n_regions, n_services)
+    span = np.where(service_regional, 1, rng.integers(2, 5, n_services))
+    slot_region = (home[:, None] + (slot[None, :] * span[:, None]) // length[:, None] * 3) % n_regions
+    rotation = _popular_ports(rng, slot_region, (n_services, 12), per_region, n_regions)
+    # expected calls of a ship of every service over the horizon (region changes along the loop: span)
+    # (means of the lognormal dwell and voyage times, first call within the first 30 days)
+    loop_hours = (length * (DWELL_HOURS * np.exp(.125) + REGIONAL_HOURS * np.exp(.08))
+                  + span * (GLOBAL_HOURS - REGIONAL_HOURS) * np.exp(.08) * ~service_regional)
+    calls = (horizon - 24 * 15) * length / loop_hours
+    n_ships = max(1, int(round(n_rows / (CALL_ROWS * calls.mean()))))
+    n_calls = int(calls.max() * 1.5) + 2
+
+    classes = np.array([c for t in ['REGIONAL', 'GLOBAL'] for c in TRAFFIC_CLASSES[t]])
+    service = rng.integers(0, n_services, n_ships)
+    n_class = np.where(service_regional[service], len(TRAFFIC_CLASSES['REGIONAL']), len(TRAFFIC_CLASSES['GLOBAL']))
+    first = np.where(service_regional[service], 0, len(TRAFFIC_CLASSES['REGIONAL']))
+    ship_class = first + (rng.random(n_ships) * n_class).astype(np.int64)
+    low, high = np.array([CLASS_TEU[c] for c in classes]).T
+    teu = np.round(rng.uniform(low[ship_class], high[ship_class]))
+
+    position = (rng.integers(0, 12, n_ships)[:, None] + np.arange(n_calls)[None, :]) % length[service][:, None]
+    port = rotation[service[:, None], position]
+    deviate = rng.random((n_ships, n_calls)) < DEVIATION_RATE
+    port = np.where(deviate, _popular_ports(rng, port % n_regions, port.shape, per_region, n_regions), port)
+    same = np.zeros_like(port, dtype=bool)
+    same[:, 1:] = port[:, 1:] == port[:, :-1]
+    port = np.where(same, (port + n_regions - 1) % (n_regions * per_region) + 1, port)
+    region = port % n_regions
+
+    # times (hours since start): voyage from the previous port, then time at berth
+    cross = np.zeros_like(port, dtype=bool)
+    cross[:, 1:] = region[:, 1:] != region[:, :-1]
+    voyage = rng.lognormal(np.log(np.where(cross, GLOBAL_HOURS, REGIONAL_HOURS)), .4)
+    voyage[:, 0] = rng.uniform(0, 24 * 30, n_ships)
+    dwell = rng.lognormal(np.log(DWELL_HOURS), .5, (n_ships, n_calls))
+    arrival = np.cumsum(voyage + np.concatenate([np.zeros((n_ships, 1)), dwell[:, :-1]], axis=1), axis=1)
+    departure = arrival + dwell
+
+    ship = np.repeat(np.arange(n_ships), n_calls)
+    keep = (departure < horizon).ravel()
+    ship, port, arrival, departure = ship[keep], port.ravel()[keep], arrival.ravel()[keep], departure.ravel()[keep]
+    draught = rng.uniform(60, 150, len(port)).round()
+    # repeated departures: 1 to 3 more departures between arrival and the last departure
+    n_extra = np.where(rng.random(len(port)) < repeat_rate, rng.integers(1, 4, len(port)), 0)
+    extra = np.repeat(np.arange(len(port)), n_extra)
+    extra_time = arrival[extra] + (departure[extra] - arrival[extra]) * rng.uniform(.2, .95, len(extra))
+
+    call = np.concatenate([np.arange(len(port)), np.arange(len(port)), extra])
+    hours = np.concatenate([arrival, departure, extra_time])
+    move = np.concatenate([np.zeros(len(port), dtype=np.int8), np.ones(len(port) + len(extra), dtype=np.int8)])
+    order = np.lexsort((hours, ship[call]))
+    call, hours, move = call[order], hours[order], move[order]
+    s = ship[call]
+
+    minutes = np.round(hours * 60).astype(np.int64)
+    timestamp = pd.DatetimeIndex(np.datetime64(start, 'm') + minutes.astype('timedelta64[m]')).as_unit('ns').tz_localize('UTC')
+    n_port_ids = n_regions * per_region
+    df = pd.DataFrame({'SHIP_ID': 100000 + s, 'IMO': (9000000 + s).astype(np.float64), 'MMSI': (200000000 + s).astype(np.float64),
+                       'SHIPNAME': pd.Categorical.from_codes(s, ['SHIP {}'.format(i) for i in range(n_ships)]),
+                       'TIMESTAMP_UTC': timestamp, 'PORT_ID': port[call],
+                       'PORT_NAME': pd.Categorical.from_codes(port[call] - 1, ['PORT {}'.format(i) for i in range(1, n_port_ids + 1)]),
+                       'MOVE_TYPE': pd.Categorical.from_codes(move, ['ARRIVAL', 'DEPARTURE']),
+                       'DRAUGHT_METERSX10': draught[call], 'LENGTH': (120 + teu[s] / 60).round(), 'WIDTH': (20 + teu[s] / 500).round(),
+                       'DWT': (teu[s] * 13).round(), 'GROSS_TONNAGE': (teu[s] * 11).round(), 'TEU': teu[s],
+                       'SHIP_CLASS_NAME': pd.Categorical.from_codes(ship_class[s], classes),
+                       'COMFLEET_GROUPEDTYPE': pd.Categorical.from_codes(np.zeros(len(s), dtype=np.int8), ['CONTAINER SHIPS'])})
+    df['Datetime'] = df['TIMESTAMP_UTC'].dt.tz_localize(None)
+    df['source_file'] = pd.Categorical.from_codes(np.zeros(len(s), dtype=np.int8), ['synthetic'])
+    return compact(df)
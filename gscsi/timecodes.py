@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Canonical time of port calls and integer period codes.
+Timestamps are parsed once, at ingest (gscsi.ingest): TIMESTAMP_UTC (tz-aware, part of the dedup key) and Datetime,
+the same instant as tz-naive UTC datetime64[ns] (int64 nanoseconds), which every later stage reads as is.
+Days, weeks (starting on Monday), months and quarters are integer codes since 1970 computed from these int64 values;
+period labels (YYYY-MM, Monday of the week) are made from the codes, only for the output files.
+"""
+import numpy as np
+import pandas as pd
+
+NS_PER_DAY = 86400 * 10 ** 9
+NAT = np.iinfo(np.int64).min
+# 1970-01-01 is a Thursday: days + 3 puts Mondays at multiples of 7
+WEEK_SHIFT = 3
+
+
+def naive_utc(values):
+    """
+    values as tz-naive UTC datetime64[ns] (numpy array): datetime64 values are taken as they are (no parsing),
+    tz-aware ones are converted to UTC, anything else (strings of old files) is parsed
+    """
+    dtype = getattr(values, 'dtype', None)
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return pd.DatetimeIndex(values).tz_convert('UTC').tz_localize(None).to_numpy(dtype='datetime64[ns]')
+    if dtype is not None and np.issubdtype(dtype, np.datetime64):
+        return np.asarray(values, dtype='datetime64[ns]')
+    return pd.to_datetime(values, utc=True).tz_localize(None).to_numpy(dtype='datetime64[ns]')
+
+
+def day_codes(dates):
+    """Days since 1970-01-01"""
+    ns = naive_utc(dates).view(np.int64)
+    return np.where(ns == NAT, NAT, ns // NS_PER_DAY)
+
+
+def week_codes(dates):
+    """Weeks (Monday to Sunday) since the week of 1970-01-01"""
+    days = day_codes(dates)
+    return np.where(days == NAT, NAT, (days + WEEK_SHIFT) // 7)
+
+
+def month_codes(dates):
+    """Months since 1970-01"""
+    return naive_utc(dates).astype('datetime64[M]').view(np.int64)
+
+
+def quarter_codes(dates):
+    """Quarters since 1970Q1"""
+    months = month_codes(dates)
+    return np.where(months == NAT, NAT, months // 3)
+
+
+def month_labels(codes, missing=None):
+    """YYYY-MM of month codes (missing for NaT codes, if given)"""
+    codes = np.asarray(codes, dtype=np.int64)
+    labels = codes.view('datetime64[M]').astype(str).astype(object)
+    if missing is not None:
+        labels[codes == NAT] = missing
+    return labels
+
+
+def week_starts(codes):
+    """Monday (datetime64[ns]) of week codes"""
+    codes = np.asarray(codes, dtype=np.int64)
+    return (codes * 7 - WEEK_SHIFT).astype('datetime64[D]').astype('datetime64[ns]')
+
+
+def seconds_between(end, start):
+    """Seconds from start to end (NaN where either is NaT)"""
+    return (naive_utc(end) - naive_utc(start)) / np.timedelta64(1, 's')
+
+
+def hours_between(end, start):
+    """Hours from start to end, as seconds / 3600 (NaN where either is NaT)"""
+    return seconds_between(end, start) / 3600
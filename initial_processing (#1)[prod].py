@@ -1,59 +1,65 @@
 # -*- coding: utf-8 -*-
 #### SEQ # 001. Inital processing script of Marine Traffic port calls data.
 
-import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta, date
-import os, csv, re
+import os
+from gscsi.ingest import update_store, read_sources
+from gscsi.schema import concat
+from gscsi.store import write_snapshot
+from gscsi.fleet_registry import PORT_KEY, VESSEL_KEY, load_registry, save_registry, update_registry, new_entities
+from gscsi.config import load_config
+from gscsi import instrument
+from gscsi.instrument import traced
 
 #### View settings and paths #####       
 pd.set_option('display.max_columns', 12)
 #pd.set_option('display.width', 1000)
 pd.set_option("display.precision", 3)
 pd.set_option("display.expand_frame_repr", False)
-os.chdir("Y:\\mt")
+# Paths of the site configuration (pipeline.ini, see gscsi.config)
+CONFIG = load_config()['paths']
 # Path to historical files
-path = "Y:\\PortCalls\\WorldBank\\"
+path = CONFIG['historical']
 # Path  to new files
-new_path = "Y:\\Marine Traffic (sFTP weekly)\\"
-OUTPATH =  "Y:\\mt\\"
-DRY_OUTPATH = "Y:\\bulkcargo\\work\\"
+new_path = CONFIG['weekly']
+OUTPATH = CONFIG['workdir']
+DRY_OUTPATH = CONFIG['drybulk_workdir']
+HIST_DRYBULK = CONFIG['drybulk_historical']
+JUNE_DRYBULK = CONFIG['drybulk_snapshot']
+# Partitioned columnar stores (weekly snapshots share unchanged partitions)
+STORE = os.path.join(OUTPATH, "portcalls_store")
+DRY_STORE = os.path.join(DRY_OUTPATH, "portcalls_store")
+# Step timings and row counts (JSON lines, off unless a trace file is configured, see gscsi.instrument)
+instrument.configure('initial_processing')
+# Incremental mode: parse only source files not yet listed in the manifest and merge them into the consolidated store
+INCREMENTAL = True
+# Number of processes parsing source files (None = all cores)
+INGEST_WORKERS = None
+# Streaming mode (incremental mode only): memory budget in MB, source files are read in chunks and
+# the store is written month by month, so peak memory does not grow with history. None = read in one go
+MEMORY_BUDGET_MB = None
 
 
 def get_weekly_drybulk_data(drybulk_files):
     """Process and consolidate weekly data data files for drybulk ships"""
-    junedata = pd.read_csv("Y:\\bulkcargo\\weekly\\SAL-5645-worldbank-out-port-calls.csv", sep=';')
-    hist_ = []
-    hist_.append(junedata)
-    for i,file in enumerate(drybulk_files):
-        df = pd.read_csv(file, compression='gzip', sep=',')
-        #df['source_file'] = file
-        hist_.append(df)
-    
-    h = pd.concat(hist_)
-    h['Datetime'] = pd.to_datetime(h['TIMESTAMP_UTC']).dt.tz_localize(None)
-    h = h.copy()
-    return h
+    sources = {JUNE_DRYBULK: 'drybulk_snapshot'}
+    sources.update({f: 'weekly_drybulk' for f in drybulk_files})
+    return concat(read_sources(sources, INGEST_WORKERS))
 
-def get_historical_data(path):
-    """Process and consolidate historical data files"""
+def get_historical_files(path):
+    """List all files of the historical repository"""
     files = []
     # r=root, d=directories, f = files
     for r, d, f in os.walk(path):
         for file in f:
             files.append(os.path.join(r, file))
+    return files
 
-    hist_ = []
-    for i,file in enumerate(files):
-        df = pd.read_csv(file, sep=';',decimal=',',
-                         parse_dates=['TIMESTAMP_UTC'])
-        df['source_file'] = file
-        hist_.append(df)
-
-    h = pd.concat(hist_)
-    h['Datetime'] = pd.to_datetime(h['TIMESTAMP_UTC']).dt.tz_localize(None)
-    hist = h.copy()
-    return hist
+def get_historical_data(path):
+    """Process and consolidate historical data files"""
+    sources = {f: 'historical' for f in get_historical_files(path)}
+    return concat(read_sources(sources, INGEST_WORKERS))
 
 def get_filenames(new_path):
     """Process all files from weekly update repository"""
@@ -75,19 +81,10 @@ def containers_data(files):
     """Iterate through repositry of files,open each, concatenate all in 1 DF
     +record file's size (N rows) and exact path of the source file"""
       
-    main_=[]
-    for i,file in enumerate(files):
-        df = pd.read_csv(file,compression='gzip',
-                         parse_dates=['TIMESTAMP_UTC'],)
-        df.rename(columns = {'DRAUGHT': 'DRAUGHT_METERSX10'},inplace=True)
-        df['source_file'] = file
+    main_ = read_sources({f: 'weekly_containers' for f in files}, INGEST_WORKERS)
+    for file, df in zip(files, main_):
         print("File {} contains {} rows\n".format(file,len(df)))
-        main_.append(df)
-
-    dframe = pd.concat(main_)
-    dframe['Datetime'] = pd.to_datetime(dframe['TIMESTAMP_UTC']).dt.tz_localize(None)
-    new = dframe.copy()
-    return new
+    return concat(main_)
 
 def timestamp_saved_file(fnm):
     extension = ".pkl"
@@ -126,104 +123,145 @@ def saved_last_week(fnm, extension=".pkl"):
     print(filename)
     return filename
 
-def save_unseen(df1, aports, aves):
+def save_unseen(df, aports, aves, outpath):
     """Get full records of ports and ships not seen previosuly and save results to csv """
-    df = df1.copy()
     if aports:
-        df['getit'] = np.where(df['PORT_ID'].isin(aports),1,0)
-        gotit = df[df['getit']==1]
+        gotit = df[df['PORT_ID'].isin(aports)]
         print(gotit)
-        gotit = gotit.copy()
-        gotit.drop(columns=['getit'],inplace=True)
-        gotit.to_csv(os.path.join(OUTPATH,timestamp_saved_file("new_records_of_ports")))
+        gotit.to_csv(os.path.join(outpath,timestamp_saved_file("new_records_of_ports")))
     else:
         print("No new ports")
     if aves:
-        df['getit'] = np.where(df['SHIP_ID'].isin(aves),1,0)
-        gotit = df[df['getit']==1]
+        gotit = df[df['SHIP_ID'].isin(aves)]
         print(gotit)
-        gotit = gotit.copy()
-        gotit.drop(columns=['getit'],inplace=True)
-        gotit.to_csv(os.path.join(OUTPATH,timestamp_saved_file("new_records_of_vessesls")))
+        gotit.to_csv(os.path.join(outpath,timestamp_saved_file("new_records_of_vessesls")))
     else:
         print("No new vessels")
     
-def comparison(older, df):
+def comparison(ports, vessels, df):
     """
-    Compare new and historical data to identify/print new ports and vessels (unique to this week's dataset.
-    Clarification: NOT comparing most recent weekly update with evrth provided before,
-    RATHER: everything processed last week with everything processed today 
-    [Reason: check for potential data revisions]
+    Compare new data with the registry to identify/print new ports and vessels (never seen in any earlier run).
+    (PORT_ID, PORT_NAME) and (SHIP_ID, IMO) pairs are compared, so a renamed port or a ship with a new IMO
+    shows up as well [Reason: check for potential data revisions]
     """ 
     aves, aports = None, None
-    ports_hist = list(set(list(zip(older['PORT_ID'], older['PORT_NAME']))))
-    ports_new = list(set(list(zip(df['PORT_ID'], df['PORT_NAME']))))
-    added_ports = [x for x in ports_new if x not in ports_hist]
+    added_ports = new_entities(ports, df, PORT_KEY)
     if len(added_ports) > 0: 
-        aports = [x[0] for x in added_ports]
+        aports = list(added_ports['PORT_ID'])
         print("NEW PORTS ADDED:")
-        print(added_ports)
+        print(list(added_ports.itertuples(index=False, name=None)))
   
     #Added vessels
-    hist_ves = list(set(list(zip(older['SHIP_ID'], older['IMO']))))
-    new_ves = list(set(list(zip(df['SHIP_ID'], df['IMO']))))
-    added_ves = [x for x in new_ves if x not in hist_ves]
+    added_ves = new_entities(vessels, df, VESSEL_KEY)
     if len(added_ves)> 0:
-        aves = [x[0] for x in added_ves]
+        aves = list(added_ves['SHIP_ID'])
         print("NEW VESSELS ADDED:")
         print(aves)
         
     return aves, aports
 
+def open_registry(root):
+    """Load the port and vessel registry of a store, to be checked and updated batch by batch"""
+    ports, vessels = load_registry(root)
+    return {'root': root, 'ports': ports, 'vessels': vessels, 'created': ports is None,
+            'aports': [], 'aves': [], 'records': []}
+
+def check_registry(reg, df):
+    """Report ports and vessels of df never seen before (keep their records), then add the rows of df to the registry"""
+    if not reg['created']:
+        aves, aports = comparison(reg['ports'], reg['vessels'], df)
+        if aves or aports:
+            reg['aves'] += aves or []
+            reg['aports'] += aports or []
+            reg['records'].append(df[df['PORT_ID'].isin(aports or []) | df['SHIP_ID'].isin(aves or [])])
+    reg['ports'], reg['vessels'] = update_registry(reg['ports'], reg['vessels'], df)
+
+def close_registry(reg, outpath):
+    """Save records of the new ports and vessels and the updated registry"""
+    if reg['created']:
+        print("Creating port and vessel registry of {}".format(reg['root']))
+    else:
+        records = pd.concat(reg['records']) if reg['records'] else pd.DataFrame(columns=['PORT_ID', 'SHIP_ID'])
+        save_unseen(records, reg['aports'], reg['aves'], outpath)
+    if reg['ports'] is not None:
+        save_registry(reg['root'], reg['ports'], reg['vessels'])
+
+@traced('total')
 def main():
+    """Update the containership and drybulk stores. Return: snapshots written {'containers': ..., 'drybulk': ...}"""
     ###################################
     #### Process data (new and old) ###
     ###################################
+    os.chdir(OUTPATH)
     files, drybulk_files = get_filenames(new_path)
 
     # CONTAINERSHIPS
     print("Processing containerships\n")
     filename = "Saved_data_with_missing"
-    hist = get_historical_data(path)
-    new = containers_data(files)
-    frame=pd.concat([hist,new])
-    frame.sort_values(by=['SHIP_ID','Datetime'], ascending=[True,True], inplace=True)
-    df =frame.drop_duplicates(subset=['SHIP_ID','IMO','TIMESTAMP_UTC','PORT_ID','MOVE_TYPE'],keep='first')
-    print(df.describe())
-    print(len(df), len(frame) - len(df))
-    df.to_pickle(os.path.join(OUTPATH,timestamp_saved_file(filename)[:-4]+".pkl"))
-
-    print("File saved to {} at {}".format(timestamp_saved_file(filename)[:-4]+".pkl",OUTPATH))
+    reg = open_registry(STORE)
+    if INCREMENTAL:
+        sources = {f: 'historical' for f in get_historical_files(path)}
+        sources.update({f: 'weekly_containers' for f in files})
+        with instrument.step('ingest_containers') as s:
+            df, total, dropped, snapshot = update_store(sources, STORE, timestamp_saved_file(filename)[:-4],
+                                                        os.path.join(OUTPATH, "ingest_manifest_containers.csv"),
+                                                        os.path.join(OUTPATH, "dedup_index_containers.npy"), INGEST_WORKERS,
+                                                        MEMORY_BUDGET_MB, lambda batch: check_registry(reg, batch))
+            s.note(rows_out=total, duplicates=dropped, rows_added=0 if df is None else len(df), files=len(sources))
+    else:
+        with instrument.step('read_containers') as s:
+            hist = get_historical_data(path)
+            new = containers_data(files)
+            frame=concat([hist,new])
+            s.note(rows_out=len(frame), files=len(files))
+        with instrument.step('dedup_containers', len(frame)) as s:
+            frame.sort_values(by=['SHIP_ID','Datetime'], ascending=[True,True], inplace=True)
+            df =frame.drop_duplicates(subset=['SHIP_ID','IMO','TIMESTAMP_UTC','PORT_ID','MOVE_TYPE'],keep='first')
+            total, dropped = len(df), len(frame) - len(df)
+            s.note(rows_out=total, duplicates=dropped)
+        with instrument.step('write_containers', total):
+            snapshot = write_snapshot(df, STORE, timestamp_saved_file(filename)[:-4])
+        check_registry(reg, df)
+    if df is not None and len(df):
+        print(df.describe())  # rows added by this run in incremental mode
+
+    print("Snapshot saved to {}".format(snapshot))
+    close_registry(reg, OUTPATH)
     
     # DRYBULK 
     print("Processing drybulk\n")
     filename = "Saved_drybulk_all_"
-    hist_dry = pd.read_csv("Y:\\bulkcargo\\data\\SAL-5426-out-port-calls.csv", sep=";")
-    drybulk_weekly = get_weekly_drybulk_data( drybulk_files)
-
-    hist_dry['Datetime'] = pd.to_datetime(hist_dry['TIMESTAMP_UTC']).dt.tz_localize(None)
-
-    frame= pd.concat([hist_dry,drybulk_weekly])
-    frame.sort_values(by=['SHIP_ID','Datetime'], ascending=[True,True], inplace=True)
-    df = frame.drop_duplicates(subset=['SHIP_ID','IMO','TIMESTAMP_UTC','PORT_ID','MOVE_TYPE'],keep='first')
-    print(len(df), len(frame) - len(df))
-    df.to_pickle(os.path.join(DRY_OUTPATH,timestamp_saved_file(filename)+".pkl"))
-    assert len(df[df['COMFLEET_GROUPEDTYPE'] =='DRY BULK'])==len(df)
-
-    #Compare with last week 
-    # #last_file = saved_last_week(filename)
-    # try:
-    #     svd = saved_last_week(filename)
-    # except FileNotFoundError():
-    #     svd=False
-       
-    # if svd:
-    #     older = pd.read_csv(os.path.join(OUTPATH, svd),low_memory=False)
-    #     print(older.dtypes)
-    #     aves, aports = comparison(older,df)
-
-    # aves, aports = comparison(older,df)
-    # save_unseen(df, aports, aves)
+    reg = open_registry(DRY_STORE)
+    def check_drybulk(batch):
+        assert len(batch[batch['COMFLEET_GROUPEDTYPE'] =='DRY BULK'])==len(batch)
+        check_registry(reg, batch)
+
+    if INCREMENTAL:
+        sources = {HIST_DRYBULK: 'drybulk_snapshot', JUNE_DRYBULK: 'drybulk_snapshot'}
+        sources.update({f: 'weekly_drybulk' for f in drybulk_files})
+        with instrument.step('ingest_drybulk') as s:
+            df, total, dropped, dry_snapshot = update_store(sources, DRY_STORE, timestamp_saved_file(filename)[:-4],
+                                                        os.path.join(DRY_OUTPATH, "ingest_manifest_drybulk.csv"),
+                                                        os.path.join(DRY_OUTPATH, "dedup_index_drybulk.npy"), INGEST_WORKERS,
+                                                        MEMORY_BUDGET_MB, check_drybulk)
+            s.note(rows_out=total, duplicates=dropped, rows_added=0 if df is None else len(df), files=len(sources))
+    else:
+        with instrument.step('read_drybulk') as s:
+            hist_dry = read_sources({HIST_DRYBULK: 'drybulk_snapshot'}, 1)[0]
+            drybulk_weekly = get_weekly_drybulk_data( drybulk_files)
+
+            frame= concat([hist_dry,drybulk_weekly])
+            s.note(rows_out=len(frame), files=len(drybulk_files) + 1)
+        with instrument.step('dedup_drybulk', len(frame)) as s:
+            frame.sort_values(by=['SHIP_ID','Datetime'], ascending=[True,True], inplace=True)
+            df = frame.drop_duplicates(subset=['SHIP_ID','IMO','TIMESTAMP_UTC','PORT_ID','MOVE_TYPE'],keep='first')
+            total, dropped = len(df), len(frame) - len(df)
+            s.note(rows_out=total, duplicates=dropped)
+        with instrument.step('write_drybulk', total):
+            dry_snapshot = write_snapshot(df, DRY_STORE, timestamp_saved_file(filename)[:-4])
+        check_drybulk(df)
+    close_registry(reg, DRY_OUTPATH)
+    return {'containers': snapshot, 'drybulk': dry_snapshot}
 
     #Derive weekly indicators
     #df.set_index('TIMESTAMP_UTC').resample('W-MON',label='left',closed='left').size().plot(title="Number of observations per week")
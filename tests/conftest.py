@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the gscsi helpers and stage scripts on seeded synthetic port calls (gscsi.synthetic): python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MPLBACKEND', 'Agg')
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+collapse_runs on a small hand-made frame against the per-ship loop of sequential_filter it replaced
+"""
+import numpy as np
+import pandas as pd
+from gscsi.geofence import collapse_runs
+
+
+def legacy_runs(dep):
+    """Per-ship loop of sequential_filter before gscsi.geofence"""
+    dep = dep.sort_values(by=['SHIP_ID','TIMESTAMP_UTC'])
+    new_list = []
+    for g, v in dep.groupby(['SHIP_ID','IMO']):
+        if len(v)>1:
+            v = v.sort_values(by=['TIMESTAMP_UTC'], ascending=True)
+            v['value_grp'] = (v['PORT_ID'] != v['PORT_ID'].shift()).cumsum()
+            new = pd.DataFrame({'FirstDate' : v.groupby('value_grp')['TIMESTAMP_UTC'].first().values,
+                                'FirstDraft' : v.groupby('value_grp')['DRAUGHT_METERSX10'].first().values,
+                                'LastDraft' : v.groupby('value_grp')['DRAUGHT_METERSX10'].last().values,
+                                'LastDate' : v.groupby('value_grp')['TIMESTAMP_UTC'].last().values,
+                                'Consecutive' : v.groupby('value_grp').size().values,
+                                'PORT_ID' : v.groupby('value_grp')['PORT_ID'].first().values}).reset_index(drop=True)
+            new['SHIP_ID'] = g[0]
+            new['IMO'] = g[1]
+            new_list.append(new)
+    return pd.concat(new_list)
+
+
+def test_collapse_runs_matches_loop():
+    # ship 1: runs at ports 10, 20, 10 (rows shuffled); ship 2: one run; ship 3: a single call; ship 4: no IMO
+    dep = pd.DataFrame({'SHIP_ID': [1, 1, 1, 1, 1, 1, 2, 2, 3, 4, 4],
+                        'IMO': [11., 11., 11., 11., 11., 11., 22., 22., 33., np.nan, np.nan],
+                        'PORT_ID': [20, 10, 10, 20, 10, 10, 30, 30, 40, 50, 60],
+                        'DRAUGHT_METERSX10': [90., 80., np.nan, 95., 100., 105., 120., 121., 70., 60., 61.],
+                        'hour': [30, 0, 5, 40, 50, 60, 1, 9, 3, 4, 8]}).sample(frac=1, random_state=1)
+    dep['TIMESTAMP_UTC'] = pd.Timestamp('2021-03-01', tz='UTC') + pd.to_timedelta(dep.pop('hour'), unit='h')
+    dep['Datetime'] = dep['TIMESTAMP_UTC'].dt.tz_convert(None)
+
+    runs = collapse_runs(dep)
+    pd.testing.assert_frame_equal(runs, legacy_runs(dep))
+    assert list(runs['PORT_ID']) == [10, 20, 10, 30]
+    assert list(runs['Consecutive']) == [2, 2, 2, 2]
+    assert list(runs.index) == [0, 1, 2, 0]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+collapse_runs (and sequential_filter of stage 2) against the per-ship loop it replaced, kept here as the reference
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from gscsi.geofence import collapse_runs
+from gscsi.pipeline import load_script
+from gscsi.synthetic import port_calls
+
+
+def legacy_runs(dep):
+    """Per-ship loop of sequential_filter before gscsi.geofence (departures only, as published)"""
+    dep = dep.copy()
+    # sorting before the loop (just in case...)
+    dep.sort_values(by=['SHIP_ID','TIMESTAMP_UTC'],inplace=True)
+
+    #forming a group of observations for each ship to iterate over
+    g_dep = dep.groupby(['SHIP_ID','IMO'])
+
+    new_list = []
+    new_accum = 0
+
+    for g, v in g_dep:
+        if len(v)>1:
+            v = v.sort_values(by=['TIMESTAMP_UTC'], ascending=True)
+            v['value_grp'] = (v['PORT_ID'] != v['PORT_ID'].shift()).cumsum()
+            new = pd.DataFrame({'FirstDate' : v.groupby('value_grp')['TIMESTAMP_UTC'].first().values,
+                                'FirstDraft' : v.groupby('value_grp')['DRAUGHT_METERSX10'].first().values,
+                                'LastDraft' : v.groupby('value_grp')['DRAUGHT_METERSX10'].last().values,
+                                'LastDate' : v.groupby('value_grp')['TIMESTAMP_UTC'].last().values,
+                                'Consecutive' : v.groupby('value_grp').size().values,
+                                'PORT_ID' : v.groupby('value_grp')['PORT_ID'].first().values}).reset_index(drop=True)
+            new['SHIP_ID'] = g[0]
+            new['IMO'] = g[1]
+            new_accum += len(new)
+            new_list.append(new)
+        else:
+            continue
+
+    deps = pd.concat(new_list)
+    return deps
+
+
+@pytest.fixture(scope='module')
+def departures():
+    """
+    Synthetic departures (with repeated departures at the same port) plus the awkward cases: missing draughts,
+    a ship with a single departure, a ship whose calls alternate between two IMOs, calls without IMO, shuffled rows.
+    Departures at the same time as another departure of the ship are left out: the loop sorted with an unstable sort,
+    so the order of such ties was arbitrary
+    """
+    rng = np.random.default_rng(4)
+    df = port_calls(60000, seed=4)
+    dep = df[df['MOVE_TYPE'] == 'DEPARTURE'].copy()
+    dep = dep[~dep.duplicated(['SHIP_ID', 'Datetime'], keep=False)]
+    dep.loc[rng.random(len(dep)) < .05, 'DRAUGHT_METERSX10'] = np.nan
+    ships = dep['SHIP_ID'].unique()
+    interleaved = dep['SHIP_ID'] == ships[1]
+    dep.loc[interleaved, 'IMO'] = np.where(np.arange(interleaved.sum()) % 2, 1234567., dep.loc[interleaved, 'IMO'])
+    dep.loc[(dep['SHIP_ID'] == ships[2]) & (rng.random(len(dep)) < .3), 'IMO'] = np.nan
+    single = dep[dep['SHIP_ID'] == ships[3]].iloc[:1].assign(SHIP_ID=999999)
+    dep = pd.concat([dep, single]).sample(frac=1, random_state=0)
+    assert (dep.groupby('SHIP_ID')['IMO'].nunique() > 1).any()
+    return dep
+
+
+def test_collapse_runs_matches_loop(departures):
+    expected = legacy_runs(departures)
+    assert (expected['Consecutive'] > 1).any()
+    for date_col in ['Datetime', 'TIMESTAMP_UTC']:
+        pd.testing.assert_frame_equal(collapse_runs(departures, date_col=date_col), expected)
+
+
+def test_sequential_filter_matches_loop(departures):
+    stage2 = load_script('dep2dep_(#2)[prod].py', 'dep2dep')
+    calls = pd.concat([departures, departures.assign(MOVE_TYPE='ARRIVAL')])
+    pd.testing.assert_frame_equal(stage2.sequential_filter(calls, False), legacy_runs(departures))
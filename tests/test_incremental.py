@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental Dep2Dep (gscsi.incremental, incremental_aggregates of stage 2) against a full rebuild of the same snapshot
+and against the full run in memory
+"""
+import pandas as pd
+import pytest
+from gscsi.pipeline import load_script
+from gscsi.synthetic import port_calls, port_table
+from gscsi.ports import PortRegistry
+from gscsi.schema import compact
+from gscsi.store import write_snapshot, append_snapshot
+from gscsi.fleet_registry import update_registry, ship_table as fleet_ship_table
+
+CUTOFF = '2019-09-01 06:00'
+
+
+@pytest.fixture(scope='module')
+def stage2():
+    return load_script('dep2dep_(#2)[prod].py', 'dep2dep')
+
+
+@pytest.fixture(scope='module')
+def calls():
+    """Synthetic port calls, split at CUTOFF into the rows of a first snapshot and the rows added by the next one"""
+    df = port_calls(40000, seed=7)
+    early = (df['Datetime'] < pd.Timestamp(CUTOFF)).to_numpy()
+    return df[early], df[~early]
+
+
+@pytest.fixture(scope='module')
+def metadata(calls):
+    ship_table = fleet_ship_table(update_registry(None, None, pd.concat(calls))[1])
+    ship_table['SHIP_ID'] = ship_table['SHIP_ID'].astype(int)
+    return PortRegistry(compact(port_table(seed=7))), compact(ship_table)
+
+
+def aggregates(stage2, state, snapshot, metadata, capsys):
+    """Aggregates of snapshot from the state directory state, and whether the state was rebuilt"""
+    stage2.STATE = str(state)
+    result = stage2.incremental_aggregates(snapshot, *metadata)
+    return result, 'Rebuilding' in capsys.readouterr().out
+
+
+def full_run(stage2, snapshot, metadata):
+    """Aggregates of the full run in memory of main"""
+    ports, ship_table = metadata
+    data = stage2.time_difference(stage2.clean_deps(stage2.sequential_filter(stage2.get_data(snapshot, False), False), ports, ship_table))
+    return {t: stage2.augment_to_ports_aggregates(data if t == 'ALL' else data[data['TRAFFIC_TYPE'] == t], ports,
+                                                  stage2.AGG_FREQUENCIES, stage2.AGGREGATES)
+            for t in stage2.TRAFFIC_TYPES}
+
+
+def assert_same(result, expected):
+    assert set(result) == set(expected)
+    for traffic_type, by_freq in expected.items():
+        for freq, frame in by_freq.items():
+            pd.testing.assert_frame_equal(result[traffic_type][freq].reset_index(drop=True), frame.reset_index(drop=True))
+
+
+def test_runs_cross_the_snapshot_boundary(calls):
+    # some ships are still departing from the port of their last departure of the first snapshot: their runs are stitched
+    first, added = [c[c['MOVE_TYPE'] == 'DEPARTURE'] for c in calls]
+    last = first.sort_values('Datetime').groupby('SHIP_ID')['PORT_ID'].last()
+    nxt = added.sort_values('Datetime').groupby('SHIP_ID')['PORT_ID'].first()
+    assert (last.reindex(nxt.index) == nxt).any()
+
+
+def test_update_matches_rebuild(stage2, calls, metadata, tmp_path, capsys):
+    first = write_snapshot(calls[0], str(tmp_path / 'store'), 'A')
+    second, _ = append_snapshot(calls[1], str(tmp_path / 'store'), 'B', first)
+    _, rebuilt = aggregates(stage2, tmp_path / 'state', first, metadata, capsys)
+    assert rebuilt
+    result, rebuilt = aggregates(stage2, tmp_path / 'state', second, metadata, capsys)
+    assert not rebuilt
+    expected, _ = aggregates(stage2, tmp_path / 'full', second, metadata, capsys)
+    assert_same(result, expected)
+    assert_same(result, full_run(stage2, second, metadata))
+
+
+def test_new_traffic_type_is_rebuilt(stage2, calls, metadata, tmp_path, capsys, monkeypatch):
+    first = write_snapshot(calls[0], str(tmp_path / 'store'), 'A')
+    second, _ = append_snapshot(calls[1], str(tmp_path / 'store'), 'B', first)
+    monkeypatch.setattr(stage2, 'TRAFFIC_TYPES', ['GLOBAL'])
+    aggregates(stage2, tmp_path / 'state', first, metadata, capsys)
+    monkeypatch.setattr(stage2, 'TRAFFIC_TYPES', ['GLOBAL', 'REGIONAL'])
+    result, rebuilt = aggregates(stage2, tmp_path / 'state', second, metadata, capsys)
+    assert rebuilt
+    assert_same(result, full_run(stage2, second, metadata))
+
+
+def test_rewritten_snapshot_is_rebuilt(stage2, calls, metadata, tmp_path, capsys):
+    # stage 1 run twice on the same day: the listing of the state's snapshot is rewritten with more rows
+    snapshot = write_snapshot(calls[0], str(tmp_path / 'store'), 'S')
+    stale, _ = aggregates(stage2, tmp_path / 'state', snapshot, metadata, capsys)
+    assert write_snapshot(pd.concat(calls), str(tmp_path / 'store'), 'S') == snapshot
+    result, rebuilt = aggregates(stage2, tmp_path / 'state', snapshot, metadata, capsys)
+    assert rebuilt
+    expected, _ = aggregates(stage2, tmp_path / 'full', snapshot, metadata, capsys)
+    assert_same(result, expected)
+    assert len(result['ALL']['monthly']) > len(stale['ALL']['monthly'])
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Ingestion of port call files (gscsi.ingest) into the partitioned store: rows without IDs and duplicate counts,
+streaming mode against the in-memory mode
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from gscsi import ingest
+from gscsi.ingest import update_store, DEDUP_SUBSET, PORTCALL_DTYPES
+from gscsi.store import read_snapshot
+from gscsi.synthetic import port_calls
+
+
+def weekly_file(frame, path):
+    """frame written as a weekly container file (gzip csv, DRAUGHT column)"""
+    columns = [c for c in frame.columns if c in PORTCALL_DTYPES]
+    frame[columns].rename(columns={'DRAUGHT_METERSX10': 'DRAUGHT'}).to_csv(path, index=False, compression='gzip')
+    return str(path)
+
+
+@pytest.fixture(scope='module')
+def calls():
+    """Synthetic port calls with 30 repeated rows, 7 rows without SHIP_ID (first half) and 5 without PORT_ID (second half)"""
+    df = port_calls(3000, seed=5)
+    df = pd.concat([df, df.iloc[100:130]], ignore_index=True)
+    df = df.astype({'SHIP_ID': 'Int64', 'PORT_ID': 'Int64'})
+    df.loc[np.arange(7) * 50, 'SHIP_ID'] = pd.NA
+    df.loc[len(df) - 1 - np.arange(5) * 50, 'PORT_ID'] = pd.NA
+    return df
+
+
+def test_rows_without_ids(calls, tmp_path, capsys):
+    # rows without SHIP_ID or PORT_ID are dropped when read (and reported per file), duplicates are counted among the rest
+    half = len(calls) // 2
+    sources = {weekly_file(calls.iloc[:half], tmp_path / 'week_0.csv.gz'): 'weekly_containers',
+               weekly_file(calls.iloc[half:], tmp_path / 'week_1.csv.gz'): 'weekly_containers'}
+    added, total, dropped, snapshot = update_store(sources, str(tmp_path / 'store'), 'calls_A', str(tmp_path / 'manifest.csv'),
+                                                   str(tmp_path / 'index.npy'), workers=1)
+    out = capsys.readouterr().out
+    missing = calls[['SHIP_ID', 'PORT_ID']].isna().any(axis=1).to_numpy()
+    kept = calls[~missing]
+    assert out.count('without SHIP_ID or PORT_ID dropped') == 2
+    assert sum(int(line.split(': ')[1].split()[0]) for line in out.splitlines() if 'without SHIP_ID' in line) == missing.sum() == 12
+    assert total == len(kept.drop_duplicates(subset=DEDUP_SUBSET)) == len(added)
+    assert dropped == len(kept) - total > 0
+    store = read_snapshot(snapshot)
+    assert len(store) == total
+    assert store['SHIP_ID'].dtype == np.int32 and store['PORT_ID'].dtype == np.int32
+
+
+def test_streaming_matches_memory(calls, tmp_path, monkeypatch):
+    # chunks of 500 rows: every file is read in several chunks; the second week is appended to the first snapshot
+    monkeypatch.setattr(ingest, 'chunk_rows', lambda memory_budget_mb, workers: 500)
+    half = len(calls) // 2
+    weeks = [weekly_file(calls.iloc[:half], tmp_path / 'week_0.csv.gz'), weekly_file(calls.iloc[half:], tmp_path / 'week_1.csv.gz')]
+    stores = {}
+    for mode, budget in [('memory', None), ('streaming', 1)]:
+        sources = {}
+        for i, week in enumerate(weeks):
+            sources[week] = 'weekly_containers'
+            _, total, dropped, snapshot = update_store(sources, str(tmp_path / mode), 'calls_{}'.format(i), str(tmp_path / (mode + '.csv')),
+                                                       str(tmp_path / (mode + '.npy')), workers=1, memory_budget_mb=budget)
+        stores[mode] = total, dropped, read_snapshot(snapshot).sort_values(DEDUP_SUBSET).reset_index(drop=True)
+    assert stores['streaming'][:2] == stores['memory'][:2]
+    pd.testing.assert_frame_equal(stores['streaming'][2], stores['memory'][2])
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Per-lane quantile sketches (gscsi.lane_sketch) against exact quantiles: identical to np.quantile while a lane holds at
+most `capacity` values, within a rank error of 1 / capacity once it is compressed (values folded in over 24 merges)
+"""
+import numpy as np
+import pandas as pd
+from gscsi.lane_sketch import from_values, merge, quantiles, empty, lane_sketches
+
+QUANTILES = [.05, .1, .25, .5, .75, .9]
+CAPACITY = 100
+
+
+def rank(sorted_values, value):
+    """Rank (0 to 1) of value among sorted_values, ties counted half"""
+    lo, hi = np.searchsorted(sorted_values, value, 'left'), np.searchsorted(sorted_values, value, 'right')
+    return (lo + hi) / 2 / (len(sorted_values) - 1)
+
+
+def test_sketch_quantiles():
+    rng = np.random.default_rng(4)
+    # lanes 1-3 stay below the capacity, lanes 4-6 hold 2000 to 8000 values
+    sizes = [1, 40, CAPACITY, 2000, 5000, 8000]
+    cur = np.repeat(np.arange(1, len(sizes) + 1), sizes)
+    prev = np.full(len(cur), 7)
+    values = rng.lognormal(5, .6, len(cur)).round(1)
+    sketch = empty()
+    for part in np.array_split(rng.permutation(len(cur)), 24):
+        sketch = merge(sketch, from_values(cur[part], prev[part], values[part]), CAPACITY)
+    result = quantiles(sketch, QUANTILES)
+
+    assert list(result['period count']) == sizes
+    for i, size in enumerate(sizes):
+        x = np.sort(values[cur == i + 1])
+        estimate = result[QUANTILES].iloc[i].to_numpy(dtype=float)
+        if size <= CAPACITY:
+            np.testing.assert_allclose(estimate, np.quantile(x, QUANTILES), rtol=1e-12)
+        else:
+            assert (sketch['lane'] == i).sum() <= CAPACITY
+            for q, e in zip(QUANTILES, estimate):
+                assert abs(rank(x, e) - q) <= 1 / CAPACITY
+
+
+def test_lane_sketches_state(tmp_path, capsys):
+    # months folded in by a first run come from the state file: a second run on more months gives the sketch of all rows
+    rng = np.random.default_rng(5)
+    n = 6000
+    df = pd.DataFrame({'PORT_ID_CUR': rng.integers(1, 4, n), 'PORT_ID_PREV': rng.integers(1, 3, n),
+                       'Dep2_YearMonth': np.sort(rng.integers(0, 12, n)), 'diff_hrs median': rng.gamma(2., 80., n)})
+    df['Dep2_YearMonth'] = pd.Series(pd.period_range('2020-01', periods=12, freq='M').astype(str).to_numpy()[df['Dep2_YearMonth']])
+    path = str(tmp_path / 'sketches.npz')
+    early = df[df['Dep2_YearMonth'] < '2020-09']
+    lane_sketches(early, path, 'Dep2_YearMonth', 'diff_hrs median', CAPACITY)
+    capsys.readouterr()
+    result = quantiles(lane_sketches(df, path, 'Dep2_YearMonth', 'diff_hrs median', CAPACITY), QUANTILES)
+    assert 'Lane sketches: 6 months from state, 4 folded in, 2 pending' in capsys.readouterr().out
+    for i, (key, values) in enumerate(df.groupby(['PORT_ID_CUR', 'PORT_ID_PREV'])['diff_hrs median']):
+        x = np.sort(values.to_numpy())
+        assert result['period count'].iat[i] == len(x)
+        for q in QUANTILES:
+            assert abs(rank(x, result[q].iat[i]) - q) <= 1 / CAPACITY
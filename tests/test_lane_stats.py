@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Per-lane quantiles of stage 3 (gscsi.lane_stats) against np.quantile lane by lane
+"""
+import numpy as np
+import pandas as pd
+from gscsi.lane_stats import lane_quantiles, reference_lead_times
+
+QUANTILES = [.1, .25, .5]
+
+
+def test_lane_quantiles_match_numpy():
+    rng = np.random.default_rng(2)
+    sizes = rng.integers(1, 30, 300)
+    df = pd.DataFrame({'PORT_ID_CUR': np.repeat(rng.integers(1, 40, len(sizes)), sizes),
+                       'PORT_ID_PREV': np.repeat(rng.integers(1, 40, len(sizes)), sizes).astype(float),
+                       'diff_hrs median': rng.gamma(2., 100., sizes.sum()).round(1)})
+    df = df.sample(frac=1, random_state=0).reset_index(drop=True)
+    lanes, code = lane_quantiles(df, 'diff_hrs median', QUANTILES)
+
+    groups = df.groupby(['PORT_ID_CUR', 'PORT_ID_PREV'])['diff_hrs median']
+    assert len(lanes) == groups.ngroups
+    for i, ((cur, prev), values) in enumerate(groups):
+        row = lanes.iloc[i]
+        assert (row['PORT_ID_CUR'], row['PORT_ID_PREV']) == (cur, prev)
+        assert row['period count'] == len(values)
+        np.testing.assert_allclose(row[QUANTILES].to_numpy(dtype=float), np.quantile(values.to_numpy(), QUANTILES), rtol=1e-12)
+        assert (code[values.index] == i).all()
+
+    expected = 3 * lanes[.5] - 2 * lanes[.1]
+    np.testing.assert_allclose(reference_lead_times(lanes, 2, .1), expected.to_numpy(), rtol=1e-12)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Port registry (gscsi.ports): corrections and binary cache of load_ports
+"""
+import os
+from gscsi.ports import load_ports, read_ports, LEGACY_ROW_FIXES
+from gscsi.synthetic import port_table
+
+
+def test_load_ports(tmp_path):
+    (tmp_path / 'data').mkdir()
+    (tmp_path / 'work').mkdir()
+    ports_file = str(tmp_path / 'data' / 'ports.csv')
+    port_table(2000, seed=1).to_csv(ports_file, index=False)
+    raw = read_ports(ports_file)
+
+    ports = load_ports(ports_file, str(tmp_path / 'work'))
+    row, column, value = LEGACY_ROW_FIXES[0]
+    assert ports.take([raw['PORT_ID'].iat[row]], [column])[column].iat[0] == value
+    assert raw[column].iat[row] != value
+    # nothing written next to ports.csv, the cache is in the working directory and reused
+    assert os.listdir(str(tmp_path / 'data')) == ['ports.csv']
+    assert sorted(os.listdir(str(tmp_path / 'work'))) == ['ports_registry.json', 'ports_registry.parquet']
+    assert load_ports(ports_file, str(tmp_path / 'work')).table.equals(ports.table)
+
+    published = load_ports(ports_file, corrections=False)
+    assert published.take([raw['PORT_ID'].iat[row]], [column])[column].iat[0] == raw[column].iat[row]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Smoke test of the local query service (gscsi.query_service) through its client (gscsi.query_client): every endpoint
+over small result files, served on a free port of this host for the duration of the module
+"""
+import threading
+from http.server import ThreadingHTTPServer
+import pandas as pd
+import pytest
+from gscsi.query_service import QueryService, handler
+from gscsi.query_client import QueryClient
+
+MONTHS = ['2021-01', '2021-02', '2021-03']
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('results')
+    pd.DataFrame({'PORT_ID Destination': [10, 10, 10, 10, 20], 'PORT_ID Origin': [20, 20, 20, 30, 10],
+                  'Departure_YearMonth': MONTHS + ['2021-01', '2021-02'], 'SHIP_ID count': [5, 6, 7, 8, 9],
+                  'TEU sum': [1e4, 2e4, 3e4, 4e4, 5e4], 'diff_hrs median': [100., 110., 120., 50., 90.]}
+                 ).to_csv(workdir / 'Dep2Dep_GLOBAL_ports_monthly_agg_01Jan2022.csv')
+    pd.DataFrame({'PORT_ID': [10, 10, 20], 'PORT_NAME_CUR': ['PORT 10', 'PORT 10', 'PORT 20'], 'Departure_YearMonth': MONTHS[:2] + ['2021-01'],
+                  'port_delay': [1.5, 2.5, 3.5]}).to_csv(workdir / 'stress_by_port _01Jan2022_(global).csv')
+    pd.DataFrame({'Maritime_Region_CUR': ['North Europe'] * 3, 'Dep2_YearMonth': MONTHS, 'delayed_capacity': [1., 2., 3.]}
+                 ).to_csv(workdir / 'stressdata _01Jan2022_(global).csv')
+    pd.DataFrame({'Maritime_Region_PREV': ['North Asia'] * 3, 'Maritime_Region_CUR': ['North Europe'] * 3, 'Dep2_YearMonth': MONTHS,
+                  'pairs': [4, 5, 6], 'delayed_capacity': [10., 20., 30.]}
+                 ).to_csv(workdir / 'stress_matrix_Maritime_Region _01Jan2022_(global).csv')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler(QueryService(str(workdir), traffic_types=('GLOBAL',))))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield QueryClient('http://127.0.0.1:{}'.format(server.server_address[1]))
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_endpoints(client):
+    assert len(client.files()) == 4
+    lane = client.lane(20, 10, start='2021-02')
+    assert list(lane['Departure_YearMonth']) == ['2021-02', '2021-03']
+    assert list(lane['SHIP_ID count']) == [6, 7]
+    assert client.lane(99, 10).empty
+
+    port = client.port(10, end='2021-01')
+    assert list(port['dep2dep']['PORT_ID Origin']) == [20, 30]
+    assert list(port['stress_by_port']['port_delay']) == [1.5]
+
+    assert list(client.region('North Europe', end='2021-02')['delayed_capacity']) == [1., 2.]
+    assert list(client.region_pair('North Asia', 'North Europe')['pairs']) == [4, 5, 6]
+
+
+def test_errors_and_metrics(client):
+    with pytest.raises(ValueError):
+        client.lane('x', 10)
+    with pytest.raises(KeyError):
+        client.lane(20, 10, traffic='REGIONAL')
+    with pytest.raises(KeyError):
+        client.get('nope')
+    metrics = client.metrics()['endpoints']
+    assert metrics['/lane']['errors'] >= 2
+    assert metrics['/nope'] == dict(metrics['/nope'], requests=1, errors=1)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Origin x destination stress matrices (gscsi.region_matrix) against a merge of the port attributes and a groupby
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from gscsi.region_matrix import region_matrix, tidy, wide, LEVELS, MEASURES, UNKNOWN
+from gscsi.ports import PortRegistry
+from gscsi.schema import compact
+from gscsi.synthetic import port_table
+
+
+@pytest.fixture(scope='module')
+def pairs():
+    """Lane-month rows between 60 ports, with a port missing from the port table (999) and a missing origin"""
+    rng = np.random.default_rng(6)
+    n = 5000
+    pairs = pd.DataFrame({'PORT_ID_CUR': rng.integers(1, 61, n), 'PORT_ID_PREV': rng.integers(1, 61, n).astype(float),
+                          'Dep2_YearMonth': rng.choice(['2021-01', '2021-02', '2021-03'], n),
+                          'delayed_ship': rng.exponential(2., n), 'delayed_capacity': rng.exponential(5000., n)})
+    pairs.loc[:9, 'PORT_ID_CUR'] = 999
+    pairs.loc[10:14, 'PORT_ID_PREV'] = np.nan
+    return pairs
+
+
+@pytest.mark.parametrize('level', LEVELS)
+def test_region_matrix_matches_groupby(pairs, level):
+    ports = PortRegistry(compact(port_table(60, seed=6)))
+    matrix = region_matrix(pairs, ports, level)
+    assert matrix['groups'][-1] == UNKNOWN
+
+    table = ports.table.set_index('PORT_ID')[level].astype(object)
+    frame = pairs.assign(**{level + '_PREV': pairs['PORT_ID_PREV'].map(table).fillna(UNKNOWN),
+                            level + '_CUR': pairs['PORT_ID_CUR'].map(table).fillna(UNKNOWN)})
+    keys = ['Dep2_YearMonth', level + '_PREV', level + '_CUR']
+    expected = frame.groupby(keys).agg(pairs=('delayed_ship', 'size'), **{m: (m, 'sum') for m in MEASURES}).reset_index()
+    result = tidy(matrix).sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-12)
+
+    # matrix form: destination groups as columns, all (month, origin group) rows
+    capacity = wide(matrix)
+    assert capacity.shape == (len(matrix['months']) * len(matrix['groups']), len(matrix['groups']))
+    np.testing.assert_allclose(capacity.to_numpy().sum(), pairs['delayed_capacity'].sum(), rtol=1e-12)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Rolling daily stress (gscsi.rolling_stress): prefix-sum windows against a naive sum over the legs of every window
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from gscsi.rolling_stress import leg_delays, rolling_stress
+
+WINDOWS = [3, 7, 28]
+
+
+@pytest.fixture(scope='module')
+def legs():
+    """Legs of leg_delays: destination port, day (days since 1970), delay (hours) and capacity"""
+    rng = np.random.default_rng(8)
+    n = 400
+    return pd.DataFrame({'PORT_ID_CUR': rng.integers(1, 6, n), 'day': 18600 + rng.integers(0, 120, n) ** 2 // 120,
+                         'delay': np.where(rng.random(n) < .3, 0., rng.exponential(30., n)), 'capacity': rng.integers(500, 9000, n).astype(float)})
+
+
+def naive(legs, windows, start=None):
+    """Rolling stress by destination port, one window and one day at a time"""
+    rows = []
+    end = legs['day'].max()
+    for port, group in legs.groupby('PORT_ID_CUR'):
+        first = group['day'].min() if start is None else max(group['day'].min(), start - max(windows) + 1)
+        for w in windows:
+            for day in range(first if start is None else max(first, start), end + 1):
+                if not ((group['day'] > day - max(windows)) & (group['day'] <= day)).any():
+                    continue
+                window = group[(group['day'] > day - w) & (group['day'] <= day)]
+                capacity_delay = (window['capacity'] * window['delay']).sum()
+                rows.append({'PORT_ID': port, 'date': day, 'window_days': w, 'legs': len(window),
+                             'delayed_ship': window['delay'].sum() / (24 * w), 'delayed_capacity': capacity_delay / (24 * w),
+                             'capacity': window['capacity'].sum(),
+                             'port_delay': capacity_delay / window['capacity'].sum() if len(window) else np.nan})
+    out = pd.DataFrame(rows)
+    out['date'] = out['date'].to_numpy().astype('datetime64[D]')
+    return out
+
+
+def same(result, expected):
+    keys = ['window_days', 'PORT_ID', 'date']
+    result = result.sort_values(keys).reset_index(drop=True)
+    expected = expected[result.columns].sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-9)
+
+
+def test_rolling_matches_naive(legs):
+    same(rolling_stress(legs, legs['PORT_ID_CUR'], WINDOWS), naive(legs, WINDOWS))
+
+
+def test_rolling_from_start(legs):
+    start = pd.Timestamp(np.datetime64(18660, 'D'))
+    result = rolling_stress(legs, legs['PORT_ID_CUR'], WINDOWS, start=start)
+    assert result['date'].min() >= start
+    same(result, naive(legs, WINDOWS, 18660))
+
+
+def test_leg_delays():
+    lanes = pd.DataFrame({'PORT_ID_CUR': [1, 1, 2], 'PORT_ID_PREV': [2, 3, 1], 'reference_lead_time': [100., 50., 80.]})
+    legs = pd.DataFrame({'PORT_ID_PREV': [2, 3, 1, 4, 2], 'PORT_ID_CUR': [1, 1, 2, 2, 1],
+                         'DATE_CUR': pd.to_datetime(['2021-01-01 10:00', '2021-01-02 08:00', '2021-01-02 09:00', '2021-01-03 10:00', '2021-01-04 11:00']),
+                         'diff_hrs': [130., 40., 100., 500., np.nan], 'TEU': [1000., 2000., 3000., 4000., 5000.]})
+    out = leg_delays(legs, lanes, 'TEU')
+    # lane (2, 4) has no reference lead time, the last leg no diff_hrs
+    assert list(out['PORT_ID_CUR']) == [1, 1, 2]
+    assert list(out['delay']) == [30., 0., 20.]
+    assert list(out['capacity']) == [1000., 2000., 3000.]
+    assert list(out['day']) == [18628, 18629, 18629]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Drybulk segment (gscsi.segments): laden/ballast load status of the legs, DWT-weighted aggregates, and the full run of
+stage 2 in memory against the ship-sharded run
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from gscsi.segments import load_status, weighted
+from gscsi.aggregates import lane_aggregates, attach_ports, AGGREGATES
+from gscsi.ports import PortRegistry
+from gscsi.pipeline import load_script
+from gscsi.synthetic import port_calls, port_table
+from gscsi.schema import compact
+from gscsi.store import write_snapshot
+from gscsi.fleet_registry import update_registry, ship_table as fleet_ship_table
+from gscsi.shards import sharded_cells
+
+
+@pytest.fixture(scope='module')
+def stage2():
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv('GSCSI_SEGMENT', 'drybulk')
+        return load_script('dep2dep_(#2)[prod].py', 'dep2dep_drybulk')
+
+
+def test_load_status():
+    # deepest draught 100 for ship 1 (LADEN from 75), 50 for ship 2 (LADEN from 37.5); zero or missing draughts have no status
+    draught = [100, 80, 70, 0, np.nan, 30, 50]
+    ships = [1, 1, 1, 1, 1, 2, 2]
+    status = load_status(draught, ships)
+    assert list(status) == ['LADEN', 'LADEN', 'BALLAST', 'nan', 'nan', 'BALLAST', 'LADEN']
+    assert isinstance(status.dtype, pd.CategoricalDtype)
+
+
+def test_weighted_aggregates():
+    aggregates = weighted(AGGREGATES, 'DWT')
+    assert aggregates == [('SHIP_ID', 'count'), ('DWT', 'sum'), ('diff_hrs', 'median')]
+    ports = PortRegistry(compact(port_table(5)))
+    legs = pd.DataFrame({'SHIP_ID': [1, 2, 3, 1, 2], 'PORT_CUR': [1, 1, 1, 2, 1], 'PORT_PREV': [2., 2., 2., 1., 2.],
+                         'DATE_CUR': pd.to_datetime(['2021-01-03', '2021-01-20', '2021-02-01', '2021-01-05', '2021-01-25']),
+                         'DWT': [50000., 80000., 60000., 50000., 80000.], 'diff_hrs': [100., 200., 300., 50., 150.]})
+    monthly = lane_aggregates(legs, ports, ['monthly'], aggregates)['monthly']
+    expected = legs.groupby(['PORT_CUR', 'PORT_PREV', legs['DATE_CUR'].dt.strftime('%Y-%m')]).agg(
+        {'SHIP_ID': 'count', 'DWT': 'sum', 'diff_hrs': 'median'})
+    assert list(monthly[['SHIP_ID count', 'DWT sum', 'diff_hrs median']].itertuples(index=False, name=None)) == \
+        list(expected.itertuples(index=False, name=None))
+    assert 'TEU sum' not in monthly.columns
+
+
+def test_sharded_matches_memory(stage2, tmp_path):
+    df = port_calls(20000, seed=3)
+    ship_table = fleet_ship_table(update_registry(None, None, df)[1])
+    ship_table['SHIP_ID'] = ship_table['SHIP_ID'].astype(int)
+    ports, ship_table = PortRegistry(compact(port_table(seed=3))), compact(ship_table)
+    snapshot = write_snapshot(df, str(tmp_path / 'store'), 'S')
+    aggregates = weighted(AGGREGATES, 'DWT')
+
+    data = stage2.time_difference(stage2.clean_deps(stage2.sequential_filter(stage2.get_data(snapshot, False), False), ports, ship_table))
+    assert set(data['TRAFFIC_TYPE'].astype(object)) >= {'LADEN', 'BALLAST'}
+    cells = sharded_cells(snapshot, str(tmp_path / 'shards'), ports, ship_table, stage2.TRAFFIC_TYPES, ['monthly'], stage2.DEP_COLUMNS, 3,
+                          workers=1, weight='DWT', draught=True)
+    for traffic_type in stage2.TRAFFIC_TYPES:
+        legs = data if traffic_type == 'ALL' else data[data['TRAFFIC_TYPE'] == traffic_type]
+        expected = stage2.augment_to_ports_aggregates(legs, ports, ['monthly'], aggregates)['monthly']
+        pd.testing.assert_frame_equal(attach_ports(cells[(traffic_type, 'monthly')], ports, 'monthly', aggregates), expected)
+
+
+def test_incremental_is_refused(stage2, monkeypatch):
+    assert not stage2.INCREMENTAL
+    monkeypatch.setattr(stage2, 'INCREMENTAL', True)
+    with pytest.raises(ValueError, match='INCREMENTAL'):
+        stage2.main()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Ship-sharded stage 2 (gscsi.shards) against the full run in memory, with and without the time at port
+"""
+import pandas as pd
+import pytest
+from gscsi.pipeline import load_script
+from gscsi.synthetic import port_calls, port_table
+from gscsi.ports import PortRegistry
+from gscsi.schema import compact
+from gscsi.store import write_snapshot
+from gscsi.fleet_registry import update_registry, ship_table as fleet_ship_table
+from gscsi.aggregates import attach_ports, AGGREGATES
+from gscsi.port_stays import STAY_AGGREGATES
+from gscsi.shards import sharded_cells
+
+
+@pytest.fixture(scope='module')
+def stage2():
+    return load_script('dep2dep_(#2)[prod].py', 'dep2dep')
+
+
+@pytest.fixture(scope='module')
+def snapshot(tmp_path_factory):
+    df = port_calls(30000, seed=11)
+    ship_table = fleet_ship_table(update_registry(None, None, df)[1])
+    ship_table['SHIP_ID'] = ship_table['SHIP_ID'].astype(int)
+    return (write_snapshot(df, str(tmp_path_factory.mktemp('store')), 'S'),
+            PortRegistry(compact(port_table(seed=11))), compact(ship_table))
+
+
+@pytest.mark.parametrize('stays', [False, True])
+def test_sharded_matches_memory(stage2, snapshot, stays, tmp_path, monkeypatch):
+    snapshot, ports, ship_table = snapshot
+    monkeypatch.setattr(stage2, 'PORT_STAYS', stays)
+    aggregates = AGGREGATES + STAY_AGGREGATES if stays else AGGREGATES
+    freqs = ['monthly', 'weekly']
+
+    df = stage2.get_data(snapshot, False, ['DEPARTURE', 'ARRIVAL'] if stays else 'DEPARTURE')
+    data = stage2.clean_deps(stage2.sequential_filter(df, False), ports, ship_table)
+    if stays:
+        data = stage2.advanced_tdiff(stage2.pair_port_stays(data, df))
+    data = stage2.time_difference(data)
+    cells = sharded_cells(snapshot, str(tmp_path / 'shards'), ports, ship_table, stage2.TRAFFIC_TYPES, freqs, stage2.DEP_COLUMNS, 4,
+                          n_buckets=3, workers=2, stays=stays)
+    for traffic_type in stage2.TRAFFIC_TYPES:
+        legs = data if traffic_type == 'ALL' else data[data['TRAFFIC_TYPE'] == traffic_type]
+        expected = stage2.augment_to_ports_aggregates(legs, ports, freqs, aggregates)
+        for freq in freqs:
+            result = attach_ports(cells[(traffic_type, freq)], ports, freq, aggregates)
+            assert len(result) == len(expected[freq]) > 0
+            pd.testing.assert_frame_equal(result, expected[freq])